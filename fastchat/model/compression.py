@@ -1,7 +1,18 @@
+"""
+Group-wise weight compression for `--load-8bit`.
+
+Quantize a model once, so that workers load it without quantizing again:
+python3 -m fastchat.model.compression --model-path lmsys/vicuna-7b-v1.5 --output-path vicuna-7b-v1.5-compressed
+"""
+import argparse
 import dataclasses
 import gc
 import glob
+import json
+import mmap
 import os
+import shutil
+import struct
 
 from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
@@ -36,37 +47,114 @@ default_compression_config = CompressionConfig(
 )
 
 
+# A compressed checkpoint is a safetensors file. The quantized data of a linear
+# weight is stored under the name of the weight, with its scale and minimum under
+# these suffixes. The metadata holds the compression config and the original
+# shape of each compressed weight.
+COMPRESSED_CHECKPOINT_NAME = "compressed_model.safetensors"
+SCALE_SUFFIX = ".__scale__"
+MIN_SUFFIX = ".__min__"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+# The number of weight elements dequantized at a time by `compressed_linear`.
+# Blocks that fit in the CPU caches keep the dequantized rows hot for the matmul,
+# while on GPUs larger blocks keep the number of kernel launches low.
+CPU_BLOCK_NUMEL = 2**20
+GPU_BLOCK_NUMEL = 2**24
+
+
 class CLinear(nn.Module):
-    """Compressed Linear Layer."""
+    """Compressed Linear Layer.
 
-    def __init__(self, weight=None, bias=None, device=None):
+    The weight stays quantized. `forward` dequantizes it one block of output
+    features at a time and multiplies each block right away, so the full floating
+    point weight is never materialized.
+    """
+
+    def __init__(self, weight=None, bias=None, device=None, config=None):
         super().__init__()
+        self.config = config or default_compression_config
         if weight is None:
             self.weight = None
         elif isinstance(weight, Tensor):
-            self.weight = compress(weight.data.to(device), default_compression_config)
+            self.weight = compress(weight.data.to(device), self.config)
         else:
             self.weight = weight
         self.bias = bias
 
     def forward(self, input: Tensor) -> Tensor:
-        weight = decompress(self.weight, default_compression_config)
-        if self.bias is None:
+        return compressed_linear(input, self.weight, self.bias, self.config)
+
+
+def compressed_linear(input: Tensor, packed_data, bias, config) -> Tensor:
+    """`F.linear` with a weight compressed by `compress`, dequantized blockwise."""
+    original_shape = packed_data[-1]
+    if not config.enabled or config.group_dim != 1 or len(original_shape) != 2:
+        weight = decompress(packed_data, config)
+        if bias is None:
             return F.linear(input.to(weight.dtype), weight)
-        return F.linear(input.to(weight.dtype), weight, self.bias.to(weight.dtype))
+        return F.linear(input.to(weight.dtype), weight, bias.to(weight.dtype))
+
+    scale = packed_data[-2]
+    input = input.to(scale.dtype)
+    out_features, in_features = original_shape
+    num_groups = scale.shape[1]
+    block_numel = CPU_BLOCK_NUMEL if scale.device.type == "cpu" else GPU_BLOCK_NUMEL
+    rows_per_block = max(block_numel // (num_groups * config.group_size), 1)
+
+    outputs = []
+    for start in range(0, out_features, rows_per_block):
+        end = min(start + rows_per_block, out_features)
+        weight = dequantize_rows(packed_data, config, start, end)
+        outputs.append(F.linear(input, weight[:, :in_features]))
+    output = outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=-1)
+    if bias is not None:
+        output += bias.to(output.dtype)
+    return output
+
+
+def dequantize_rows(packed_data, config, start, end):
+    """Dequantize rows [start, end) of a 2D weight compressed with group_dim=1.
+
+    Returns a tensor of shape [end - start, num_groups * group_size], which still
+    holds the padding of the last group.
+    """
+    if config.symmetric:
+        data, scale, _ = packed_data
+        data = unpack_data(data[start:end], config)
+        data = data / scale[start:end]
+    else:
+        data, mn, scale, _ = packed_data
+        data = unpack_data(data[start:end], config)
+        data = data / scale[start:end]
+        data.add_(mn[start:end])
+    return data.view(end - start, -1)
 
 
-def compress_module(module, target_device):
+def compress_module(module, target_device, config=default_compression_config):
     for attr_str in dir(module):
         target_attr = getattr(module, attr_str)
         if type(target_attr) == torch.nn.Linear:
             setattr(
                 module,
                 attr_str,
-                CLinear(target_attr.weight, target_attr.bias, target_device),
+                CLinear(target_attr.weight, target_attr.bias, target_device, config),
             )
     for name, child in module.named_children():
-        compress_module(child, target_device)
+        compress_module(child, target_device, config)
 
 
 def get_compressed_list(module, prefix=""):
@@ -85,7 +173,13 @@ def get_compressed_list(module, prefix=""):
     return compressed_list
 
 
-def apply_compressed_weight(module, compressed_state_dict, target_device, prefix=""):
+def apply_compressed_weight(
+    module,
+    compressed_state_dict,
+    target_device,
+    prefix="",
+    config=default_compression_config,
+):
     for attr_str in dir(module):
         target_attr = getattr(module, attr_str)
         if type(target_attr) == torch.nn.Linear:
@@ -96,27 +190,21 @@ def apply_compressed_weight(module, compressed_state_dict, target_device, prefix
                 module,
                 attr_str,
                 CLinear(
-                    compressed_state_dict[full_name], target_attr.bias, target_device
+                    compressed_state_dict[full_name],
+                    target_attr.bias,
+                    target_device,
+                    config,
                 ),
             )
     for name, child in module.named_children():
         child_prefix = f"{prefix}.{name}" if prefix else name
         apply_compressed_weight(
-            child, compressed_state_dict, target_device, child_prefix
+            child, compressed_state_dict, target_device, child_prefix, config
         )
 
 
-def load_compress_model(model_path, device, torch_dtype, use_fast, revision="main"):
-    # partially load model
-    # `use_fast=True`` is not supported for some models.
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_path, use_fast=use_fast, revision=revision, trust_remote_code=True
-        )
-    except TypeError:
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_path, use_fast=~use_fast, revision=revision, trust_remote_code=True
-        )
+def init_empty_model(model_path, torch_dtype, revision="main"):
+    """Build the model of `model_path` without allocating its weights."""
     with init_empty_weights():
         # `trust_remote_code` should be set as `True` for both AutoConfig and AutoModel
         config = AutoConfig.from_pretrained(
@@ -138,7 +226,12 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
                 model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
         except NameError:
             model = AutoModel.from_config(config, trust_remote_code=True)
-        linear_weights = get_compressed_list(model)
+    return model
+
+
+def get_weight_files(model_path, revision="main"):
+    """Return the local model folder, its weight files and whether they are
+    safetensors files."""
     if os.path.exists(model_path):
         # `model_path` is a local folder
         base_pattern = os.path.join(model_path, "pytorch_model*.bin")
@@ -171,14 +264,24 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
     use_safetensors = False
     if len(files) == 0:
         base_pattern = os.path.join(model_path, "*.safetensors")
-        files = glob.glob(base_pattern)
+        files = [
+            f
+            for f in glob.glob(base_pattern)
+            if os.path.basename(f) != COMPRESSED_CHECKPOINT_NAME
+        ]
         use_safetensors = True
     if len(files) == 0:
         raise ValueError(
             f"Cannot find any model weight files. "
             f"Please check your (cached) weight path: {model_path}"
         )
+    return model_path, sorted(files), use_safetensors
 
+
+def compress_weight_files(
+    files, use_safetensors, linear_weights, device, torch_dtype, config
+):
+    """Load the weight files and quantize the weights in `linear_weights`."""
     compressed_state_dict = {}
     if use_safetensors:
         from safetensors.torch import load_file
@@ -192,28 +295,80 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
         for name in tmp_state_dict:
             if name in linear_weights:
                 tensor = tmp_state_dict[name].to(device, dtype=torch_dtype)
-                compressed_state_dict[name] = compress(
-                    tensor, default_compression_config
-                )
+                compressed_state_dict[name] = compress(tensor, config)
             else:
                 compressed_state_dict[name] = tmp_state_dict[name].to(
                     device, dtype=torch_dtype
                 )
             tmp_state_dict[name] = None
             tensor = None
-            gc.collect()
-            torch.cuda.empty_cache()
-            if device == "xpu":
-                torch.xpu.empty_cache()
-            if device == "npu":
-                torch.npu.empty_cache()
+        # The caching allocator reuses the memory of the freed tensors, so
+        # releasing it once per shard is enough.
+        tmp_state_dict = None
+        gc.collect()
+        empty_device_cache(device)
+    return compressed_state_dict
+
+
+def empty_device_cache(device):
+    torch.cuda.empty_cache()
+    if device == "xpu":
+        torch.xpu.empty_cache()
+    if device == "npu":
+        torch.npu.empty_cache()
+
+
+def load_compress_model(
+    model_path,
+    device,
+    torch_dtype,
+    use_fast,
+    revision="main",
+    compression_config=default_compression_config,
+):
+    """Load a model with its linear weights compressed.
+
+    If `model_path` is a folder written by `save_compressed_checkpoint`, the
+    compressed weights are memory-mapped from it instead of being quantized
+    again, and its compression config overrides `compression_config`.
+    """
+    # partially load model
+    # `use_fast=True`` is not supported for some models.
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_path, use_fast=use_fast, revision=revision, trust_remote_code=True
+        )
+    except TypeError:
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_path, use_fast=~use_fast, revision=revision, trust_remote_code=True
+        )
+    model = init_empty_model(model_path, torch_dtype, revision)
+    linear_weights = get_compressed_list(model)
+
+    checkpoint = os.path.join(model_path, COMPRESSED_CHECKPOINT_NAME)
+    if os.path.exists(checkpoint):
+        compressed_state_dict, compression_config = load_compressed_checkpoint(
+            checkpoint, device, torch_dtype
+        )
+    else:
+        _, files, use_safetensors = get_weight_files(model_path, revision)
+        compressed_state_dict = compress_weight_files(
+            files,
+            use_safetensors,
+            linear_weights,
+            device,
+            torch_dtype,
+            compression_config,
+        )
 
     for name in model.state_dict():
         if name not in linear_weights:
             set_module_tensor_to_device(
                 model, name, device, value=compressed_state_dict[name]
             )
-    apply_compressed_weight(model, compressed_state_dict, device)
+    apply_compressed_weight(
+        model, compressed_state_dict, device, config=compression_config
+    )
 
     if torch_dtype == torch.float16:
         model.half()
@@ -223,8 +378,148 @@ def load_compress_model(model_path, device, torch_dtype, use_fast, revision="mai
     return model, tokenizer
 
 
+def mmap_safetensors(filename):
+    """Map the tensors of a safetensors file into memory without reading them.
+
+    The mapping is private copy-on-write: pages are read from the page cache on
+    first access and shared with every other process mapping the same file.
+    Return the tensors and the metadata of the file.
+    """
+    with open(filename, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    metadata = header.pop("__metadata__", None) or {}
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - begin) // dtype.itemsize,
+            offset=8 + header_size + begin,
+        )
+        tensors[name] = tensor.view(info["shape"])
+    return tensors, metadata
+
+
+def save_compressed_checkpoint(
+    model_path,
+    output_path,
+    device="cpu",
+    torch_dtype=torch.float16,
+    revision="main",
+    compression_config=default_compression_config,
+):
+    """Quantize a model once and save it to a folder that `load_compress_model`
+    loads without quantizing again.
+
+    The other files of the model (config, tokenizer, code) are copied along.
+    """
+    from safetensors.torch import save_file
+
+    model = init_empty_model(model_path, torch_dtype, revision)
+    linear_weights = get_compressed_list(model)
+    model_path, files, use_safetensors = get_weight_files(model_path, revision)
+    compressed_state_dict = compress_weight_files(
+        files, use_safetensors, linear_weights, device, torch_dtype, compression_config
+    )
+
+    tensors = {}
+    shapes = {}
+    for name, value in compressed_state_dict.items():
+        if isinstance(value, tuple):
+            tensors[name] = value[0]
+            tensors[name + SCALE_SUFFIX] = value[-2]
+            if not compression_config.symmetric:
+                tensors[name + MIN_SUFFIX] = value[1]
+            shapes[name] = list(value[-1])
+        else:
+            tensors[name] = value
+    # safetensors refuses tensors that share memory, such as tied embeddings.
+    seen = set()
+    for name, tensor in tensors.items():
+        tensor = tensor.to("cpu").contiguous()
+        if tensor.data_ptr() in seen:
+            tensor = tensor.clone()
+        seen.add(tensor.data_ptr())
+        tensors[name] = tensor
+
+    os.makedirs(output_path, exist_ok=True)
+    weight_files = set(files) | set(glob.glob(os.path.join(model_path, "*.index.json")))
+    for filename in glob.glob(os.path.join(model_path, "*")):
+        if os.path.isfile(filename) and filename not in weight_files:
+            shutil.copy(filename, output_path)
+    metadata = {
+        "format": "pt",
+        "compression_config": json.dumps(dataclasses.asdict(compression_config)),
+        "compressed_shapes": json.dumps(shapes),
+    }
+    save_file(tensors, os.path.join(output_path, COMPRESSED_CHECKPOINT_NAME), metadata)
+
+
+def load_compressed_checkpoint(filename, device, torch_dtype):
+    """Load a file written by `save_compressed_checkpoint`.
+
+    Return the compressed state dict and the compression config it was
+    written with.
+    """
+    tensors, metadata = mmap_safetensors(filename)
+    config = CompressionConfig(**json.loads(metadata["compression_config"]))
+    shapes = json.loads(metadata["compressed_shapes"])
+
+    compressed_state_dict = {}
+    for name, tensor in tensors.items():
+        if name.endswith(SCALE_SUFFIX) or name.endswith(MIN_SUFFIX):
+            continue
+        if name in shapes:
+            scale = tensors[name + SCALE_SUFFIX].to(device)
+            if config.symmetric:
+                value = (tensor.to(device), scale, torch.Size(shapes[name]))
+            else:
+                mn = tensors[name + MIN_SUFFIX].to(device)
+                value = (tensor.to(device), mn, scale, torch.Size(shapes[name]))
+        else:
+            value = tensor.to(device, dtype=torch_dtype)
+        compressed_state_dict[name] = value
+    return compressed_state_dict, config
+
+
+def pack_int4(data, dim):
+    """Pack pairs of 4-bit values along `dim` into one uint8."""
+    data = data.to(torch.uint8).movedim(dim, -1)
+    packed = data[..., 0::2] | (data[..., 1::2] << 4)
+    return packed.movedim(-1, dim).contiguous()
+
+
+def unpack_int4(packed, dim):
+    packed = packed.movedim(dim, -1)
+    data = torch.stack([packed & 0xF, packed >> 4], dim=-1).flatten(-2)
+    return data.movedim(-1, dim)
+
+
+def unpack_data(data, config):
+    """Undo the 4-bit packing of `compress` for `num_bits <= 4`."""
+    if config.num_bits > 4:
+        return data
+    data = unpack_int4(data, config.group_dim + 1)
+    if config.symmetric:
+        # Signed values are stored with an offset of 8.
+        return data.to(torch.int8) - 8
+    return data
+
+
 def compress(tensor, config):
-    """Simulate group-wise quantization."""
+    """Simulate group-wise quantization.
+
+    With `num_bits <= 4`, two values are packed into each byte along the group
+    dimension.
+    """
     if not config.enabled:
         return tensor
 
@@ -235,6 +530,7 @@ def compress(tensor, config):
         config.symmetric,
     )
     assert num_bits <= 8
+    assert num_bits > 4 or group_size % 2 == 0
 
     original_shape = tensor.shape
     num_groups = (original_shape[group_dim] + group_size - 1) // group_size
@@ -262,6 +558,8 @@ def compress(tensor, config):
         scale = B / torch.max(data.abs(), dim=group_dim + 1, keepdim=True)[0]
         data = data * scale
         data = data.clamp_(-B, B).round_().to(torch.int8)
+        if num_bits <= 4:
+            data = pack_int4(data + 8, group_dim + 1)
         return data, scale, original_shape
     else:
         B = 2**num_bits - 1
@@ -273,6 +571,8 @@ def compress(tensor, config):
         data.mul_(scale)
 
         data = data.clamp_(0, B).round_().to(torch.uint8)
+        if num_bits <= 4:
+            data = pack_int4(data, group_dim + 1)
         return data, mn, scale, original_shape
 
 
@@ -291,10 +591,10 @@ def decompress(packed_data, config):
     # Dequantize
     if symmetric:
         data, scale, original_shape = packed_data
-        data = data / scale
+        data = unpack_data(data, config) / scale
     else:
         data, mn, scale, original_shape = packed_data
-        data = data / scale
+        data = unpack_data(data, config) / scale
         data.add_(mn)
 
     # Unpad
@@ -310,3 +610,44 @@ def decompress(packed_data, config):
         return data[indices].contiguous()
     else:
         return data.view(original_shape)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--output-path", type=str, required=True)
+    parser.add_argument("--revision", type=str, default="main")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cpu",
+        help="The device to quantize on. The output does not depend on it.",
+    )
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        choices=["float16", "bfloat16", "float32"],
+        default="float16",
+    )
+    parser.add_argument(
+        "--num-bits", type=int, default=default_compression_config.num_bits
+    )
+    parser.add_argument(
+        "--group-size", type=int, default=default_compression_config.group_size
+    )
+    parser.add_argument("--asymmetric", action="store_true")
+    args = parser.parse_args()
+
+    save_compressed_checkpoint(
+        args.model_path,
+        args.output_path,
+        device=args.device,
+        torch_dtype=getattr(torch, args.dtype),
+        revision=args.revision,
+        compression_config=CompressionConfig(
+            num_bits=args.num_bits,
+            group_size=args.group_size,
+            group_dim=1,
+            symmetric=not args.asymmetric,
+        ),
+    )
@@ -0,0 +1,242 @@
+"""
+Fast model loading by memory-mapping the checkpoint shards.
+
+With `--mmap-weights`, `from_pretrained` of the auto model classes is replaced
+while a model adapter loads its model: the model is built without weights and
+each parameter is set to a view of its memory-mapped shard. On CPU, a parameter
+that already has the target dtype is not copied at all: its pages are read
+lazily on first use and shared with the page cache. Shards are mapped by
+parallel threads, which overlaps their reads with the copies to a GPU.
+
+With `--weight-store-dir` (e.g. a folder in /dev/shm), the first process that
+loads a model writes its weights, converted to the target dtype, to a single
+file in the store. Later processes, such as several replicas of a CPU worker on
+one host, map that file and share the same physical pages.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import glob
+import os
+import re
+import time
+from typing import Dict, Optional
+
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+import torch
+from transformers import (
+    AutoConfig,
+    AutoModel,
+    AutoModelForCausalLM,
+    AutoModelForSeq2SeqLM,
+    GenerationConfig,
+)
+
+from fastchat.model.compression import COMPRESSED_CHECKPOINT_NAME, mmap_safetensors
+
+
+class LoadTimer:
+    """Measure the time spent in each phase of a model load."""
+
+    def __init__(self):
+        self.timings = {}
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (
+                time.perf_counter() - tic
+            )
+
+    def get_timings(self) -> Dict[str, float]:
+        return {**self.timings, "total": time.perf_counter() - self.start}
+
+
+def format_load_timings(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in timings.items())
+
+
+def get_checkpoint_files(model_path: str, revision: str = "main"):
+    """Return the checkpoint shards of a model, preferring safetensors."""
+    if not os.path.exists(model_path):
+        from huggingface_hub import snapshot_download
+
+        model_path = snapshot_download(model_path, revision=revision)
+    files = [
+        f
+        for f in glob.glob(os.path.join(model_path, "*.safetensors"))
+        if os.path.basename(f) != COMPRESSED_CHECKPOINT_NAME
+    ]
+    if len(files) == 0:
+        files = glob.glob(os.path.join(model_path, "pytorch_model*.bin"))
+    if len(files) == 0:
+        raise ValueError(
+            f"Cannot find any model weight files. "
+            f"Please check your (cached) weight path: {model_path}"
+        )
+    return sorted(files)
+
+
+def mmap_checkpoint_file(filename: str) -> Dict[str, torch.Tensor]:
+    if filename.endswith(".safetensors"):
+        return mmap_safetensors(filename)[0]
+    return torch.load(filename, map_location="cpu", mmap=True, weights_only=True)
+
+
+def get_weight_store_path(
+    weight_store_dir: str, model_path: str, revision: str, torch_dtype
+) -> str:
+    name = re.sub(r"[^\w.-]", "--", os.path.abspath(model_path))
+    dtype = str(torch_dtype).replace("torch.", "")
+    return os.path.join(weight_store_dir, f"{name}-{revision}-{dtype}.safetensors")
+
+
+def save_to_weight_store(model: torch.nn.Module, path: str):
+    """Write the state dict of a model to the store, atomically."""
+    from safetensors.torch import save_file
+
+    tensors = {}
+    seen = set()
+    for name, tensor in model.state_dict().items():
+        # Tied weights are stored once and tied again after loading.
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        tensors[name] = tensor.detach().to("cpu").contiguous()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_file(tensors, tmp_path, {"format": "pt"})
+    os.replace(tmp_path, path)
+
+
+def set_weights(model, state_dict, names, device, torch_dtype):
+    """Set the parameters and buffers of `model` found in `state_dict`."""
+    for name, tensor in state_dict.items():
+        if name in names:
+            dtype = torch_dtype if tensor.is_floating_point() else None
+            set_module_tensor_to_device(model, name, device, value=tensor, dtype=dtype)
+
+
+def load_weights_mmap(
+    model_cls,
+    model_path: str,
+    device: str,
+    torch_dtype,
+    revision: str = "main",
+    trust_remote_code: bool = False,
+    weight_store_dir: Optional[str] = None,
+    num_threads: int = 8,
+    timer: Optional[LoadTimer] = None,
+):
+    """Build a model with `model_cls.from_config` and set its weights from the
+    memory-mapped checkpoint. See the module docstring."""
+    timer = timer or LoadTimer()
+    config = AutoConfig.from_pretrained(
+        model_path, revision=revision, trust_remote_code=trust_remote_code
+    )
+    with init_empty_weights():
+        model = model_cls.from_config(config, trust_remote_code=trust_remote_code)
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(
+            model_path, revision=revision
+        )
+    except OSError:
+        pass
+    names = set(model.state_dict().keys())
+
+    store_path = None
+    if weight_store_dir is not None:
+        store_path = get_weight_store_path(
+            weight_store_dir, model_path, revision, torch_dtype
+        )
+    if store_path is not None and os.path.exists(store_path):
+        files = [store_path]
+    else:
+        files = get_checkpoint_files(model_path, revision)
+
+    def load_file(filename):
+        state_dict = mmap_checkpoint_file(filename)
+        set_weights(model, state_dict, names, device, torch_dtype)
+
+    with timer.phase("mmap_weights"):
+        with ThreadPoolExecutor(min(num_threads, len(files))) as pool:
+            list(pool.map(load_file, files))
+        model.tie_weights()
+
+    missing = [
+        name for name, param in model.named_parameters() if param.device.type == "meta"
+    ]
+    if missing:
+        raise ValueError(
+            f"Cannot load {len(missing)} weights of {model_path} from the "
+            f"memory-mapped checkpoint, such as {missing[0]}. "
+            f"Please load it without --mmap-weights."
+        )
+
+    if store_path is not None and files != [store_path]:
+        with timer.phase("save_weight_store"):
+            save_to_weight_store(model, store_path)
+            if device == "cpu":
+                # Map the store, so this process shares its pages with later
+                # ones instead of keeping its own converted copy.
+                state_dict = mmap_safetensors(store_path)[0]
+                set_weights(model, state_dict, names, device, torch_dtype)
+                model.tie_weights()
+
+    model.eval()
+    return model
+
+
+# The keyword arguments of `from_pretrained` that `load_weights_mmap` supports.
+# Calls with any other argument go through the original `from_pretrained`.
+MMAP_SUPPORTED_KWARGS = {
+    "low_cpu_mem_usage",
+    "torch_dtype",
+    "dtype",
+    "revision",
+    "trust_remote_code",
+}
+
+
+@contextlib.contextmanager
+def mmap_from_pretrained(
+    device: str, weight_store_dir: Optional[str] = None, timer=None
+):
+    """Make `from_pretrained` of the auto model classes load weights with
+    `load_weights_mmap`, so the model adapters use it without changes."""
+    patched = []
+
+    def make_from_pretrained(model_cls, original):
+        def from_pretrained(model_path, *args, **kwargs):
+            if args or not set(kwargs) <= MMAP_SUPPORTED_KWARGS:
+                return original(model_path, *args, **kwargs)
+            return load_weights_mmap(
+                model_cls,
+                model_path,
+                device,
+                kwargs.get("torch_dtype", kwargs.get("dtype")),
+                revision=kwargs.get("revision", "main"),
+                trust_remote_code=kwargs.get("trust_remote_code", False),
+                weight_store_dir=weight_store_dir,
+                timer=timer,
+            )
+
+        return from_pretrained
+
+    for model_cls in (AutoModel, AutoModelForCausalLM, AutoModelForSeq2SeqLM):
+        patched.append((model_cls, model_cls.__dict__.get("from_pretrained")))
+        model_cls.from_pretrained = make_from_pretrained(
+            model_cls, model_cls.from_pretrained
+        )
+    try:
+        yield
+    finally:
+        for model_cls, original in patched:
+            if original is None:
+                del model_cls.from_pretrained
+            else:
+                model_cls.from_pretrained = original
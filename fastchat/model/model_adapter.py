@@ -1,5 +1,6 @@
 """Model adapter registration."""
 
+import contextlib
 import math
 import os
 import re
@@ -28,6 +29,7 @@ from transformers import (
 from fastchat.constants import CPU_ISA
 from fastchat.conversation import Conversation, get_conv_template
 from fastchat.model.compression import load_compress_model
+from fastchat.model.lazy_loading import LoadTimer, mmap_from_pretrained
 from fastchat.model.llama_condense_monkey_patch import replace_llama_with_condense
 from fastchat.model.model_chatglm import generate_stream_chatglm
 from fastchat.model.model_codet5p import generate_stream_codet5p
@@ -206,10 +208,16 @@ def load_model(
     xft_config: Optional[XftConfig] = None,
     revision: str = "main",
     debug: bool = False,
+    mmap_weights: bool = False,
+    weight_store_dir: Optional[str] = None,
 ):
-    """Load a model from Hugging Face."""
+    """Load a model from Hugging Face.
+
+    The time spent in each phase of the load is stored in `model.load_timings`.
+    """
     import accelerate
 
+    timer = LoadTimer()
     # get model adapter
     adapter = get_model_adapter(model_path)
 
@@ -292,12 +300,14 @@ def load_model(
                 "8-bit quantization is not supported for multi-gpu inference."
             )
         else:
-            model, tokenizer = adapter.load_compress_model(
-                model_path=model_path,
-                device=device,
-                torch_dtype=kwargs["torch_dtype"],
-                revision=revision,
-            )
+            with timer.phase("load_compress_model"):
+                model, tokenizer = adapter.load_compress_model(
+                    model_path=model_path,
+                    device=device,
+                    torch_dtype=kwargs["torch_dtype"],
+                    revision=revision,
+                )
+            model.load_timings = timer.get_timings()
             if debug:
                 print(model)
             return model, tokenizer
@@ -305,7 +315,8 @@ def load_model(
         assert (
             awq_config.wbits == 4
         ), "Currently we only support 4-bit inference for AWQ."
-        model, tokenizer = load_awq_quantized(model_path, awq_config, device)
+        with timer.phase("load_model"):
+            model, tokenizer = load_awq_quantized(model_path, awq_config, device)
         if num_gpus != 1:
             device_map = accelerate.infer_auto_device_map(
                 model,
@@ -323,9 +334,11 @@ def load_model(
             )
         else:
             model.to(device)
+        model.load_timings = timer.get_timings()
         return model, tokenizer
     elif gptq_config and gptq_config.wbits < 16:
-        model, tokenizer = load_gptq_quantized(model_path, gptq_config)
+        with timer.phase("load_model"):
+            model, tokenizer = load_gptq_quantized(model_path, gptq_config)
         if num_gpus != 1:
             device_map = accelerate.infer_auto_device_map(
                 model,
@@ -337,12 +350,17 @@ def load_model(
             )
         else:
             model.to(device)
+        model.load_timings = timer.get_timings()
         return model, tokenizer
     elif exllama_config:
-        model, tokenizer = load_exllama_model(model_path, exllama_config)
+        with timer.phase("load_model"):
+            model, tokenizer = load_exllama_model(model_path, exllama_config)
+        model.load_timings = timer.get_timings()
         return model, tokenizer
     elif xft_config:
-        model, tokenizer = load_xft_model(model_path, xft_config)
+        with timer.phase("load_model"):
+            model, tokenizer = load_xft_model(model_path, xft_config)
+        model.load_timings = timer.get_timings()
         return model, tokenizer
     kwargs["revision"] = revision
 
@@ -364,7 +382,13 @@ def load_model(
             raise e
 
     # Load model
-    model, tokenizer = adapter.load_model(model_path, kwargs)
+    if mmap_weights or weight_store_dir:
+        # Set the weights on the final device right away.
+        load_context = mmap_from_pretrained(device, weight_store_dir, timer)
+    else:
+        load_context = contextlib.nullcontext()
+    with load_context, timer.phase("load_model"):
+        model, tokenizer = adapter.load_model(model_path, kwargs)
 
     if (
         device == "cpu"
@@ -378,11 +402,13 @@ def load_model(
         "xpu",
         "npu",
     ):
-        model.to(device)
+        with timer.phase("to_device"):
+            model.to(device)
 
     if device == "xpu":
         model = torch.xpu.optimize(model, dtype=kwargs["torch_dtype"], inplace=True)
 
+    model.load_timings = timer.get_timings()
     if debug:
         print(model)
 
@@ -521,6 +547,17 @@ def add_model_args(parser):
     parser.add_argument(
         "--load-8bit", action="store_true", help="Use 8-bit quantization"
     )
+    parser.add_argument(
+        "--mmap-weights",
+        action="store_true",
+        help="Memory-map the safetensors shards and set the weights lazily instead of loading them with from_pretrained",
+    )
+    parser.add_argument(
+        "--weight-store-dir",
+        type=str,
+        default=None,
+        help="A folder (e.g. in /dev/shm) where the converted weights are stored once and memory-mapped by every worker process on the host. Implies --mmap-weights",
+    )
     parser.add_argument(
         "--cpu-offloading",
         action="store_true",
@@ -7,6 +7,8 @@ import re
 import torch
 from transformers.generation.logits_process import LogitsProcessor
 
+from fastchat.utils import IncrementalDetokenizer
+
 
 class InvalidScoreLogitsProcessor(LogitsProcessor):
     def __call__(
@@ -103,15 +105,20 @@ def generate_stream_chatglm(
         gen_kwargs["temperature"] = temperature
 
     total_len = 0
+    output_start = 0 if echo else input_echo_len
+    detokenizer = IncrementalDetokenizer(
+        tokenizer,
+        skip_special_tokens=False,
+        spaces_between_special_tokens=True,
+        clean_up_tokenization_spaces=None,
+    )
     for total_ids in model.stream_generate(**inputs, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
-        if echo:
-            output_ids = total_ids
-        else:
-            output_ids = total_ids[input_echo_len:]
-        response = tokenizer.decode(output_ids)
-        response = process_response(response)
+        # Only decode the tokens generated since the last step.
+        total_len = total_ids.shape[1]
+        detokenizer.add_tokens(
+            total_ids[0, output_start + len(detokenizer.token_ids) :].tolist()
+        )
+        response = process_response(detokenizer.text)
 
         yield {
             "text": response,
@@ -123,6 +130,9 @@ def generate_stream_chatglm(
             "finish_reason": None,
         }
 
+    detokenizer.add_tokens([], flush=True)
+    response = process_response(detokenizer.text)
+
     # TODO: ChatGLM stop when it reach max length
     # Only last stream result contains finish_reason, we set finish_reason as stop
     ret = {
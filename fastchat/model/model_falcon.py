@@ -1,12 +1,11 @@
 import gc
 from threading import Thread
-from typing import Iterable
 
 import torch
 import transformers
 from transformers import TextIteratorStreamer, GenerationConfig
 
-from fastchat.utils import is_partial_stop
+from fastchat.utils import StopStringMatcher
 
 
 @torch.inference_mode()
@@ -20,7 +19,6 @@ def generate_stream_falcon(
     judge_sent_end=False,
 ):
     prompt = params["prompt"]
-    len_prompt = len(prompt)
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
     top_p = float(params.get("top_p", 1.0))
@@ -70,36 +68,19 @@ def generate_stream_falcon(
         output = prompt
     else:
         output = ""
+    stop_matcher = StopStringMatcher(stop_str, len(output))
+    stopped = False
 
     for i, new_text in enumerate(streamer):
+        if stopped:
+            # Drain the streamer until the generation thread finishes.
+            continue
         output += new_text
+        pos, partially_stopped = stop_matcher.find(output)
+        if pos != -1:
+            output = output[:pos]
+            stopped = True
         if i % stream_interval == 0:
-            if echo:
-                rfind_start = len_prompt
-            else:
-                rfind_start = 0
-
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
-
             # prevent yielding partial stop sequence
             if not partially_stopped:
                 yield {
@@ -1,19 +1,27 @@
 import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import os
 import threading
 import time
 from typing import List
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 import requests
 
 from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
 from fastchat.conversation import Conversation
-from fastchat.utils import pretty_print_semaphore, build_logger
+from fastchat.utils import (
+    build_logger,
+    encode_embedding_buffer,
+    pretty_print_semaphore,
+)
 
 
 worker = None
 logger = None
+executor = None
 
 app = FastAPI()
 
@@ -24,6 +32,145 @@ def heart_beat_worker(obj):
         obj.send_heart_beat()
 
 
+class InferenceExecutor:
+    """Run the blocking calls of the model workers off the event loop.
+
+    Model calls (generation and embeddings) are queued to a single inference
+    thread, so they run one at a time in their order of arrival and never
+    compete for the GPU. Tokenization and token counting run on a separate pool
+    of CPU threads, so they only wait for the current step of a model call, which
+    holds the tokenizer (see `BaseModelWorker.tokenizer_lock`). The event loop
+    only awaits the results and stays free to answer heart beats and status
+    requests under load.
+    """
+
+    def __init__(self, num_cpu_threads: int = 4):
+        self.inference_pool = ThreadPoolExecutor(1, thread_name_prefix="inference")
+        self.cpu_pool = ThreadPoolExecutor(num_cpu_threads, thread_name_prefix="cpu")
+        # Threads that wait for another thread of the worker, e.g. a batching engine
+        self.wait_pool = ThreadPoolExecutor(thread_name_prefix="wait")
+
+    def get_pool(self, on_inference_thread: bool):
+        return self.inference_pool if on_inference_thread else self.wait_pool
+
+    async def run(self, fn, *args, on_inference_thread: bool = True):
+        """Run a model call.
+
+        Calls that only wait for another thread of the worker can pass
+        `on_inference_thread=False` to not hold the inference thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_pool(on_inference_thread), fn, *args)
+
+    async def run_cpu(self, fn, *args):
+        """Run a CPU-bound call such as tokenization."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_pool, fn, *args)
+
+    async def iterate(self, generator, on_inference_thread: bool = True):
+        """Iterate a blocking generator, running each step like `run` does."""
+        pool = self.get_pool(on_inference_thread)
+        end = object()
+        step = None
+        try:
+            while True:
+                step = pool.submit(next, generator, end)
+                output = await asyncio.wrap_future(step)
+                if output is end:
+                    break
+                yield output
+        finally:
+            # The generator may still be running a step if the client went away.
+            # Close it once that step is done, without waiting.
+            def close(_=None):
+                pool.submit(generator.close)
+
+            if step is None:
+                close()
+            else:
+                step.add_done_callback(close)
+
+
+class EmbeddingBatcher:
+    """Coalesce concurrent embedding requests into one model call.
+
+    Requests that arrive while a batch is running, or within `max_wait` seconds
+    of the first one, are passed together to `worker.get_embeddings_batch` on the
+    inference thread, up to `max_batch_size` inputs. Each caller gets back the
+    result for its own inputs.
+    """
+
+    def __init__(self, worker, max_wait: float = 0.0, max_batch_size: int = 256):
+        self.worker = worker
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.pending = collections.deque()  # (params, future)
+        self.task = None
+
+    async def submit(self, params):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((params, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return await future
+
+    def next_batch(self):
+        batch = [self.pending.popleft()]
+        num_inputs = len(batch[0][0]["input"])
+        while self.pending:
+            num_new_inputs = len(self.pending[0][0]["input"])
+            if num_inputs + num_new_inputs > self.max_batch_size:
+                break
+            batch.append(self.pending.popleft())
+            num_inputs += num_new_inputs
+        # Skip the requests whose client has gone away.
+        return [(params, future) for params, future in batch if not future.done()]
+
+    async def run(self):
+        while self.pending:
+            if self.max_wait > 0:
+                await asyncio.sleep(self.max_wait)
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                results = await self.worker.executor.run(
+                    self.worker.get_embeddings_batch, [params for params, _ in batch]
+                )
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+def iterate_with_lock(generator, lock):
+    """Run each step of a blocking generator while holding `lock`."""
+    end = object()
+    try:
+        while True:
+            with lock:
+                output = next(generator, end)
+            if output is end:
+                break
+            yield output
+    finally:
+        with lock:
+            generator.close()
+
+
+def get_inference_executor() -> InferenceExecutor:
+    """Return the inference executor shared by all workers of the process."""
+    global executor
+    if executor is None:
+        executor = InferenceExecutor(min(4, os.cpu_count() or 1))
+    return executor
+
+
 class BaseModelWorker:
     def __init__(
         self,
@@ -49,9 +196,21 @@ class BaseModelWorker:
         self.conv.sep_style = int(self.conv.sep_style)
         self.multimodal = multimodal
         self.tokenizer = None
+        # Held by the calls of the tokenizer that may run concurrently, i.e. on
+        # the inference thread, the CPU pool or a batching engine. A fast
+        # tokenizer raises "Already borrowed" when a thread changes its
+        # truncation or padding while another thread uses it.
+        self.tokenizer_lock = threading.Lock()
         self.context_len = None
         self.call_ct = 0
         self.semaphore = None
+        # Moving average of the decoding speed of a request, reported to the controller
+        self.tokens_per_second = 0.0
+        self.executor = get_inference_executor()
+        # Whether generation requests are batched by a scheduler thread of the
+        # worker, so that they only wait for it and do not hold the inference thread.
+        self.batches_generation = False
+        self.embedding_batcher = EmbeddingBatcher(self)
 
         self.heart_beat_thread = None
 
@@ -116,6 +275,7 @@ class BaseModelWorker:
                     json={
                         "worker_name": self.worker_addr,
                         "queue_length": self.get_queue_length(),
+                        "worker_status": self.get_status(),
                     },
                     timeout=5,
                 )
@@ -143,20 +303,36 @@ class BaseModelWorker:
             return self.limit_worker_concurrency - sempahore_value + waiter_count
 
     def get_status(self):
-        return {
+        status = {
             "model_names": self.model_names,
             "speed": 1,
             "queue_length": self.get_queue_length(),
         }
+        if self.tokens_per_second > 0:
+            status["tokens_per_second"] = self.tokens_per_second
+        return status
+
+    def update_tokens_per_second(self, num_tokens: int, elapsed: float):
+        """Record the decoding speed of a finished request."""
+        if num_tokens <= 0 or elapsed <= 0:
+            return
+        tokens_per_second = num_tokens / elapsed
+        if self.tokens_per_second == 0:
+            self.tokens_per_second = tokens_per_second
+        else:
+            self.tokens_per_second = (
+                0.9 * self.tokens_per_second + 0.1 * tokens_per_second
+            )
 
     def count_token(self, params):
         prompt = params["prompt"]
 
-        try:
-            input_ids = self.tokenizer(prompt).input_ids
-            input_echo_len = len(input_ids)
-        except TypeError:
-            input_echo_len = self.tokenizer.num_tokens(prompt)
+        with self.tokenizer_lock:
+            try:
+                input_ids = self.tokenizer(prompt).input_ids
+                input_echo_len = len(input_ids)
+            except TypeError:
+                input_echo_len = self.tokenizer.num_tokens(prompt)
 
         ret = {
             "count": input_echo_len,
@@ -167,6 +343,13 @@ class BaseModelWorker:
     def get_conv_template(self):
         return {"conv": self.conv}
 
+    def get_model_info(self, params):
+        """Combine `/model_details`, `/worker_get_conv_template` and `/count_token`."""
+        ret = {"context_length": self.context_len, "conv": self.conv}
+        if params.get("prompt") is not None:
+            ret["count"] = self.count_token(params)["count"]
+        return ret
+
     def generate_stream_gate(self, params):
         raise NotImplementedError
 
@@ -176,6 +359,10 @@ class BaseModelWorker:
     def get_embeddings(self, params):
         raise NotImplementedError
 
+    def get_embeddings_batch(self, params_list):
+        """Compute the embeddings of several requests, one result per request."""
+        return [self.get_embeddings(params) for params in params_list]
+
 
 def release_worker_semaphore():
     worker.semaphore.release()
@@ -193,11 +380,34 @@ def create_background_tasks():
     return background_tasks
 
 
+def generate_stream_in_executor(worker, params):
+    """Stream the chunks of `generate_stream_gate` without blocking the event loop."""
+    return worker.executor.iterate(
+        worker.generate_stream_gate(params),
+        on_inference_thread=not worker.batches_generation,
+    )
+
+
+def create_embedding_response(params, embedding):
+    """Return the embeddings as one binary buffer if the caller asked for it."""
+    if params.get("encoding_format") == "binary":
+        return Response(
+            encode_embedding_buffer(embedding), media_type="application/octet-stream"
+        )
+    return JSONResponse(content=embedding)
+
+
+async def generate_in_executor(worker, params):
+    return await worker.executor.run(
+        worker.generate_gate, params, on_inference_thread=not worker.batches_generation
+    )
+
+
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    generator = worker.generate_stream_gate(params)
+    generator = generate_stream_in_executor(worker, params)
     background_tasks = create_background_tasks()
     return StreamingResponse(generator, background=background_tasks)
 
@@ -206,8 +416,10 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    output = await asyncio.to_thread(worker.generate_gate, params)
-    release_worker_semaphore()
+    try:
+        output = await generate_in_executor(worker, params)
+    finally:
+        release_worker_semaphore()
     return JSONResponse(output)
 
 
@@ -215,9 +427,11 @@ async def api_generate(request: Request):
 async def api_get_embeddings(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    embedding = worker.get_embeddings(params)
-    release_worker_semaphore()
-    return JSONResponse(content=embedding)
+    try:
+        embedding = await worker.embedding_batcher.submit(params)
+    finally:
+        release_worker_semaphore()
+    return create_embedding_response(params, embedding)
 
 
 @app.post("/worker_get_status")
@@ -228,7 +442,7 @@ async def api_get_status(request: Request):
 @app.post("/count_token")
 async def api_count_token(request: Request):
     params = await request.json()
-    return worker.count_token(params)
+    return await worker.executor.run_cpu(worker.count_token, params)
 
 
 @app.post("/worker_get_conv_template")
@@ -239,3 +453,9 @@ async def api_get_conv(request: Request):
 @app.post("/model_details")
 async def api_model_details(request: Request):
     return {"context_length": worker.context_len}
+
+
+@app.post("/worker_get_model_info")
+async def api_get_model_info(request: Request):
+    params = await request.json()
+    return await worker.executor.run_cpu(worker.get_model_info, params)
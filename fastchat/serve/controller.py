@@ -5,18 +5,16 @@ It sends worker addresses to clients.
 import argparse
 import asyncio
 import dataclasses
-from enum import Enum, auto
 import json
 import logging
 import os
 import time
-from typing import List, Union
+from typing import List, Optional, Union
 import threading
 
+import aiohttp
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
-import numpy as np
-import requests
 import uvicorn
 
 from fastchat.constants import (
@@ -25,24 +23,16 @@ from fastchat.constants import (
     ErrorCode,
     SERVER_ERROR_MSG,
 )
+from fastchat.serve.dispatch import DispatchMethod, dispatch_worker
 from fastchat.utils import build_logger
 
 
 logger = build_logger("controller", "controller.log")
 
-
-class DispatchMethod(Enum):
-    LOTTERY = auto()
-    SHORTEST_QUEUE = auto()
-
-    @classmethod
-    def from_str(cls, name):
-        if name == "lottery":
-            return cls.LOTTERY
-        elif name == "shortest_queue":
-            return cls.SHORTEST_QUEUE
-        else:
-            raise ValueError(f"Invalid dispatch method")
+status_timeout = aiohttp.ClientTimeout(total=5)
+stream_timeout = aiohttp.ClientTimeout(
+    total=None, sock_connect=WORKER_API_TIMEOUT, sock_read=WORKER_API_TIMEOUT
+)
 
 
 @dataclasses.dataclass
@@ -53,6 +43,17 @@ class WorkerInfo:
     check_heart_beat: bool
     last_heart_beat: str
     multimodal: bool
+    in_flight: int = 0
+    tokens_per_second: float = 0.0
+    kv_cache_occupancy: float = 0.0
+
+    def update_load(self, worker_status: dict):
+        """Update the load metrics from the status reported by the worker."""
+        self.queue_length = worker_status["queue_length"]
+        self.in_flight = worker_status["queue_length"]
+        self.tokens_per_second = worker_status.get("tokens_per_second", 0.0)
+        if "kv_cache" in worker_status:
+            self.kv_cache_occupancy = worker_status["kv_cache"]["occupancy"]
 
 
 def heart_beat_controller(controller):
@@ -66,13 +67,25 @@ class Controller:
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
+        self.session: Optional[aiohttp.ClientSession] = None
 
         self.heart_beat_thread = threading.Thread(
             target=heart_beat_controller, args=(self,)
         )
         self.heart_beat_thread.start()
 
-    def register_worker(
+    def get_session(self) -> aiohttp.ClientSession:
+        """Get the HTTP session shared by all requests to workers.
+
+        It keeps the connections to each worker alive, so relaying a stream or
+        polling a status does not pay for a new TCP handshake.
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def register_worker(
         self,
         worker_name: str,
         check_heart_beat: bool,
@@ -85,7 +98,7 @@ class Controller:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
@@ -97,33 +110,39 @@ class Controller:
             time.time(),
             multimodal,
         )
+        self.worker_info[worker_name].update_load(worker_status)
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            async with self.get_session().post(
+                worker_name + "/worker_get_status", timeout=status_timeout
+            ) as r:
+                if r.status != 200:
+                    logger.error(f"Get status fails: {worker_name}, {r.status}")
+                    return None
+                return await r.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
-        if r.status_code != 200:
-            logger.error(f"Get status fails: {worker_name}, {r}")
-            return None
-
-        return r.json()
+    async def get_all_worker_status(self, worker_names: List[str]):
+        """Poll the status of all workers concurrently."""
+        return await asyncio.gather(*[self.get_worker_status(w) for w in worker_names])
 
     def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
 
-    def refresh_all_workers(self):
+    async def refresh_all_workers(self):
         old_info = dict(self.worker_info)
+        all_status = await self.get_all_worker_status(list(old_info))
         self.worker_info = {}
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(
-                w_name, w_info.check_heart_beat, None, w_info.multimodal
+        for (w_name, w_info), worker_status in zip(old_info.items(), all_status):
+            if not worker_status or not await self.register_worker(
+                w_name, w_info.check_heart_beat, worker_status, w_info.multimodal
             ):
                 logger.info(f"Remove stale worker: {w_name}")
 
@@ -153,65 +172,56 @@ class Controller:
 
         return list(model_names)
 
+    def list_workers(self):
+        """Return the worker table, so that clients can dispatch requests locally."""
+        workers = {}
+        for w_name, w_info in self.worker_info.items():
+            workers[w_name] = {
+                "model_names": w_info.model_names,
+                "speed": w_info.speed,
+                "queue_length": w_info.queue_length,
+                "multimodal": w_info.multimodal,
+                "in_flight": w_info.in_flight,
+                "tokens_per_second": w_info.tokens_per_second,
+                "kv_cache_occupancy": w_info.kv_cache_occupancy,
+            }
+        return {
+            "dispatch_method": self.dispatch_method.to_str(),
+            "workers": workers,
+        }
+
     def get_worker_address(self, model_name: str):
-        if self.dispatch_method == DispatchMethod.LOTTERY:
-            worker_names = []
-            worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
-            worker_speeds = np.array(worker_speeds, dtype=np.float32)
-            norm = np.sum(worker_speeds)
-            if norm < 1e-4:
-                return ""
-            worker_speeds = worker_speeds / norm
-            if True:  # Directly return address
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-                return worker_name
-
-            # Check status before returning
-            while True:
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-
-                if self.get_worker_status(worker_name):
-                    break
-                else:
-                    self.remove_worker(worker_name)
-                    worker_speeds[pt] = 0
-                    norm = np.sum(worker_speeds)
-                    if norm < 1e-4:
-                        return ""
-                    worker_speeds = worker_speeds / norm
-                    continue
-            return worker_name
-        elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
-            if len(worker_names) == 0:
-                return ""
-            min_index = np.argmin(worker_qlen)
-            w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
+        w_name = dispatch_worker(self.worker_info, model_name, self.dispatch_method)
+        if self.dispatch_method == DispatchMethod.SHORTEST_QUEUE and w_name:
             logger.info(
-                f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
+                f"model: {model_name}, ret: {w_name}, "
+                f"queue_length: {self.worker_info[w_name].queue_length}"
             )
-            return w_name
-        else:
-            raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
+        elif self.dispatch_method.tracks_in_flight and w_name:
+            logger.info(
+                f"model: {model_name}, ret: {w_name}, "
+                f"in_flight: {self.worker_info[w_name].in_flight}"
+            )
+        return w_name
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def release_worker_address(self, worker_name: str):
+        """Receive the notification that a request dispatched to a worker completed."""
+        if worker_name in self.worker_info:
+            w_info = self.worker_info[worker_name]
+            w_info.in_flight = max(w_info.in_flight - 1, 0)
+
+    def receive_heart_beat(
+        self, worker_name: str, queue_length: int, worker_status: dict = None
+    ):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
-        self.worker_info[worker_name].queue_length = queue_length
+        if worker_status:
+            self.worker_info[worker_name].update_load(worker_status)
+        else:
+            self.worker_info[worker_name].queue_length = queue_length
+            self.worker_info[worker_name].in_flight = queue_length
         self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
@@ -244,13 +254,13 @@ class Controller:
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        all_status = await self.get_all_worker_status(list(self.worker_info))
+        for worker_status in all_status:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
@@ -263,32 +273,42 @@ class Controller:
             "queue_length": queue_length,
         }
 
-    def worker_api_generate_stream(self, params):
+    async def worker_api_generate_stream(self, params):
         worker_addr = self.get_worker_address(params["model"])
         if not worker_addr:
             yield self.handle_no_worker(params)
+            return
 
+        # The chunks are passed through as is, so "stream_delta" requests
+        # get the delta chunks of the worker.
         try:
-            response = requests.post(
+            async with self.get_session().post(
                 worker_addr + "/worker_generate_stream",
                 json=params,
-                stream=True,
-                timeout=WORKER_API_TIMEOUT,
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+                timeout=stream_timeout,
+            ) as response:
+                async for chunk in response.content.iter_any():
+                    yield chunk
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             yield self.handle_worker_timeout(worker_addr)
+        finally:
+            if self.dispatch_method.tracks_in_flight:
+                self.release_worker_address(worker_addr)
 
 
 app = FastAPI()
 
 
+@app.on_event("shutdown")
+async def close_session():
+    if controller.session is not None:
+        await controller.session.close()
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"],
         data["check_heart_beat"],
         data.get("worker_status", None),
@@ -298,7 +318,7 @@ async def register_worker(request: Request):
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -319,17 +339,33 @@ async def list_language_models():
     return {"models": models}
 
 
+@app.post("/list_workers")
+async def list_workers():
+    return controller.list_workers()
+
+
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
     addr = controller.get_worker_address(data["model"])
-    return {"address": addr}
+    return {
+        "address": addr,
+        "track_in_flight": controller.dispatch_method.tracks_in_flight,
+    }
+
+
+@app.post("/release_worker_address")
+async def release_worker_address(request: Request):
+    data = await request.json()
+    controller.release_worker_address(data["address"])
 
 
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
-    exist = controller.receive_heart_beat(data["worker_name"], data["queue_length"])
+    exist = controller.receive_heart_beat(
+        data["worker_name"], data["queue_length"], data.get("worker_status", None)
+    )
     return {"exist": exist}
 
 
@@ -342,7 +378,7 @@ async def worker_api_generate_stream(request: Request):
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 @app.get("/test_connection")
@@ -357,7 +393,7 @@ def create_controller():
     parser.add_argument(
         "--dispatch-method",
         type=str,
-        choices=["lottery", "shortest_queue"],
+        choices=["lottery", "shortest_queue", "least_loaded", "power_of_two"],
         default="shortest_queue",
     )
     parser.add_argument(
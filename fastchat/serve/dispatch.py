@@ -0,0 +1,129 @@
+"""
+Dispatch methods that pick a worker for a request.
+They are shared by the controller and the routing table of the OpenAI API server.
+
+LOTTERY samples a worker in proportion to its speed and SHORTEST_QUEUE picks the
+worker with the shortest queue reported by its last heart beat.
+LEAST_LOADED and POWER_OF_TWO track the requests in flight on each worker:
+dispatching a request adds one, a completion notification removes one, and a
+heart beat resets the count to the queue length reported by the worker. The
+load of a worker is its requests in flight over its measured tokens per second,
+scaled up as its KV cache fills. Workers that have not measured their tokens per
+second are assumed to be as fast as the measured workers of the model on average. LEAST_LOADED picks the least loaded worker and
+POWER_OF_TWO the less loaded of two workers sampled at random, which avoids
+sending a burst of requests to the same worker between load updates.
+"""
+from enum import Enum, auto
+from typing import Dict
+
+import numpy as np
+
+
+class DispatchMethod(Enum):
+    LOTTERY = auto()
+    SHORTEST_QUEUE = auto()
+    LEAST_LOADED = auto()
+    POWER_OF_TWO = auto()
+
+    @classmethod
+    def from_str(cls, name):
+        if name == "lottery":
+            return cls.LOTTERY
+        elif name == "shortest_queue":
+            return cls.SHORTEST_QUEUE
+        elif name == "least_loaded":
+            return cls.LEAST_LOADED
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
+        else:
+            raise ValueError(f"Invalid dispatch method")
+
+    def to_str(self):
+        return self.name.lower()
+
+    @property
+    def tracks_in_flight(self):
+        """Whether the method needs to be notified when a request completes."""
+        return self in (DispatchMethod.LEAST_LOADED, DispatchMethod.POWER_OF_TWO)
+
+
+def get_worker_load(w_info, default_speed: float) -> float:
+    """Estimate how long one more request would take on a worker.
+
+    `default_speed` is used for a worker without a measured tokens per second.
+    """
+    speed = w_info.tokens_per_second or default_speed
+    load = (w_info.in_flight + 1) / speed
+    # A worker with a nearly full KV cache has to queue or preempt requests.
+    return load / max(1.0 - w_info.kv_cache_occupancy, 0.05)
+
+
+def dispatch_worker(
+    worker_info: Dict, model_name: str, dispatch_method: DispatchMethod
+) -> str:
+    """
+    Pick a worker that serves `model_name`. Return "" if there is none.
+
+    `worker_info` maps worker names to objects with `model_names`, `speed`,
+    `queue_length`, `in_flight`, `tokens_per_second` and `kv_cache_occupancy`
+    attributes. SHORTEST_QUEUE increments the queue length of the picked worker
+    until the next report of the worker overwrites it. LEAST_LOADED and
+    POWER_OF_TWO increment its requests in flight.
+    """
+    if dispatch_method == DispatchMethod.LOTTERY:
+        worker_names = []
+        worker_speeds = []
+        for w_name, w_info in worker_info.items():
+            if model_name in w_info.model_names:
+                worker_names.append(w_name)
+                worker_speeds.append(w_info.speed)
+        worker_speeds = np.array(worker_speeds, dtype=np.float32)
+        norm = np.sum(worker_speeds)
+        if norm < 1e-4:
+            return ""
+        worker_speeds = worker_speeds / norm
+        pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
+        return worker_names[pt]
+    elif dispatch_method == DispatchMethod.SHORTEST_QUEUE:
+        worker_names = []
+        worker_qlen = []
+        for w_name, w_info in worker_info.items():
+            if model_name in w_info.model_names:
+                worker_names.append(w_name)
+                worker_qlen.append(w_info.queue_length / w_info.speed)
+        if len(worker_names) == 0:
+            return ""
+        min_index = np.argmin(worker_qlen)
+        w_name = worker_names[min_index]
+        worker_info[w_name].queue_length += 1
+        return w_name
+    elif dispatch_method in (DispatchMethod.LEAST_LOADED, DispatchMethod.POWER_OF_TWO):
+        worker_names = [
+            w_name
+            for w_name, w_info in worker_info.items()
+            if model_name in w_info.model_names
+        ]
+        if len(worker_names) == 0:
+            return ""
+        measured = [
+            worker_info[w].tokens_per_second
+            for w in worker_names
+            if worker_info[w].tokens_per_second
+        ]
+        # When no worker is measured, the configured speeds are compared.
+        default_speed = float(np.mean(measured)) if measured else None
+        if dispatch_method == DispatchMethod.POWER_OF_TWO and len(worker_names) > 2:
+            worker_names = [
+                worker_names[i]
+                for i in np.random.choice(len(worker_names), 2, replace=False)
+            ]
+        w_name = min(
+            worker_names,
+            key=lambda w: get_worker_load(
+                worker_info[w], default_speed or worker_info[w].speed
+            ),
+        )
+        worker_info[w_name].in_flight += 1
+        return w_name
+    else:
+        raise ValueError(f"Invalid dispatch method: {dispatch_method}")
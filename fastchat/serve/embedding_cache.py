@@ -0,0 +1,198 @@
+"""
+A content-addressed embedding cache for the OpenAI-compatible API server.
+
+An embedding is keyed by the model name, the truncation mode of the worker that
+computed it and the hash of the input text, so only the inputs that miss the
+cache are sent to a worker. Recently used embeddings stay in an in-memory LRU
+tier bounded in bytes. With a cache directory, embeddings are also appended to
+an on-disk tier that survives restarts: one file per dimension and dtype holding
+fixed-size binary records of (key, token count, vector), memory-mapped for reads.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import re
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+KEY_SIZE = 16
+
+
+def get_embedding_cache_key(model_name: str, truncation: bool, text: str) -> bytes:
+    h = hashlib.sha256()
+    h.update(f"{model_name}\0{int(bool(truncation))}\0".encode())
+    h.update(text.encode("utf-8"))
+    return h.digest()[:KEY_SIZE]
+
+
+class DiskEmbeddingStore:
+    """An append-only file of embeddings of one dimension, memory-mapped for reads."""
+
+    def __init__(self, path: str, dim: int, dtype: str, max_bytes: Optional[int]):
+        self.path = path
+        self.record_dtype = np.dtype(
+            [
+                ("key", f"V{KEY_SIZE}"),
+                ("token_num", "<i4"),
+                ("vector", np.dtype(dtype).newbyteorder("<"), (dim,)),
+            ]
+        )
+        self.max_bytes = max_bytes
+        self.index = {}  # key -> record number
+
+        num_records = 0
+        if os.path.exists(path):
+            num_records = os.path.getsize(path) // self.record_dtype.itemsize
+            # Drop a partial record left by an interrupted write.
+            os.truncate(path, num_records * self.record_dtype.itemsize)
+        self.num_records = num_records
+        self.records = None
+        if num_records > 0:
+            self.remap()
+            for i, key in enumerate(self.records["key"].tolist()):
+                self.index[key] = i
+        self.file = open(path, "ab")
+
+    def remap(self):
+        self.records = np.memmap(
+            self.path, dtype=self.record_dtype, mode="r", shape=(self.num_records,)
+        )
+
+    @property
+    def num_bytes(self):
+        return self.num_records * self.record_dtype.itemsize
+
+    def get(self, key: bytes) -> Optional[Tuple[np.ndarray, int]]:
+        i = self.index.get(key)
+        if i is None:
+            return None
+        if self.records is None or i >= len(self.records):
+            self.remap()
+        record = self.records[i]
+        return np.array(record["vector"], dtype=np.float32), int(record["token_num"])
+
+    def put(self, key: bytes, vector: np.ndarray, token_num: int):
+        if key in self.index:
+            return
+        if self.max_bytes is not None and self.num_bytes >= self.max_bytes:
+            return
+        record = np.zeros(1, dtype=self.record_dtype)
+        record["key"] = np.void(key)
+        record["token_num"] = token_num
+        record["vector"] = vector
+        self.file.write(record.tobytes())
+        self.file.flush()
+        self.index[key] = self.num_records
+        self.num_records += 1
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        max_memory_bytes: int,
+        cache_dir: Optional[str] = None,
+        dtype: str = "float32",
+        max_disk_bytes: Optional[int] = None,
+    ):
+        self.max_memory_bytes = max_memory_bytes
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.max_disk_bytes = max_disk_bytes
+
+        self.memory = OrderedDict()  # key -> (vector, token_num), LRU first
+        self.memory_bytes = 0
+        self.stores = {}  # dim -> DiskEmbeddingStore
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            for name in sorted(os.listdir(cache_dir)):
+                m = re.fullmatch(r"embeddings-(\d+)-(\w+)\.bin", name)
+                if m and m.group(2) == self.dtype.name:
+                    self.get_store(int(m.group(1)))
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.bytes_saved = 0
+
+    def get_store(self, dim: int) -> DiskEmbeddingStore:
+        if dim not in self.stores:
+            name = f"embeddings-{dim}-{self.dtype.name}.bin"
+            path = os.path.join(self.cache_dir, name)
+            self.stores[dim] = DiskEmbeddingStore(
+                path, dim, self.dtype.name, self.max_disk_bytes
+            )
+        return self.stores[dim]
+
+    def put_memory(self, key: bytes, vector: np.ndarray, token_num: int):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = (vector, token_num)
+        self.memory_bytes += vector.nbytes
+        while self.memory_bytes > self.max_memory_bytes and self.memory:
+            _, (old_vector, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= old_vector.nbytes
+
+    def lookup(self, key: bytes) -> Optional[Tuple[np.ndarray, int]]:
+        result = self.memory.get(key)
+        if result is not None:
+            self.memory.move_to_end(key)
+            return result[0].astype(np.float32), result[1]
+        for store in self.stores.values():
+            result = store.get(key)
+            if result is not None:
+                self.put_memory(key, result[0].astype(self.dtype), result[1])
+                return result
+        return None
+
+    def get(
+        self, model_name: str, truncation: Optional[bool], texts: List[str]
+    ) -> List[Optional[Tuple[np.ndarray, int]]]:
+        """Look up the (float32 vector, token count) of each text, None on a miss.
+
+        If the truncation mode of the model is not known yet (None), an
+        embedding computed in either mode is a hit.
+        """
+        modes = [False, True] if truncation is None else [truncation]
+        results = []
+        for text in texts:
+            for mode in modes:
+                result = self.lookup(get_embedding_cache_key(model_name, mode, text))
+                if result is not None:
+                    break
+            if result is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+                self.bytes_saved += result[0].nbytes
+            results.append(result)
+        return results
+
+    def put(
+        self,
+        model_name: str,
+        truncation: bool,
+        texts: List[str],
+        vectors: np.ndarray,
+        token_nums: List[int],
+    ):
+        vectors = np.asarray(vectors).astype(self.dtype)
+        for text, vector, token_num in zip(texts, vectors, token_nums):
+            key = get_embedding_cache_key(model_name, truncation, text)
+            # Copy the row so the memory tier does not keep the whole batch alive.
+            self.put_memory(key, vector.copy(), token_num)
+            if self.cache_dir is not None:
+                self.get_store(len(vector)).put(key, vector, token_num)
+
+    def get_status(self):
+        num_queries = self.num_hits + self.num_misses
+        return {
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "hit_rate": self.num_hits / max(num_queries, 1),
+            "bytes_saved": self.bytes_saved,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_entries": sum(store.num_records for store in self.stores.values()),
+            "disk_bytes": sum(store.num_bytes for store in self.stores.values()),
+        }
@@ -278,6 +278,13 @@ async def api_model_details(request: Request):
     return {"context_length": worker.context_len}
 
 
+@app.post("/worker_get_model_info")
+async def api_get_model_info(request: Request):
+    params = await request.json()
+    worker = worker_map[params["model"]]
+    return worker.get_model_info(params)
+
+
 def create_huggingface_api_worker():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", type=str, default="localhost")
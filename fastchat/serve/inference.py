@@ -4,9 +4,10 @@ import gc
 import json
 import math
 import os
+import queue
 import sys
 import time
-from typing import Iterable, Optional, Dict
+from typing import Optional, Dict
 import warnings
 
 import psutil
@@ -21,14 +22,6 @@ from transformers import (
     T5Tokenizer,
     AutoConfig,
 )
-from transformers.generation.logits_process import (
-    LogitsProcessorList,
-    RepetitionPenaltyLogitsProcessor,
-    TemperatureLogitsWarper,
-    TopKLogitsWarper,
-    TopPLogitsWarper,
-)
-
 from fastchat.conversation import get_conv_template, SeparatorStyle
 from fastchat.model.model_adapter import (
     load_model,
@@ -39,23 +32,41 @@ from fastchat.modules.awq import AWQConfig
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
-from fastchat.utils import is_partial_stop, is_sentence_complete, get_context_length
+from fastchat.serve.kv_cache import KVCachePool, PagedKVCache
+from fastchat.serve.sampler import BatchSampler, get_prompt_logprobs
+from fastchat.utils import (
+    IncrementalDetokenizer,
+    StopStringMatcher,
+    is_sentence_complete,
+    get_context_length,
+)
+
+
+def past_key_values_to_tuple(past_key_values):
+    """Convert a transformers KV cache into a tuple of (key, value) per layer."""
+    if past_key_values is None or isinstance(past_key_values, (tuple, list)):
+        return past_key_values
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
 
 
-def prepare_logits_processor(
-    temperature: float, repetition_penalty: float, top_p: float, top_k: int
-) -> LogitsProcessorList:
-    processor_list = LogitsProcessorList()
-    # TemperatureLogitsWarper doesn't accept 0.0, 1.0 makes it a no-op so we skip two cases.
-    if temperature >= 1e-5 and temperature != 1.0:
-        processor_list.append(TemperatureLogitsWarper(temperature))
-    if repetition_penalty > 1.0:
-        processor_list.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
-    if 1e-8 <= top_p < 1.0:
-        processor_list.append(TopPLogitsWarper(top_p))
-    if top_k > 0:
-        processor_list.append(TopKLogitsWarper(top_k))
-    return processor_list
+def past_key_values_from_tuple(past_key_values):
+    """Wrap a tuple of (key, value) per layer into the cache class the model expects."""
+    try:
+        from transformers.cache_utils import DynamicCache
+    except ImportError:  # transformers < 4.36 still takes the legacy tuples
+        return past_key_values
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(past_key_values)
+    return DynamicCache(past_key_values)
+
+
+def decode_top_logprobs(tokenizer, top_logprobs: Optional[Dict[int, float]]):
+    """Map the token ids of top logprobs to their text."""
+    if top_logprobs is None:
+        return None
+    return {tokenizer.decode(k): v for k, v in top_logprobs.items()}
 
 
 @torch.inference_mode()
@@ -67,28 +78,25 @@ def generate_stream(
     context_len: int,
     stream_interval: int = 2,
     judge_sent_end: bool = False,
+    kv_cache_pool: Optional[KVCachePool] = None,
 ):
     if hasattr(model, "device"):
         device = model.device
 
     # Read parameters
     prompt = params["prompt"]
-    len_prompt = len(prompt)
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
     top_p = float(params.get("top_p", 1.0))
     top_k = int(params.get("top_k", -1))  # -1 means disable
     max_new_tokens = int(params.get("max_new_tokens", 256))
-    logprobs = params.get("logprobs", None)  # FIXME: Support logprobs>1.
+    logprobs = params.get("logprobs", None)
     echo = bool(params.get("echo", True))
     stop_str = params.get("stop", None)
     stop_token_ids = params.get("stop_token_ids", None) or []
     if tokenizer.eos_token_id not in stop_token_ids:
         stop_token_ids.append(tokenizer.eos_token_id)
 
-    logits_processor = prepare_logits_processor(
-        temperature, repetition_penalty, top_p, top_k
-    )
     input_ids = tokenizer(prompt).input_ids
 
     if model.config.is_encoder_decoder:
@@ -114,8 +122,25 @@ def generate_stream(
     else:
         start_ids = torch.as_tensor([input_ids], device=device)
 
+    if echo:
+        detokenizer = IncrementalDetokenizer(tokenizer, input_ids)
+    else:
+        detokenizer = IncrementalDetokenizer(tokenizer)
+    stop_matcher = StopStringMatcher(stop_str, len(detokenizer.text))
+    logprob_tokens = []
+    logprob_text_offset = []
+    logprob_curr_pos = 0
+
     past_key_values = out = None
+    if kv_cache_pool is not None and not model.config.is_encoder_decoder:
+        past_key_values = PagedKVCache(kv_cache_pool)
+        # Prompt logprobs need the logits of every prompt token.
+        if kv_cache_pool.enable_prefix_caching and logprobs is None:
+            num_cached_tokens = past_key_values.load_prefix(input_ids, device)
+            start_ids = start_ids[:, num_cached_tokens:]
     token_logprobs = [None]  # The first token has no logprobs.
+    top_logprobs = [None]
+    sampler = None
     sent_interrupt = False
     finish_reason = None
     stopped = False
@@ -129,19 +154,35 @@ def generate_stream(
                 )
                 logits = model.lm_head(out[0])
             else:
-                out = model(input_ids=start_ids, use_cache=True)
+                out = model(
+                    input_ids=start_ids,
+                    use_cache=True,
+                    past_key_values=past_key_values,
+                )
                 logits = out.logits
             past_key_values = out.past_key_values
 
             if logprobs is not None:
-                # Prefull logprobs for the prompt.
-                shift_input_ids = start_ids[..., 1:].contiguous()
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_logits = torch.log_softmax(shift_logits, dim=-1).tolist()
-                for label_id, logit in zip(
-                    shift_input_ids[0].tolist(), shift_logits[0]
-                ):
-                    token_logprobs.append(logit[label_id])
+                # Prefill logprobs for the prompt.
+                prompt_logprobs, prompt_top_logprobs = get_prompt_logprobs(
+                    logits[0], start_ids[0], logprobs
+                )
+                token_logprobs.extend(prompt_logprobs)
+                top_logprobs.extend(
+                    decode_top_logprobs(tokenizer, x) for x in prompt_top_logprobs
+                )
+
+            sampler = BatchSampler(
+                [temperature],
+                [repetition_penalty],
+                [top_p],
+                [top_k],
+                [logprobs],
+                [input_ids],
+                logits.shape[-1],
+                # Switch to CPU by avoiding some bugs in mps backend.
+                "cpu" if device == "mps" else logits.device,
+            )
         else:  # decoding
             if model.config.is_encoder_decoder:
                 out = model.decoder(
@@ -169,33 +210,14 @@ def generate_stream(
                 logits = out.logits
             past_key_values = out.past_key_values
 
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
-            else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
-
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
-
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            _, indices = torch.topk(last_token_logits, 2)
-            tokens = [int(index) for index in indices.tolist()]
-        else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            indices = torch.multinomial(probs, num_samples=2)
-            tokens = [int(token) for token in indices.tolist()]
+        # The second token is a fallback for judge_sent_end.
+        sampled = sampler(logits[:, -1, :], num_samples=2 if judge_sent_end else 1)
+        tokens = sampled.tokens[0]
         token = tokens[0]
         output_ids.append(token)
         if logprobs is not None:
-            # Cannot use last_token_logits because logprobs is based on raw logits.
-            token_logprobs.append(
-                torch.log_softmax(logits[0, -1, :], dim=-1)[token].tolist()
-            )
+            token_logprobs.append(sampled.token_logprobs[0])
+            top_logprobs.append(decode_top_logprobs(tokenizer, sampled.top_logprobs[0]))
 
         if token in stop_token_ids:
             stopped = True
@@ -204,40 +226,26 @@ def generate_stream(
 
         # Yield the output tokens
         if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len_prompt
-            else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
-
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=True,
-                spaces_between_special_tokens=False,
-                clean_up_tokenization_spaces=True,
+            # Only decode the tokens generated since the last yield.
+            output_start = 0 if echo else input_echo_len
+            detokenizer.add_tokens(
+                output_ids[output_start + len(detokenizer.token_ids) :],
+                flush=i == max_new_tokens - 1 or stopped,
             )
+            output = detokenizer.text
+
             ret_logprobs = None
             if logprobs is not None:
+                for token_id in output_ids[output_start + len(logprob_tokens) :]:
+                    logprob_tokens.append(tokenizer.decode(token_id))
+                    logprob_text_offset.append(logprob_curr_pos)
+                    logprob_curr_pos += len(logprob_tokens[-1])
                 ret_logprobs = {
-                    "text_offset": [],
-                    "tokens": [
-                        tokenizer.decode(token)
-                        for token in (
-                            output_ids if echo else output_ids[input_echo_len:]
-                        )
-                    ],
-                    "token_logprobs": token_logprobs
-                    if echo
-                    else token_logprobs[input_echo_len:],
-                    "top_logprobs": [{}]
-                    * len(token_logprobs if echo else token_logprobs[input_echo_len:]),
+                    "text_offset": list(logprob_text_offset),
+                    "tokens": list(logprob_tokens),
+                    "token_logprobs": token_logprobs[output_start:],
+                    "top_logprobs": top_logprobs[output_start:],
                 }
-                # Compute text_offset
-                curr_pos = 0
-                for text in ret_logprobs["tokens"]:
-                    ret_logprobs["text_offset"].append(curr_pos)
-                    curr_pos += len(text)
 
             # TODO: For the issue of incomplete sentences interrupting output, apply a patch and others can also modify it to a more elegant way
             if judge_sent_end and stopped and not is_sentence_complete(output):
@@ -246,31 +254,15 @@ def generate_stream(
                     output_ids[-1] = token
                 else:
                     output_ids.pop()
+                detokenizer.reset(output_ids[output_start:])
+                sampler.reset_history(0, output_ids)
                 stopped = False
                 sent_interrupt = True
 
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
+            pos, partially_stopped = stop_matcher.find(output)
+            if pos != -1:
+                output = output[:pos]
+                stopped = True
 
             # Prevent yielding partial stop sequence
             if not partially_stopped:
@@ -307,6 +299,11 @@ def generate_stream(
     }
 
     # Clean
+    if PagedKVCache is not None and isinstance(past_key_values, PagedKVCache):
+        # Return the blocks to the pool, no global GC is needed.
+        past_key_values.release(output_ids)
+        del past_key_values, out
+        return
     del past_key_values, out
     gc.collect()
     torch.cuda.empty_cache()
@@ -316,6 +313,127 @@ def generate_stream(
         torch.npu.empty_cache()
 
 
+class BatchedRequest:
+    """The per-request state of a generation, shared by continuous batching
+    (`ContinuousBatchingEngine` in model_worker.py) and speculative decoding."""
+
+    def __init__(self, params, tokenizer, context_len: int):
+        self.prompt = params["prompt"]
+        self.temperature = float(params.get("temperature", 1.0))
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        self.top_k = int(params.get("top_k", -1))  # -1 means disable
+        self.max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.logprobs = params.get("logprobs", None)
+        self.echo = bool(params.get("echo", True))
+        self.stop_str = params.get("stop", None)
+        self.stop_token_ids = list(params.get("stop_token_ids", None) or [])
+        self.validate()
+        if tokenizer.eos_token_id not in self.stop_token_ids:
+            self.stop_token_ids.append(tokenizer.eos_token_id)
+
+        input_ids = tokenizer(self.prompt).input_ids
+        max_src_len = context_len - self.max_new_tokens - 1
+        self.input_ids = input_ids[-max_src_len:]
+        self.input_echo_len = len(self.input_ids)
+        self.output_ids = list(self.input_ids)
+        self.token_logprobs = [None]  # The first token has no logprobs.
+        self.top_logprobs = [None]
+
+        if self.echo:
+            self.detokenizer = IncrementalDetokenizer(tokenizer, self.input_ids)
+        else:
+            self.detokenizer = IncrementalDetokenizer(tokenizer)
+        self.stop_matcher = StopStringMatcher(self.stop_str, len(self.detokenizer.text))
+        self.logprob_tokens = []
+        self.logprob_text_offset = []
+        self.logprob_curr_pos = 0
+
+        self.outputs = queue.Queue()
+        self.cancelled = False
+        self.finished = False
+        # The LoRA adapter of the request and its slot, see `LoRARegistry`.
+        self.lora_name = None
+        self.lora_slot = 0
+
+    def validate(self):
+        """Reject malformed parameters before the request joins a batch, where
+        an error would fail all the running requests."""
+        stop_str = self.stop_str
+        if isinstance(stop_str, str):
+            stop_str = [stop_str]
+        if stop_str is not None and not (
+            isinstance(stop_str, list) and all(isinstance(x, str) for x in stop_str)
+        ):
+            raise ValueError(f"Invalid stop: {self.stop_str!r}")
+        if not all(
+            isinstance(x, int) and not isinstance(x, bool) for x in self.stop_token_ids
+        ):
+            raise ValueError(f"Invalid stop_token_ids: {self.stop_token_ids!r}")
+        if self.logprobs is not None and (
+            not isinstance(self.logprobs, int)
+            or isinstance(self.logprobs, bool)
+            or self.logprobs < 0
+        ):
+            raise ValueError(f"Invalid logprobs: {self.logprobs!r}")
+        if self.max_new_tokens < 0:
+            raise ValueError(f"Invalid max_new_tokens: {self.max_new_tokens}")
+
+    @property
+    def num_generated(self):
+        return len(self.output_ids) - self.input_echo_len
+
+    def make_output(self, tokenizer, stopped: bool, finish_reason=None):
+        """Decode the new tokens of the output like `generate_stream` does.
+
+        Returns the chunk to stream, or None when the text ends with a partial stop string.
+        """
+        output_start = 0 if self.echo else self.input_echo_len
+        self.detokenizer.add_tokens(
+            self.output_ids[output_start + len(self.detokenizer.token_ids) :],
+            flush=stopped or self.num_generated >= self.max_new_tokens,
+        )
+        output = self.detokenizer.text
+
+        ret_logprobs = None
+        if self.logprobs is not None:
+            for token_id in self.output_ids[output_start + len(self.logprob_tokens) :]:
+                self.logprob_tokens.append(tokenizer.decode(token_id))
+                self.logprob_text_offset.append(self.logprob_curr_pos)
+                self.logprob_curr_pos += len(self.logprob_tokens[-1])
+            ret_logprobs = {
+                "text_offset": list(self.logprob_text_offset),
+                "tokens": list(self.logprob_tokens),
+                "token_logprobs": self.token_logprobs[output_start:],
+                "top_logprobs": self.top_logprobs[output_start:],
+            }
+
+        pos, partially_stopped = self.stop_matcher.find(output)
+        if pos != -1:
+            output = output[:pos]
+            stopped = True
+
+        if stopped:
+            self.finished = True
+            finish_reason = "stop"
+        elif self.num_generated >= self.max_new_tokens:
+            self.finished = True
+            finish_reason = "length"
+        elif partially_stopped:
+            return None
+
+        return {
+            "text": output,
+            "logprobs": ret_logprobs,
+            "usage": {
+                "prompt_tokens": self.input_echo_len,
+                "completion_tokens": self.num_generated,
+                "total_tokens": self.input_echo_len + self.num_generated,
+            },
+            "finish_reason": finish_reason,
+        }
+
+
 class ChatIO(abc.ABC):
     @abc.abstractmethod
     def prompt_for_input(self, role: str) -> str:
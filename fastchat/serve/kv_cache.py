@@ -0,0 +1,274 @@
+"""
+A block-allocated KV cache pool for the huggingface/transformers model worker.
+
+The pool pre-allocates fixed-size blocks of key/value slots for every layer once.
+Each request draws blocks from a free list into its own block table while it
+decodes and returns them when it finishes, so memory is reused across requests
+without calling `gc.collect()` and `torch.cuda.empty_cache()` after each one.
+
+With prefix caching enabled, the full blocks of finished requests stay indexed
+by the token ids they hold, so a later request sharing the same prompt prefix
+(e.g., the system message and earlier turns of a conversation) maps those
+blocks into its block table and only prefills the new suffix.  Unused cached
+blocks are evicted in LRU order when the pool runs out of free blocks.
+"""
+from collections import OrderedDict
+import threading
+from typing import List, Optional
+
+import torch
+
+try:
+    from transformers.cache_utils import DynamicCache
+except ImportError:  # transformers < 4.36
+    DynamicCache = None
+
+
+class KVCachePoolExhausted(RuntimeError):
+    pass
+
+
+class KVCachePool:
+    """A pool of fixed-size KV cache blocks shared by all requests of a worker."""
+
+    def __init__(
+        self, num_blocks: int, block_size: int = 16, enable_prefix_caching=False
+    ):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.enable_prefix_caching = enable_prefix_caching
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.ref_counts = {}
+        self.lock = threading.Lock()
+
+        # Prefix caching: the key of a block is the hash of the key of the
+        # previous block together with the token ids in this block.
+        self.prefix_index = {}  # key -> block id
+        self.block_keys = {}  # block id -> key
+        self.evictable_blocks = OrderedDict()  # Cached blocks not in use, LRU first
+        self.num_queried_tokens = 0
+        self.num_hit_tokens = 0
+
+        # Per layer tensors of shape [num_heads, num_blocks * block_size, head_dim].
+        # They are allocated on the first use of each layer so that every layer
+        # lives on the device of its weights.
+        self.key_slots = {}
+        self.value_slots = {}
+
+    @classmethod
+    def from_model(
+        cls,
+        model,
+        memory_gb: float,
+        block_size: int = 16,
+        enable_prefix_caching: bool = False,
+    ):
+        """Size a pool to hold `memory_gb` GiB of KV cache for `model`."""
+        config = model.config
+        num_layers = config.num_hidden_layers
+        num_heads = config.num_attention_heads
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or num_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // num_heads
+        itemsize = torch.tensor([], dtype=model.dtype).element_size()
+        bytes_per_token = 2 * num_layers * num_kv_heads * head_dim * itemsize
+        num_blocks = int(memory_gb * 2**30) // (bytes_per_token * block_size)
+        if num_blocks <= 0:
+            raise ValueError(f"--kv-cache-gb {memory_gb} is too small for one block.")
+        return cls(num_blocks, block_size, enable_prefix_caching)
+
+    def get_layer_slots(self, layer_idx: int, key_states: torch.Tensor):
+        if layer_idx not in self.key_slots:
+            with self.lock:
+                if layer_idx not in self.key_slots:
+                    shape = (
+                        key_states.shape[1],
+                        self.num_blocks * self.block_size,
+                        key_states.shape[3],
+                    )
+                    kwargs = {"dtype": key_states.dtype, "device": key_states.device}
+                    self.value_slots[layer_idx] = torch.empty(shape, **kwargs)
+                    self.key_slots[layer_idx] = torch.empty(shape, **kwargs)
+        return self.key_slots[layer_idx], self.value_slots[layer_idx]
+
+    def allocate(self, num_blocks: int) -> List[int]:
+        with self.lock:
+            while len(self.free_blocks) < num_blocks and self.evictable_blocks:
+                block_id, _ = self.evictable_blocks.popitem(last=False)
+                del self.prefix_index[self.block_keys.pop(block_id)]
+                self.free_blocks.append(block_id)
+            if num_blocks > len(self.free_blocks):
+                raise KVCachePoolExhausted(
+                    f"KV cache pool is exhausted: {num_blocks} blocks requested, "
+                    f"{len(self.free_blocks)} free."
+                )
+            block_ids = [self.free_blocks.pop() for _ in range(num_blocks)]
+            for block_id in block_ids:
+                self.ref_counts[block_id] = 1
+            return block_ids
+
+    def free(self, block_ids: List[int]):
+        with self.lock:
+            for block_id in reversed(block_ids):
+                self.ref_counts[block_id] -= 1
+                if self.ref_counts[block_id] > 0:
+                    continue
+                del self.ref_counts[block_id]
+                if block_id in self.block_keys:
+                    self.evictable_blocks[block_id] = None
+                else:
+                    self.free_blocks.append(block_id)
+
+    def get_block_keys(self, token_ids: List[int], num_blocks: int):
+        keys = []
+        key = None
+        for i in range(num_blocks):
+            block = token_ids[i * self.block_size : (i + 1) * self.block_size]
+            key = hash((key, tuple(block)))
+            keys.append(key)
+        return keys
+
+    def acquire_prefix(self, token_ids: List[int]) -> List[int]:
+        """Return the cached blocks holding the longest block-aligned prefix of `token_ids`."""
+        keys = self.get_block_keys(token_ids, len(token_ids) // self.block_size)
+        block_ids = []
+        with self.lock:
+            for key in keys:
+                block_id = self.prefix_index.get(key)
+                if block_id is None:
+                    break
+                self.evictable_blocks.pop(block_id, None)
+                self.ref_counts[block_id] = self.ref_counts.get(block_id, 0) + 1
+                block_ids.append(block_id)
+            self.num_queried_tokens += len(token_ids)
+            self.num_hit_tokens += len(block_ids) * self.block_size
+        return block_ids
+
+    def register_prefix(self, token_ids: List[int], block_ids: List[int]):
+        """Index the full blocks holding `token_ids` for reuse by later requests."""
+        keys = self.get_block_keys(token_ids, len(token_ids) // self.block_size)
+        with self.lock:
+            for key, block_id in zip(keys, block_ids):
+                if key not in self.prefix_index and block_id not in self.block_keys:
+                    self.prefix_index[key] = block_id
+                    self.block_keys[block_id] = key
+
+    def get_status(self):
+        num_free_blocks = len(self.free_blocks) + len(self.evictable_blocks)
+        status = {
+            "block_size": self.block_size,
+            "num_blocks": self.num_blocks,
+            "num_free_blocks": num_free_blocks,
+            "occupancy": 1 - num_free_blocks / self.num_blocks,
+        }
+        if self.enable_prefix_caching:
+            status["num_cached_blocks"] = len(self.block_keys)
+            status["prefix_cache_hit_rate"] = self.num_hit_tokens / max(
+                self.num_queried_tokens, 1
+            )
+        return status
+
+
+if DynamicCache is not None:
+
+    class PagedKVCache(DynamicCache):
+        """The KV cache of one request, stored in the blocks of a KVCachePool.
+
+        New key/value states are scattered into the slots of the request's block
+        table and the full states are gathered back for attention, in place of the
+        `torch.cat` that `DynamicCache` runs on every step.
+        Only batch size 1 is supported.
+        """
+
+        def __init__(self, pool: KVCachePool):
+            super().__init__()
+            self.pool = pool
+            self.block_table: List[int] = []
+            self.slot_mapping: Optional[torch.Tensor] = None
+            self.prefix_length = 0
+            self.layer_lengths: List[int] = []
+
+        def load_prefix(self, token_ids: List[int], device) -> int:
+            """Map the cached blocks of the longest known prefix of `token_ids`.
+
+            At least one token is left out so that the caller still gets the
+            logits of the last prompt token. Returns the number of cached tokens.
+            """
+            block_ids = self.pool.acquire_prefix(token_ids[:-1])
+            if block_ids:
+                self.add_blocks(block_ids, device)
+                self.prefix_length = len(block_ids) * self.pool.block_size
+            return self.prefix_length
+
+        def reserve(self, num_tokens: int, device):
+            num_blocks = -(-num_tokens // self.pool.block_size) - len(self.block_table)
+            if num_blocks > 0:
+                self.add_blocks(self.pool.allocate(num_blocks), device)
+
+        def add_blocks(self, new_blocks: List[int], device):
+            self.block_table.extend(new_blocks)
+            new_slots = (
+                torch.as_tensor(new_blocks, device=device).unsqueeze(-1)
+                * self.pool.block_size
+                + torch.arange(self.pool.block_size, device=device)
+            ).flatten()
+            if self.slot_mapping is None:
+                self.slot_mapping = new_slots
+            else:
+                self.slot_mapping = torch.cat([self.slot_mapping, new_slots])
+
+        def update(self, key_states, value_states, layer_idx, *args, **kwargs):
+            if key_states.shape[0] != 1:
+                raise ValueError("PagedKVCache only supports batch size 1.")
+            while len(self.layer_lengths) <= layer_idx:
+                self.layer_lengths.append(self.prefix_length)
+            start = self.layer_lengths[layer_idx]
+            end = start + key_states.shape[-2]
+            self.reserve(end, key_states.device)
+
+            key_slots, value_slots = self.pool.get_layer_slots(layer_idx, key_states)
+            slot_mapping = self.slot_mapping.to(key_slots.device)
+            key_slots.index_copy_(1, slot_mapping[start:end], key_states[0])
+            value_slots.index_copy_(1, slot_mapping[start:end], value_states[0])
+            self.layer_lengths[layer_idx] = end
+
+            keys = key_slots.index_select(1, slot_mapping[:end]).unsqueeze(0)
+            values = value_slots.index_select(1, slot_mapping[:end]).unsqueeze(0)
+            return keys, values
+
+        def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+            if layer_idx is None:
+                layer_idx = 0
+            if layer_idx >= len(self.layer_lengths):
+                return self.prefix_length
+            return self.layer_lengths[layer_idx]
+
+        def get_mask_sizes(self, query_length, layer_idx: int = 0):
+            if isinstance(query_length, torch.Tensor):
+                query_length = query_length.shape[0]
+            return self.get_seq_length(layer_idx) + query_length, 0
+
+        def __len__(self):
+            return len(self.layer_lengths)
+
+        def release(self, token_ids: Optional[List[int]] = None):
+            """Return the blocks to the pool.
+
+            If `token_ids` is given and prefix caching is enabled, the full blocks
+            of the cached tokens are kept for reuse by later requests.
+            """
+            if self.block_table:
+                if token_ids is not None and self.pool.enable_prefix_caching:
+                    num_cached = min(self.layer_lengths or [self.prefix_length])
+                    self.pool.register_prefix(token_ids[:num_cached], self.block_table)
+                self.pool.free(self.block_table)
+            self.block_table = []
+            self.slot_mapping = None
+            self.prefix_length = 0
+            self.layer_lengths = []
+
+        def __del__(self):
+            if hasattr(self, "pool"):
+                self.release()
+
+else:
+    PagedKVCache = None
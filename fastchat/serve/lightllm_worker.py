@@ -257,6 +257,12 @@ async def api_model_details(request: Request):
     return {"context_length": worker.context_len}
 
 
+@app.post("/worker_get_model_info")
+async def api_get_model_info(request: Request):
+    params = await request.json()
+    return worker.get_model_info(params)
+
+
 if __name__ == "__main__":
     torch.multiprocessing.set_start_method("spawn")
     parser = argparse.ArgumentParser()
@@ -0,0 +1,161 @@
+"""
+Lookahead decoding: Jacobi iteration plus an n-gram pool, for any causal LM.
+
+This generalizes the Jacobi decoding of CLLM checkpoints (`model_cllm.py`) to
+models served by `generate_stream`, without a draft model. Every step feeds a
+chain of guessed future tokens to the model in one forward pass, and the
+guesses are verified with the rejection rule of `speculative_decoding.py`, so
+the output follows the same distribution as `generate_stream` (and greedy
+requests give the same text) while a forward can produce several tokens.
+
+The guesses come from two sources:
+- The Jacobi window: the model's predictions at the positions after the
+  accepted tokens, from the previous forward pass, are the guesses for the next
+  one. Repeating this converges to the output like CLLM's Jacobi trajectory.
+- The n-gram pool: n-grams of the prompts and outputs served so far, keyed by
+  their first token. When the pool has an n-gram starting with the last token,
+  it replaces the head of the window. The pool is shared by all the requests
+  of a worker, so repeated text (system prompts, code, templates) is guessed
+  right across requests.
+"""
+from collections import OrderedDict
+import random
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import torch
+
+from fastchat.serve.sampler import BatchSampler
+from fastchat.serve.speculative_decoding import (
+    SpeculativeDecodingMetrics,
+    generate_stream_with_proposer,
+)
+
+
+class NGramPool:
+    """A bounded pool of n-grams keyed by their first token, least recently
+    used first."""
+
+    def __init__(self, ngram_size: int = 4, max_size: int = 100000):
+        self.ngram_size = ngram_size
+        self.max_size = max_size
+        self.ngrams = OrderedDict()  # first token -> OrderedDict of continuations
+        self.size = 0
+        self.lock = threading.Lock()
+        self.num_lookups = 0
+        self.num_hits = 0
+
+    def add(self, token_ids: Sequence[int]):
+        n = self.ngram_size
+        with self.lock:
+            for i in range(len(token_ids) - n + 1):
+                key = token_ids[i]
+                continuation = tuple(token_ids[i + 1 : i + n])
+                continuations = self.ngrams.get(key)
+                if continuations is None:
+                    continuations = self.ngrams[key] = OrderedDict()
+                else:
+                    self.ngrams.move_to_end(key)
+                if continuation in continuations:
+                    continuations.move_to_end(continuation)
+                    continue
+                continuations[continuation] = None
+                self.size += 1
+            while self.size > self.max_size:
+                _, continuations = self.ngrams.popitem(last=False)
+                self.size -= len(continuations)
+
+    def lookup(self, token: int, count: bool = True) -> Optional[tuple]:
+        """The most recent continuation of `token`, if any. Only the lookups
+        with `count` are counted in the hit rate."""
+        with self.lock:
+            if count:
+                self.num_lookups += 1
+            continuations = self.ngrams.get(token)
+            if not continuations:
+                return None
+            if count:
+                self.num_hits += 1
+            return next(reversed(continuations))
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "lookups": self.num_lookups,
+                "hit_rate": self.num_hits / max(self.num_lookups, 1),
+            }
+
+
+class LookaheadProposer:
+    """Propose the Jacobi window of a request, with its head replaced by an
+    n-gram from the pool when there is one."""
+
+    def __init__(self, ngram_pool: NGramPool, window_size: int):
+        self.ngram_pool = ngram_pool
+        self.window_size = window_size
+        self.window: List[int] = []  # The guesses for the next positions
+        self.pool_len = 0  # The number of output tokens added to the pool
+
+    def fill_window(self, output_ids: List[int]):
+        """Extend the window to its size by following the pool, or with random
+        tokens of the output like CLLM's initial trajectory."""
+        while len(self.window) < self.window_size:
+            last = self.window[-1] if self.window else output_ids[-1]
+            continuation = self.ngram_pool.lookup(last, count=False)
+            if continuation:
+                self.window.extend(continuation)
+            else:
+                self.window.append(random.choice(output_ids))
+        del self.window[self.window_size :]
+
+    def propose(self, sampler: BatchSampler, output_ids: List[int], num_tokens: int):
+        n = self.ngram_pool.ngram_size
+        self.ngram_pool.add(output_ids[max(self.pool_len - n + 1, 0) :])
+        self.pool_len = len(output_ids)
+
+        self.fill_window(output_ids)
+        drafts = list(self.window)
+        continuation = self.ngram_pool.lookup(output_ids[-1])
+        if continuation:
+            drafts[: len(continuation)] = continuation
+        return drafts[:num_tokens], None
+
+    def update(
+        self,
+        output_ids: List[int],
+        drafts: List[int],
+        num_accepted: int,
+        processed_logits: torch.Tensor,
+    ):
+        # The predictions after the accepted tokens and the next one.
+        predictions = processed_logits.argmax(dim=-1).tolist()
+        self.window = predictions[num_accepted + 1 :]
+
+
+def generate_stream_lookahead(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int = 2,
+    judge_sent_end: bool = False,
+    ngram_pool: Optional[NGramPool] = None,
+    window_size: int = 6,
+    metrics: Optional[SpeculativeDecodingMetrics] = None,
+):
+    """`generate_stream` for decoder-only models, with lookahead decoding."""
+    if ngram_pool is None:
+        ngram_pool = NGramPool()
+    yield from generate_stream_with_proposer(
+        model,
+        tokenizer,
+        params,
+        device,
+        context_len,
+        stream_interval,
+        LookaheadProposer(ngram_pool, window_size),
+        window_size,
+        metrics,
+    )
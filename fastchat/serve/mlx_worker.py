@@ -233,6 +233,12 @@ async def api_model_details(request: Request):
     return {"context_length": worker.context_len}
 
 
+@app.post("/worker_get_model_info")
+async def api_get_model_info(request: Request):
+    params = await request.json()
+    return worker.get_model_info(params)
+
+
 worker = None
 
 
@@ -3,10 +3,15 @@ A model worker that executes the model.
 """
 import argparse
 import base64
+import contextlib
+import functools
 import gc
 import json
 import os
-from typing import List, Optional
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
 import uuid
 
 import torch
@@ -15,6 +20,7 @@ from transformers import set_seed
 import uvicorn
 
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
+from fastchat.model.lazy_loading import format_load_timings
 from fastchat.model.model_adapter import (
     load_model,
     add_model_args,
@@ -24,8 +30,33 @@ from fastchat.modules.awq import AWQConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
 from fastchat.modules.gptq import GptqConfig
-from fastchat.serve.base_model_worker import BaseModelWorker, app
+from fastchat.serve.base_model_worker import (
+    BaseModelWorker,
+    EmbeddingBatcher,
+    app,
+    iterate_with_lock,
+)
+from fastchat.serve.kv_cache import KVCachePool, PagedKVCache
+from fastchat.serve.lookahead_decoding import NGramPool, generate_stream_lookahead
+from fastchat.serve.multi_lora import (
+    LoRARegistry,
+    LoRASlotsFull,
+    get_lora_target_modules,
+)
+from fastchat.serve.inference import (
+    BatchedRequest,
+    decode_top_logprobs,
+    generate_stream,
+    past_key_values_from_tuple,
+    past_key_values_to_tuple,
+)
+from fastchat.serve.sampler import BatchSampler, get_prompt_logprobs
+from fastchat.serve.speculative_decoding import (
+    SpeculativeDecodingMetrics,
+    generate_stream_speculative,
+)
 from fastchat.utils import (
+    StreamDeltaEncoder,
     build_logger,
     get_context_length,
     str_to_torch_dtype,
@@ -35,6 +66,302 @@ worker_id = str(uuid.uuid4())[:8]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 
 
+class ContinuousBatchingEngine:
+    """An iteration-level scheduler for HuggingFace causal LMs.
+
+    All in-flight requests share one left-padded batch and one KV cache.  Each
+    iteration runs a single batched decode forward for the running requests,
+    retires the finished ones and prefills newly admitted requests, which are
+    then merged into the running batch for the next iteration.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        context_len: int,
+        stream_interval: int = 2,
+        max_batch_size: int = 16,
+        lora_registry: Optional[LoRARegistry] = None,
+        tokenizer_lock: Optional[threading.Lock] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        # Held while the tokenizer is used, see `BaseModelWorker.tokenizer_lock`.
+        self.tokenizer_lock = tokenizer_lock or threading.Lock()
+        self.device = model.device if hasattr(model, "device") else device
+        self.context_len = context_len
+        self.stream_interval = stream_interval
+        self.max_batch_size = max_batch_size
+        self.pad_token_id = tokenizer.pad_token_id or 0
+
+        self.waiting = queue.Queue()
+        self.running: List[BatchedRequest] = []
+        self.past_key_values = None  # Tuple of (key, value) per layer
+        self.attention_mask = None  # [batch, seq]
+        self.sampler: Optional[BatchSampler] = None  # One row per running request
+        self.lora_registry = lora_registry
+        # Requests that wait for a LoRA slot to be free.
+        self.deferred: List[BatchedRequest] = []
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def generate_stream(self, params):
+        with self.tokenizer_lock:
+            req = BatchedRequest(params, self.tokenizer, self.context_len)
+        if self.lora_registry is not None:
+            if self.lora_registry.has(params.get("model")):
+                req.lora_name = params["model"]
+        self.waiting.put(req)
+        try:
+            while True:
+                output = req.outputs.get()
+                if isinstance(output, Exception):
+                    raise output
+                yield output
+                if output["finish_reason"] is not None:
+                    break
+        finally:
+            # Retire the request at the next step if the client has gone away.
+            req.cancelled = True
+
+    def get_num_running(self):
+        """The number of requests admitted to the engine and not finished yet."""
+        return len(self.running) + len(self.deferred) + self.waiting.qsize()
+
+    def loop(self):
+        while True:
+            new_reqs, self.deferred = self.deferred, []
+            if not self.running and not new_reqs:
+                # Block until there is work to do.
+                new_reqs.append(self.waiting.get())
+            while len(self.running) + len(new_reqs) < self.max_batch_size:
+                try:
+                    new_reqs.append(self.waiting.get_nowait())
+                except queue.Empty:
+                    break
+            new_reqs = [req for req in new_reqs if not req.cancelled]
+            if self.lora_registry is not None:
+                new_reqs = self.acquire_lora_slots(new_reqs)
+
+            try:
+                with self.tokenizer_lock:
+                    if self.running:
+                        self.decode_step()
+                    if new_reqs:
+                        self.prefill_step(new_reqs)
+            except Exception as e:
+                # Never let the scheduler thread die: its clients would wait forever.
+                logger.exception(f"Continuous batching step failed: {e}")
+                # New requests may have been merged into the running batch.
+                failed = self.running + [r for r in new_reqs if r not in self.running]
+                for req in failed:
+                    req.outputs.put(e)
+                self.release_lora_slots(failed)
+                self.running = []
+                self.past_key_values = self.attention_mask = self.sampler = None
+
+    def acquire_lora_slots(self, reqs: List[BatchedRequest]) -> List[BatchedRequest]:
+        """Load the LoRA adapters of new requests. Return the requests that got
+        a slot; the others wait for a running request to free one."""
+        admitted = []
+        for req in reqs:
+            try:
+                req.lora_slot = self.lora_registry.acquire(req.lora_name)
+            except LoRASlotsFull:
+                self.deferred.append(req)
+                continue
+            except Exception as e:
+                logger.error(f"Cannot load the LoRA adapter {req.lora_name}: {e}")
+                req.outputs.put(e)
+                continue
+            admitted.append(req)
+        return admitted
+
+    def release_lora_slots(self, reqs: List[BatchedRequest]):
+        if self.lora_registry is not None:
+            for req in reqs:
+                self.lora_registry.release(req.lora_name)
+
+    def forward(self, reqs, input_ids, attention_mask, past_key_values):
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+        position_ids = position_ids[:, -input_ids.shape[1] :]
+        if past_key_values is not None:
+            past_key_values = past_key_values_from_tuple(past_key_values)
+        if self.lora_registry is not None:
+            lora_context = self.lora_registry.activate([r.lora_slot for r in reqs])
+        else:
+            lora_context = contextlib.nullcontext()
+        with lora_context:
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        return out.logits, past_key_values_to_tuple(out.past_key_values)
+
+    @torch.inference_mode()
+    def decode_step(self):
+        input_ids = torch.as_tensor(
+            [[req.output_ids[-1]] for req in self.running], device=self.device
+        )
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))],
+            dim=-1,
+        )
+        logits, self.past_key_values = self.forward(
+            self.running, input_ids, self.attention_mask, self.past_key_values
+        )
+        self.process_logits(self.running, logits[:, -1, :], self.sampler)
+        self.retire()
+
+    @torch.inference_mode()
+    def prefill_step(self, reqs: List[BatchedRequest]):
+        max_len = max(len(req.input_ids) for req in reqs)
+        input_ids = torch.full(
+            (len(reqs), max_len), self.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(reqs), max_len), dtype=torch.long)
+        for i, req in enumerate(reqs):
+            input_ids[i, max_len - len(req.input_ids) :] = torch.as_tensor(
+                req.input_ids
+            )
+            attention_mask[i, max_len - len(req.input_ids) :] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        logits, past_key_values = self.forward(reqs, input_ids, attention_mask, None)
+
+        for i, req in enumerate(reqs):
+            if req.logprobs is not None:
+                # Prefill logprobs for the prompt, skipping the left padding.
+                pad_len = max_len - len(req.input_ids)
+                prompt_logprobs, prompt_top_logprobs = get_prompt_logprobs(
+                    logits[i, pad_len:], input_ids[i, pad_len:], req.logprobs
+                )
+                req.token_logprobs.extend(prompt_logprobs)
+                req.top_logprobs.extend(
+                    decode_top_logprobs(self.tokenizer, x) for x in prompt_top_logprobs
+                )
+        sampler = BatchSampler(
+            [req.temperature for req in reqs],
+            [req.repetition_penalty for req in reqs],
+            [req.top_p for req in reqs],
+            [req.top_k for req in reqs],
+            [req.logprobs for req in reqs],
+            [req.input_ids for req in reqs],
+            logits.shape[-1],
+            logits.device,
+        )
+        self.process_logits(reqs, logits[:, -1, :], sampler)
+
+        self.merge(reqs, past_key_values, attention_mask, sampler)
+        self.retire()
+
+    def process_logits(
+        self, reqs: List[BatchedRequest], logits: torch.Tensor, sampler: BatchSampler
+    ):
+        """Sample the next token of each row and stream the outputs."""
+        sampled = sampler(logits)
+        for i, req in enumerate(reqs):
+            token = sampled.tokens[i][0]
+            req.output_ids.append(token)
+            if req.logprobs is not None:
+                req.token_logprobs.append(sampled.token_logprobs[i])
+                req.top_logprobs.append(
+                    decode_top_logprobs(self.tokenizer, sampled.top_logprobs[i])
+                )
+
+            stopped = token in req.stop_token_ids
+            i_step = req.num_generated - 1
+            if (
+                i_step % self.stream_interval == 0
+                or req.num_generated >= req.max_new_tokens
+                or stopped
+            ):
+                output = req.make_output(self.tokenizer, stopped)
+                if output is not None:
+                    req.outputs.put(output)
+
+    def merge(self, reqs, past_key_values, attention_mask, sampler):
+        """Merge freshly prefilled requests into the running batch."""
+        if not self.running:
+            self.running = list(reqs)
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.sampler = sampler
+            return
+
+        old_len = self.attention_mask.shape[1]
+        new_len = attention_mask.shape[1]
+        total_len = max(old_len, new_len)
+
+        def left_pad(x, length, dim):
+            if x.shape[dim] == length:
+                return x
+            shape = list(x.shape)
+            shape[dim] = length - x.shape[dim]
+            return torch.cat([x.new_zeros(shape), x], dim=dim)
+
+        self.past_key_values = tuple(
+            (
+                torch.cat(
+                    [left_pad(old_k, total_len, 2), left_pad(new_k, total_len, 2)]
+                ),
+                torch.cat(
+                    [left_pad(old_v, total_len, 2), left_pad(new_v, total_len, 2)]
+                ),
+            )
+            for (old_k, old_v), (new_k, new_v) in zip(
+                self.past_key_values, past_key_values
+            )
+        )
+        self.attention_mask = torch.cat(
+            [
+                left_pad(self.attention_mask, total_len, 1),
+                left_pad(attention_mask, total_len, 1),
+            ]
+        )
+        self.sampler = BatchSampler.concat([self.sampler, sampler])
+        self.running.extend(reqs)
+
+    def retire(self):
+        """Drop finished or cancelled requests from the running batch."""
+        keep = [
+            i
+            for i, req in enumerate(self.running)
+            if not (req.finished or req.cancelled)
+        ]
+        if len(keep) == len(self.running):
+            return
+        self.release_lora_slots(
+            [req for req in self.running if req.finished or req.cancelled]
+        )
+        if not keep:
+            self.running = []
+            self.past_key_values = self.attention_mask = self.sampler = None
+            return
+
+        index = torch.as_tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Trim the columns that are padding for every remaining request.
+        start = int(attention_mask.any(dim=0).long().argmax())
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = tuple(
+            (
+                k.index_select(0, index.to(k.device))[:, :, start:],
+                v.index_select(0, index.to(v.device))[:, :, start:],
+            )
+            for k, v in self.past_key_values
+        )
+        self.sampler.select(keep)
+        self.running = [self.running[i] for i in keep]
+
+
 class ModelWorker(BaseModelWorker):
     def __init__(
         self,
@@ -61,6 +388,26 @@ class ModelWorker(BaseModelWorker):
         embed_in_truncate: bool = False,
         seed: Optional[int] = None,
         debug: bool = False,
+        continuous_batching: bool = False,
+        max_batch_size: int = 16,
+        kv_cache_gb: Optional[float] = None,
+        kv_cache_block_size: int = 16,
+        enable_prefix_caching: bool = False,
+        embed_batch_wait: float = 0.0,
+        embed_max_batch_size: int = 256,
+        embed_max_batch_tokens: int = 16384,
+        mmap_weights: bool = False,
+        weight_store_dir: Optional[str] = None,
+        lora_adapters: Optional[Dict[str, str]] = None,
+        lora_target_modules: Optional[List[str]] = None,
+        lora_max_rank: int = 64,
+        lora_memory_gb: float = 1.0,
+        draft_model_path: Optional[str] = None,
+        num_speculative_tokens: int = 4,
+        lookahead_decoding: bool = False,
+        lookahead_window_size: int = 6,
+        lookahead_ngram_size: int = 4,
+        lookahead_pool_size: int = 100000,
         **kwargs,
     ):
         super().__init__(
@@ -88,7 +435,12 @@ class ModelWorker(BaseModelWorker):
             exllama_config=exllama_config,
             xft_config=xft_config,
             debug=debug,
+            mmap_weights=mmap_weights,
+            weight_store_dir=weight_store_dir,
         )
+        load_timings = getattr(self.model, "load_timings", None)
+        if load_timings:
+            logger.info(f"Loaded the model in {format_load_timings(load_timings)}")
         self.device = device
         if self.tokenizer.pad_token == None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
@@ -96,8 +448,123 @@ class ModelWorker(BaseModelWorker):
         self.generate_stream_func = get_generate_stream_function(self.model, model_path)
         self.stream_interval = stream_interval
         self.embed_in_truncate = embed_in_truncate
+        self.embed_max_batch_tokens = embed_max_batch_tokens
+        self.embedding_batcher = EmbeddingBatcher(
+            self, embed_batch_wait, embed_max_batch_size
+        )
         self.seed = seed
 
+        self.speculative_metrics = None
+        self.ngram_pool = None
+        if draft_model_path is not None or lookahead_decoding:
+            if (
+                self.generate_stream_func is not generate_stream
+                or self.model.config.is_encoder_decoder
+            ):
+                logger.warning(
+                    "Speculative and lookahead decoding only support decoder-only "
+                    "models served by `generate_stream`. Ignoring --draft-model-path "
+                    "and --lookahead-decoding."
+                )
+            elif draft_model_path is not None:
+                logger.info(f"Loading the draft model {draft_model_path} ...")
+                self.draft_model, _ = load_model(
+                    draft_model_path,
+                    device=device,
+                    num_gpus=num_gpus,
+                    max_gpu_memory=max_gpu_memory,
+                    dtype=dtype,
+                    load_8bit=load_8bit,
+                    cpu_offloading=cpu_offloading,
+                    debug=debug,
+                    mmap_weights=mmap_weights,
+                    weight_store_dir=weight_store_dir,
+                )
+                self.speculative_metrics = SpeculativeDecodingMetrics()
+                self.generate_stream_func = functools.partial(
+                    generate_stream_speculative,
+                    draft_model=self.draft_model,
+                    num_speculative_tokens=num_speculative_tokens,
+                    metrics=self.speculative_metrics,
+                )
+            else:
+                self.ngram_pool = NGramPool(lookahead_ngram_size, lookahead_pool_size)
+                self.speculative_metrics = SpeculativeDecodingMetrics()
+                self.generate_stream_func = functools.partial(
+                    generate_stream_lookahead,
+                    ngram_pool=self.ngram_pool,
+                    window_size=lookahead_window_size,
+                    metrics=self.speculative_metrics,
+                )
+
+        self.lora_registry = None
+        if lora_adapters is not None:
+            self.lora_registry = LoRARegistry(
+                self.model,
+                lora_target_modules or get_lora_target_modules(lora_adapters.values()),
+                lora_max_rank,
+                int(lora_memory_gb * 2**30),
+            )
+            for name, path in lora_adapters.items():
+                self.lora_registry.register(name, path)
+            self.model_names = self.model_names + list(lora_adapters)
+            logger.info(
+                f"Serving {len(lora_adapters)} LoRA adapters with "
+                f"{self.lora_registry.num_slots} slots on the device."
+            )
+
+        self.kv_cache_pool = None
+        if kv_cache_gb:
+            if (
+                self.generate_stream_func is not generate_stream
+                or self.model.config.is_encoder_decoder
+                or PagedKVCache is None
+            ):
+                logger.warning(
+                    "The paged KV cache only supports decoder-only models served by "
+                    "`generate_stream` with transformers>=4.36. Ignoring --kv-cache-gb."
+                )
+            else:
+                self.kv_cache_pool = KVCachePool.from_model(
+                    self.model,
+                    kv_cache_gb,
+                    kv_cache_block_size,
+                    enable_prefix_caching,
+                )
+                logger.info(
+                    f"Allocated a KV cache pool of {self.kv_cache_pool.num_blocks} "
+                    f"blocks x {kv_cache_block_size} tokens."
+                )
+
+        self.batching_engine = None
+        if continuous_batching:
+            if (
+                self.generate_stream_func is not generate_stream
+                or self.model.config.is_encoder_decoder
+            ):
+                logger.warning(
+                    "Continuous batching only supports decoder-only models served by "
+                    "`generate_stream`. Falling back to one request at a time."
+                )
+            else:
+                if limit_worker_concurrency < max_batch_size:
+                    logger.warning(
+                        f"--limit-worker-concurrency ({limit_worker_concurrency}) is "
+                        f"smaller than --max-batch-size ({max_batch_size}), "
+                        "so batches will never be full."
+                    )
+                self.batching_engine = ContinuousBatchingEngine(
+                    self.model,
+                    self.tokenizer,
+                    device,
+                    self.context_len,
+                    stream_interval,
+                    max_batch_size,
+                    self.lora_registry,
+                    self.tokenizer_lock,
+                )
+                self.batches_generation = True
+
         if not no_register:
             self.init_heart_beat()
 
@@ -111,25 +578,54 @@ class ModelWorker(BaseModelWorker):
         try:
             if self.seed is not None:
                 set_seed(self.seed)
-            for output in self.generate_stream_func(
-                self.model,
-                self.tokenizer,
-                params,
-                self.device,
-                self.context_len,
-                self.stream_interval,
-            ):
+            start = time.time()
+            if self.batching_engine is not None:
+                output_stream = self.batching_engine.generate_stream(params)
+            elif self.kv_cache_pool is not None:
+                output_stream = self.generate_stream_func(
+                    self.model,
+                    self.tokenizer,
+                    params,
+                    self.device,
+                    self.context_len,
+                    self.stream_interval,
+                    kv_cache_pool=self.kv_cache_pool,
+                )
+            else:
+                output_stream = self.generate_stream_func(
+                    self.model,
+                    self.tokenizer,
+                    params,
+                    self.device,
+                    self.context_len,
+                    self.stream_interval,
+                )
+            if self.lora_registry is not None and self.batching_engine is None:
+                output_stream = self.lora_registry.wrap_stream(
+                    output_stream, params.get("model")
+                )
+            if self.batching_engine is None:
+                output_stream = iterate_with_lock(output_stream, self.tokenizer_lock)
+            delta_encoder = StreamDeltaEncoder() if params.get("stream_delta") else None
+            usage = None
+            for output in output_stream:
                 ret = {
                     "text": output["text"],
                     "error_code": 0,
                 }
                 if "usage" in output:
-                    ret["usage"] = output["usage"]
+                    ret["usage"] = usage = output["usage"]
                 if "finish_reason" in output:
                     ret["finish_reason"] = output["finish_reason"]
                 if "logprobs" in output:
                     ret["logprobs"] = output["logprobs"]
+                if delta_encoder is not None:
+                    ret = delta_encoder.encode(ret)
                 yield json.dumps(ret).encode() + b"\0"
+            if usage is not None:
+                self.update_tokens_per_second(
+                    usage["completion_tokens"], time.time() - start
+                )
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -143,20 +639,37 @@ class ModelWorker(BaseModelWorker):
             }
             yield json.dumps(ret).encode() + b"\0"
 
+    def get_status(self):
+        status = super().get_status()
+        if self.batching_engine is not None:
+            status["num_running"] = self.batching_engine.get_num_running()
+        if self.kv_cache_pool is not None:
+            status["kv_cache"] = self.kv_cache_pool.get_status()
+        if self.lora_registry is not None:
+            status["lora"] = self.lora_registry.get_status()
+        if self.speculative_metrics is not None:
+            status["speculative"] = self.speculative_metrics.get_status()
+        if self.ngram_pool is not None:
+            status["speculative"]["ngram_pool"] = self.ngram_pool.get_status()
+        return status
+
     def generate_gate(self, params):
+        params = dict(params, stream_delta=False)
         for x in self.generate_stream_gate(params):
             pass
         return json.loads(x[:-1].decode())
 
     def __process_embed_chunk(self, input_ids, attention_mask, **model_type_dict):
         if model_type_dict.get("is_bert"):
-            model_output = self.model(input_ids)
+            model_output = self.model(input_ids, attention_mask=attention_mask)
             if model_type_dict.get("is_robert"):
                 data = model_output.last_hidden_state
             else:
                 data = model_output[0]
         elif model_type_dict.get("is_t5"):
-            model_output = self.model(input_ids, decoder_input_ids=input_ids)
+            model_output = self.model(
+                input_ids, attention_mask=attention_mask, decoder_input_ids=input_ids
+            )
             data = model_output.encoder_last_hidden_state
         else:
             model_output = self.model(input_ids, output_hidden_states=True)
@@ -171,7 +684,7 @@ class ModelWorker(BaseModelWorker):
             mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
             masked_embeddings = data * mask
             sum_embeddings = torch.sum(masked_embeddings, dim=1)
-        token_num = torch.sum(attention_mask).item()
+        token_num = torch.sum(attention_mask, dim=1)
 
         return sum_embeddings, token_num
 
@@ -181,14 +694,99 @@ class ModelWorker(BaseModelWorker):
             base64.b64encode(e.numpy().tobytes()).decode("utf-8") for e in embeddings
         ]
 
-    @torch.inference_mode()
+    def __make_embed_buckets(self, all_input_ids: List[List[int]]) -> List[List[int]]:
+        """Group the inputs into batches of similar lengths.
+
+        A batch holds at most `embed_max_batch_tokens` padded tokens, or a single
+        longer input. Returns the indices of the inputs in each batch.
+        """
+        order = sorted(range(len(all_input_ids)), key=lambda i: len(all_input_ids[i]))
+        buckets = [[]]
+        for i in order:
+            # The inputs are sorted, so the new one is the longest of the bucket.
+            padded_len = min(len(all_input_ids[i]), self.context_len)
+            if (
+                buckets[-1]
+                and (len(buckets[-1]) + 1) * padded_len > self.embed_max_batch_tokens
+            ):
+                buckets.append([])
+            buckets[-1].append(i)
+        return [bucket for bucket in buckets if bucket]
+
+    def __embed_bucket(self, all_input_ids: List[List[int]], **model_type_dict):
+        """Return the normalized embeddings and the token numbers of a bucket."""
+        tokenizer = self.tokenizer
+        max_len = max(len(ids) for ids in all_input_ids)
+        input_ids = torch.full(
+            (len(all_input_ids), max_len), tokenizer.pad_token_id, dtype=torch.long
+        )
+        attention_mask = torch.zeros((len(all_input_ids), max_len), dtype=torch.long)
+        for i, ids in enumerate(all_input_ids):
+            input_ids[i, : len(ids)] = torch.as_tensor(ids)
+            attention_mask[i, : len(ids)] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        use_cls_pooling = (
+            hasattr(self.model, "use_cls_pooling") and self.model.use_cls_pooling
+        )
+
+        if self.embed_in_truncate:
+            embedding, token_num = self.__process_embed_chunk(
+                input_ids, attention_mask, **model_type_dict
+            )
+            if not use_cls_pooling:
+                embedding = embedding / token_num.unsqueeze(-1)
+        else:
+            embedding = 0
+            token_num = 0
+            for i in range(0, input_ids.size(1), self.context_len):
+                chunk_input_ids = input_ids[:, i : i + self.context_len]
+                chunk_attention_mask = attention_mask[:, i : i + self.context_len]
+
+                # add cls token and mask to get cls embedding
+                if use_cls_pooling:
+                    cls_tokens = (
+                        torch.zeros(
+                            (chunk_input_ids.size(0), 1),
+                            dtype=chunk_input_ids.dtype,
+                            device=chunk_input_ids.device,
+                        )
+                        + tokenizer.cls_token_id
+                    )
+                    chunk_input_ids = torch.cat([cls_tokens, chunk_input_ids], dim=-1)
+                    # Rows with no tokens left in this chunk get no cls token.
+                    mask = chunk_attention_mask.any(dim=1, keepdim=True).to(
+                        chunk_attention_mask.dtype
+                    )
+                    chunk_attention_mask = torch.cat(
+                        [mask, chunk_attention_mask], dim=-1
+                    )
+
+                chunk_embeddings, chunk_token_num = self.__process_embed_chunk(
+                    chunk_input_ids, chunk_attention_mask, **model_type_dict
+                )
+                if use_cls_pooling:
+                    chunk_embeddings = chunk_embeddings * chunk_token_num.unsqueeze(-1)
+                embedding = embedding + chunk_embeddings
+                token_num = token_num + chunk_token_num
+            embedding = embedding / token_num.clamp(min=1).unsqueeze(-1)
+
+        return F.normalize(embedding, p=2, dim=1), token_num.tolist()
+
     def get_embeddings(self, params):
-        self.call_ct += 1
+        return self.get_embeddings_batch([params])[0]
 
-        try:
-            tokenizer = self.tokenizer
-            ret = {"embedding": [], "token_num": 0}
+    @torch.inference_mode()
+    def get_embeddings_batch(self, params_list):
+        """Embed the inputs of several requests together.
+
+        The inputs of all requests are sorted by token length and run in buckets
+        (see `__make_embed_buckets`), so that a short input is not padded to the
+        longest input of the batch. The results are split back per request.
+        """
+        self.call_ct += len(params_list)
 
+        try:
             model_type_dict = {
                 "is_llama": "llama" in str(type(self.model)),
                 "is_t5": "t5" in str(type(self.model)),
@@ -197,89 +795,55 @@ class ModelWorker(BaseModelWorker):
                 "is_robert": "robert" in str(type(self.model)),
             }
 
-            if self.embed_in_truncate:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"],
-                    padding=True,
-                    truncation="longest_first",
-                    return_tensors="pt",
-                    max_length=self.context_len,
-                )
-            else:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
-                )
-            input_ids = encoding["input_ids"].to(self.device)
-            attention_mask = input_ids != tokenizer.pad_token_id
-
-            base64_encode = params.get("encoding_format", None)
+            inputs = [text for params in params_list for text in params["input"]]
+            with self.tokenizer_lock:
+                if self.embed_in_truncate:
+                    encoding = self.tokenizer(
+                        inputs, truncation="longest_first", max_length=self.context_len
+                    )
+                else:
+                    encoding = self.tokenizer(inputs)
+            all_input_ids = encoding["input_ids"]
 
-            if self.embed_in_truncate:
-                embedding, token_num = self.__process_embed_chunk(
-                    input_ids, attention_mask, **model_type_dict
+            embeddings = [None] * len(inputs)
+            token_nums = [0] * len(inputs)
+            for bucket in self.__make_embed_buckets(all_input_ids):
+                bucket_embeddings, bucket_token_nums = self.__embed_bucket(
+                    [all_input_ids[i] for i in bucket], **model_type_dict
                 )
-                if (
-                    not hasattr(self.model, "use_cls_pooling")
-                    or not self.model.use_cls_pooling
+                for i, embedding, token_num in zip(
+                    bucket, bucket_embeddings, bucket_token_nums
                 ):
-                    embedding = embedding / token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret["token_num"] = token_num
-            else:
-                all_embeddings = []
-                all_token_num = 0
-                for i in range(0, input_ids.size(1), self.context_len):
-                    chunk_input_ids = input_ids[:, i : i + self.context_len]
-                    chunk_attention_mask = attention_mask[:, i : i + self.context_len]
-
-                    # add cls token and mask to get cls embedding
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        cls_tokens = (
-                            torch.zeros(
-                                (chunk_input_ids.size(0), 1),
-                                dtype=chunk_input_ids.dtype,
-                                device=chunk_input_ids.device,
-                            )
-                            + tokenizer.cls_token_id
-                        )
-                        chunk_input_ids = torch.cat(
-                            [cls_tokens, chunk_input_ids], dim=-1
-                        )
-                        mask = torch.ones(
-                            (chunk_attention_mask.size(0), 1),
-                            dtype=chunk_attention_mask.dtype,
-                            device=chunk_attention_mask.device,
-                        )
-                        chunk_attention_mask = torch.cat(
-                            [mask, chunk_attention_mask], dim=-1
-                        )
+                    embeddings[i] = embedding
+                    token_nums[i] = token_num
 
-                    chunk_embeddings, token_num = self.__process_embed_chunk(
-                        chunk_input_ids, chunk_attention_mask, **model_type_dict
-                    )
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        all_embeddings.append(chunk_embeddings * token_num)
+            rets = []
+            start = 0
+            for params in params_list:
+                end = start + len(params["input"])
+                encoding_format = params.get("encoding_format", None)
+                if end == start:
+                    out_embeddings = []
+                else:
+                    normalized_embeddings = torch.stack(embeddings[start:end])
+                    if encoding_format == "base64":
+                        out_embeddings = self.__encode_base64(normalized_embeddings)
+                    elif encoding_format == "binary":
+                        # Packed into one buffer by `encode_embedding_buffer`.
+                        if normalized_embeddings.dtype != torch.float16:
+                            normalized_embeddings = normalized_embeddings.float()
+                        out_embeddings = normalized_embeddings.cpu().numpy()
                     else:
-                        all_embeddings.append(chunk_embeddings)
-                    all_token_num += token_num
-
-                all_embeddings_tensor = torch.stack(all_embeddings)
-                embedding = torch.sum(all_embeddings_tensor, dim=0) / all_token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-
-                ret["token_num"] = all_token_num
-
-            if base64_encode == "base64":
-                out_embeddings = self.__encode_base64(normalized_embeddings)
-            else:
-                out_embeddings = normalized_embeddings.tolist()
-            ret["embedding"] = out_embeddings
+                        out_embeddings = normalized_embeddings.tolist()
+                rets.append(
+                    {
+                        "embedding": out_embeddings,
+                        "token_num": sum(token_nums[start:end]),
+                        "token_nums": token_nums[start:end],
+                        "embed_in_truncate": self.embed_in_truncate,
+                    }
+                )
+                start = end
 
             gc.collect()
             torch.cuda.empty_cache()
@@ -292,12 +856,14 @@ class ModelWorker(BaseModelWorker):
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
+            rets = [ret] * len(params_list)
         except (ValueError, RuntimeError) as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-        return ret
+            rets = [ret] * len(params_list)
+        return rets
 
 
 def create_model_worker():
@@ -318,6 +884,26 @@ def create_model_worker():
         "--conv-template", type=str, default=None, help="Conversation prompt template."
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--embed-batch-wait-ms",
+        type=float,
+        default=0.0,
+        help="How long to wait for more embedding requests before running a batch. "
+        "Requests that arrive while a batch is running are always batched together.",
+    )
+    parser.add_argument(
+        "--embed-max-batch-size",
+        type=int,
+        default=256,
+        help="The maximum number of inputs of the embedding requests batched together.",
+    )
+    parser.add_argument(
+        "--embed-max-batch-tokens",
+        type=int,
+        default=16384,
+        help="The maximum number of padded tokens in one embedding forward pass. "
+        "Inputs are sorted by length into batches under this limit.",
+    )
     parser.add_argument(
         "--limit-worker-concurrency",
         type=int,
@@ -325,6 +911,76 @@ def create_model_worker():
         help="Limit the model concurrency to prevent OOM.",
     )
     parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Merge concurrent requests into one batched forward pass per decoding step.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=16,
+        help="Used for continuous batching. The maximum number of requests decoded together.",
+    )
+    parser.add_argument(
+        "--kv-cache-gb",
+        type=float,
+        default=None,
+        help="Serve generate_stream from a paged KV cache pool of this size (GiB) "
+        "instead of freeing the KV cache with a global GC after every request.",
+    )
+    parser.add_argument(
+        "--kv-cache-block-size",
+        type=int,
+        default=16,
+        help="Used for the paged KV cache. The number of tokens per block.",
+    )
+    parser.add_argument(
+        "--enable-prefix-caching",
+        action="store_true",
+        help="Used for the paged KV cache. Reuse the KV cache of prompt prefixes "
+        "shared across requests, so that only the new suffix is prefilled.",
+    )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        default=None,
+        help="Enable speculative decoding with this small draft model, which must "
+        "share the tokenizer of the served model.",
+    )
+    parser.add_argument(
+        "--num-speculative-tokens",
+        type=int,
+        default=4,
+        help="Used for speculative decoding. The number of tokens proposed by the "
+        "draft model per forward pass of the served model.",
+    )
+    parser.add_argument(
+        "--lookahead-decoding",
+        action="store_true",
+        help="Decode several tokens per forward pass by verifying the guesses of "
+        "Jacobi iteration and of an n-gram pool shared across requests. "
+        "Works on CPU and does not need a draft model.",
+    )
+    parser.add_argument(
+        "--lookahead-window-size",
+        type=int,
+        default=6,
+        help="Used for lookahead decoding. The number of guessed tokens verified "
+        "per forward pass.",
+    )
+    parser.add_argument(
+        "--lookahead-ngram-size",
+        type=int,
+        default=4,
+        help="Used for lookahead decoding. The length of the n-grams in the pool.",
+    )
+    parser.add_argument(
+        "--lookahead-pool-size",
+        type=int,
+        default=100000,
+        help="Used for lookahead decoding. The maximum number of n-grams in the pool.",
+    )
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument(
         "--seed",
@@ -404,8 +1060,24 @@ def create_model_worker():
         stream_interval=args.stream_interval,
         conv_template=args.conv_template,
         embed_in_truncate=args.embed_in_truncate,
+        embed_batch_wait=args.embed_batch_wait_ms / 1000,
+        embed_max_batch_size=args.embed_max_batch_size,
+        embed_max_batch_tokens=args.embed_max_batch_tokens,
         seed=args.seed,
         debug=args.debug,
+        continuous_batching=args.continuous_batching,
+        max_batch_size=args.max_batch_size,
+        kv_cache_gb=args.kv_cache_gb,
+        kv_cache_block_size=args.kv_cache_block_size,
+        enable_prefix_caching=args.enable_prefix_caching,
+        mmap_weights=args.mmap_weights,
+        weight_store_dir=args.weight_store_dir,
+        draft_model_path=args.draft_model_path,
+        num_speculative_tokens=args.num_speculative_tokens,
+        lookahead_decoding=args.lookahead_decoding,
+        lookahead_window_size=args.lookahead_window_size,
+        lookahead_ngram_size=args.lookahead_ngram_size,
+        lookahead_pool_size=args.lookahead_pool_size,
     )
     return args, worker
 
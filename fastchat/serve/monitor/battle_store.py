@@ -0,0 +1,170 @@
+"""
+A columnar store of cleaned battles.
+
+The battles of `clean_battle_data.py` are written as a Parquet dataset
+partitioned by date (date=YYYY-MM-DD directories, in UTC). Model names, the
+winner, the judge and the language are dictionary encoded and are read back as
+pandas categoricals. Nested fields (the conversations, the category tags) keep
+their Arrow types. The total number of tokens of each conversation is stored
+in the num_tokens_a and num_tokens_b columns, so the "long" category does not
+need the conversations.
+
+Readers only load the columns they ask for, and the date and model filters are
+pushed down to the partitions and the Parquet row groups.
+
+Usage:
+python3 -m fastchat.serve.monitor.battle_store --input clean_battle_20240101.json --output battle_store
+"""
+import argparse
+import json
+import os
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+DICTIONARY_COLUMNS = ["model_a", "model_b", "winner", "judge", "language"]
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+
+
+def get_conv_num_tokens(conv):
+    return sum(turn.get("num_tokens", 0) for turn in conv)
+
+
+def get_dates(tstamp):
+    """The UTC dates (YYYY-MM-DD) of timestamps."""
+    return pd.to_datetime(np.asarray(tstamp), unit="s").strftime("%Y-%m-%d")
+
+
+def battles_to_table(battles):
+    """Convert a list of battle dicts or a DataFrame to an Arrow table with a
+    date column."""
+    if isinstance(battles, pd.DataFrame):
+        battles = battles.to_dict("records")
+    table = pa.Table.from_pylist(battles)
+
+    for side in ["a", "b"]:
+        conv_column = f"conversation_{side}"
+        if conv_column in table.column_names:
+            num_tokens = [get_conv_num_tokens(x[conv_column]) for x in battles]
+            table = table.append_column(
+                f"num_tokens_{side}", pa.array(num_tokens, pa.int64())
+            )
+
+    for name in DICTIONARY_COLUMNS:
+        if name in table.column_names:
+            i = table.column_names.index(name)
+            table = table.set_column(i, name, table[name].dictionary_encode())
+
+    date = get_dates(table["tstamp"].to_numpy())
+    return table.append_column("date", pa.array(date, pa.string()))
+
+
+def write_battle_store(battles, root, append=False):
+    """Write battles to a store.
+
+    By default, the dates of `battles` replace the same dates in the store.
+    With `append`, they are added as new files.
+    """
+    table = battles_to_table(battles)
+    ds.write_dataset(
+        table,
+        root,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore" if append else "delete_matching",
+        max_rows_per_group=1 << 17,
+    )
+
+
+def open_battle_store(root):
+    dataset = ds.dataset(root, format="parquet", partitioning=PARTITIONING)
+    # The files written by different runs may have different columns.
+    schemas = [x.physical_schema for x in dataset.get_fragments()]
+    if len(schemas) > 1:
+        schema = pa.unify_schemas(schemas + [PARTITIONING.schema])
+        dataset = ds.dataset(
+            root, schema=schema, format="parquet", partitioning=PARTITIONING
+        )
+    return dataset
+
+
+def get_battle_filter(
+    start_date=None, end_date=None, models=None, exclude_models=None, anony_only=False
+):
+    """The Arrow filter of the battles in [start_date, end_date] (YYYY-MM-DD,
+    UTC) between `models` and not with `exclude_models`."""
+    conditions = []
+    if start_date is not None:
+        conditions.append(ds.field("date") >= start_date)
+    if end_date is not None:
+        conditions.append(ds.field("date") <= end_date)
+    if models is not None:
+        conditions.append(ds.field("model_a").isin(list(models)))
+        conditions.append(ds.field("model_b").isin(list(models)))
+    if exclude_models:
+        conditions.append(~ds.field("model_a").isin(list(exclude_models)))
+        conditions.append(~ds.field("model_b").isin(list(exclude_models)))
+    if anony_only:
+        conditions.append(ds.field("anony"))
+
+    expr = None
+    for x in conditions:
+        expr = x if expr is None else expr & x
+    return expr
+
+
+def read_battle_store(root, columns=None, **filters):
+    """Read the battles of a store as a DataFrame sorted by time.
+
+    `columns` are the columns to read (default: all). Columns that the store
+    does not have are skipped. `filters` are the arguments of
+    `get_battle_filter`.
+    """
+    dataset = open_battle_store(root)
+    if columns is not None:
+        columns = [x for x in columns if x in dataset.schema.names]
+        if "tstamp" not in columns:
+            columns.append("tstamp")
+    table = dataset.to_table(columns=columns, filter=get_battle_filter(**filters))
+    table = table.sort_by("tstamp")
+    return table.to_pandas()
+
+
+def load_battles(path, columns=None, **filters):
+    """Read battles from a store directory or a JSON file of
+    `clean_battle_data.py`."""
+    if os.path.isdir(path):
+        return read_battle_store(path, columns, **filters)
+
+    battles = pd.read_json(path)
+    if len(battles) == 0:
+        return battles
+    expr = get_battle_filter(**filters)
+    if expr is not None:
+        table = pa.Table.from_pandas(battles.assign(date=get_dates(battles["tstamp"])))
+        battles = table.filter(expr).drop(["date"]).to_pandas()
+    if columns is not None:
+        battles = battles[[x for x in columns if x in battles]]
+    return battles
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input", type=str, required=True, help="A JSON file of clean_battle_data.py"
+    )
+    parser.add_argument("--output", type=str, required=True, help="The store directory")
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add the battles to the store instead of replacing their dates.",
+    )
+    args = parser.parse_args()
+
+    battles = json.load(open(args.input))
+    write_battle_store(battles, args.output, append=args.append)
+    print(f"Write {len(battles)} battles to {args.output}")
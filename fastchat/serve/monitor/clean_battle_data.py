@@ -6,6 +6,7 @@ python3 clean_battle_data.py --mode conv_release
 """
 import argparse
 import datetime
+from functools import lru_cache
 import json
 import os
 from pytz import timezone
@@ -113,27 +114,67 @@ def replace_model_name(old_name, tstamp):
     return old_name
 
 
-def read_file(filename):
+@lru_cache(maxsize=1)
+def get_encoding():
+    return tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+
+@lru_cache(maxsize=1 << 16)
+def count_tokens(text):
+    return len(get_encoding().encode(text, allowed_special="all"))
+
+
+@lru_cache(maxsize=1 << 16)
+def detect_language_cached(text):
+    return detect_language(text)
+
+
+def read_file(filename, offset=0):
+    """Read the votes of a log file from a byte offset.
+
+    Returns the votes and the offset after the last complete line.
+    """
     data = []
     for retry in range(5):
         try:
-            # lines = open(filename).readlines()
-            for l in open(filename):
-                row = json.loads(l)
-                if row["type"] in VOTES:
-                    data.append(row)
+            with open(filename, "rb") as fin:
+                fin.seek(offset)
+                for l in fin:
+                    if not l.endswith(b"\n"):
+                        # The line is still being written
+                        break
+                    offset += len(l)
+                    # Only parse the lines that can be votes
+                    if b"vote" not in l:
+                        continue
+                    row = json.loads(l)
+                    if row["type"] in VOTES:
+                        data.append(row)
             break
         except FileNotFoundError:
             time.sleep(2)
-    return data
+    return data, offset
+
+
+def read_file_with_offset(args):
+    filename, offset = args
+    return read_file(filename, offset)
 
 
-def read_file_parallel(log_files, num_threads=16):
+def read_file_parallel(log_files, num_threads=16, offsets=None):
+    """Read the votes of the log files. With `offsets` ({filename: byte
+    offset}), only read the lines after the offsets and advance them."""
+    if offsets is None:
+        offsets = {}
+    args_list = [(filename, offsets.get(filename, 0)) for filename in log_files]
     data_all = []
     with Pool(num_threads) as p:
-        ret_all = list(tqdm(p.imap(read_file, log_files), total=len(log_files)))
-        for ret in ret_all:
-            data_all.extend(ret)
+        ret_all = list(
+            tqdm(p.imap(read_file_with_offset, args_list), total=len(log_files))
+        )
+        for filename, (data, offset) in zip(log_files, ret_all):
+            data_all.extend(data)
+            offsets[filename] = offset
     return data_all
 
 
@@ -143,7 +184,6 @@ def process_data(
     sanitize_ip,
     ban_ip_list,
 ):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
     convert_type = {
         "leftvote": "model_a",
         "rightvote": "model_b",
@@ -212,17 +252,20 @@ def process_data(
         if state["offset"] >= len(state["messages"]):
             count_dict["invalid"] += 1
             continue
-        lang_code = detect_language(state["messages"][state["offset"]][1])
+        lang_code = detect_language_cached(state["messages"][state["offset"]][1])
 
         # Drop conversations if the model names are leaked
-        messages = ""
+        messages = []
         for i in range(2):
             state = row["states"][i]
             for _, (role, msg) in enumerate(state["messages"][state["offset"] :]):
                 if msg:
-                    messages += msg.lower()
+                    messages.append(msg.lower())
                 else:
                     flag_none_msg = True
+        # The words are found with one substring search each, which is faster
+        # than a regex alternation of all of them.
+        messages = "".join(messages)
 
         for word in IDENTITY_WORDS:
             if word in messages:
@@ -286,14 +329,11 @@ def process_data(
         if flag_anony:
             count_dict["anony"] += 1
 
+        # The prompts of both sides and repeated prompts are only counted once
         for conv in conversation_a:
-            conv["num_tokens"] = len(
-                encoding.encode(conv["content"], allowed_special="all")
-            )
+            conv["num_tokens"] = count_tokens(conv["content"])
         for conv in conversation_b:
-            conv["num_tokens"] = len(
-                encoding.encode(conv["content"], allowed_special="all")
-            )
+            conv["num_tokens"] = count_tokens(conv["content"])
 
         # Save the results
         battles.append(
@@ -321,12 +361,21 @@ def clean_battle_data(
     sanitize_ip=False,
     anony_only=False,
     num_threads=16,
+    offsets=None,
 ):
-    data = read_file_parallel(log_files, num_threads=16)
+    """Clean the votes of the log files into battles sorted by time.
+
+    With `offsets` ({filename: byte offset}), only the log lines appended
+    after the offsets are cleaned, and the offsets are advanced.
+    """
+    data = read_file_parallel(log_files, num_threads, offsets)
+    if len(data) == 0:
+        print("#votes: 0")
+        return []
 
     battles = []
-    count_dict = {}
-    count_leak = {}
+    count_dict = Counter()
+    count_leak = Counter()
     all_ips = {}
     with Pool(num_threads) as p:
         # split data into chunks
@@ -344,14 +393,18 @@ def clean_battle_data(
         for ret in ret_all:
             sub_battles, sub_count_dict, sub_count_leak, sub_all_ips = ret
             battles.extend(sub_battles)
-            count_dict = dict(Counter(count_dict) + Counter(sub_count_dict))
-            count_leak = dict(Counter(count_leak) + Counter(sub_count_leak))
+            # Counter.update keeps the zero counts, unlike Counter addition
+            count_dict.update(sub_count_dict)
+            count_leak.update(sub_count_leak)
             for ip in sub_all_ips:
                 if ip not in all_ips:
                     all_ips[ip] = sub_all_ips[ip]
                 else:
                     all_ips[ip]["count"] += sub_all_ips[ip]["count"]
     battles.sort(key=lambda x: x["tstamp"])
+    if len(battles) == 0:
+        print(f"#votes: {len(data)}, #battles: 0")
+        return battles
     last_updated_tstamp = battles[-1]["tstamp"]
 
     last_updated_datetime = datetime.datetime.fromtimestamp(
@@ -359,10 +412,10 @@ def clean_battle_data(
     ).strftime("%Y-%m-%d %H:%M:%S %Z")
 
     print(f"#votes: {len(data)}")
-    print(count_dict)
+    print(dict(count_dict))
     print(f"#battles: {len(battles)}, #anony: {count_dict['anony']}")
     print(f"last-updated: {last_updated_datetime}")
-    print(f"leaked_identity: {count_leak}")
+    print(f"leaked_identity: {dict(count_leak)}")
 
     if ban_ip_list is not None:
         for ban_ip in ban_ip_list:
@@ -382,42 +435,81 @@ if __name__ == "__main__":
     parser.add_argument("--exclude-model-names", type=str, nargs="+")
     parser.add_argument("--ban-ip-file", type=str)
     parser.add_argument("--sanitize-ip", action="store_true", default=False)
+    parser.add_argument(
+        "--battle-store",
+        type=str,
+        help="Write all the battles with all their fields to this battle store "
+        "directory instead of a JSON file. Readers select the columns they need.",
+    )
+    parser.add_argument(
+        "--offset-file",
+        type=str,
+        help="Only clean the log lines appended since the last run, keeping the "
+        "byte offsets of the log files in this file. The new battles are appended "
+        "to --battle-store.",
+    )
     args = parser.parse_args()
+    assert (
+        args.offset_file is None or args.battle_store
+    ), "--offset-file requires --battle-store"
 
     log_files = get_log_files(args.max_num_files)
     ban_ip_list = json.load(open(args.ban_ip_file)) if args.ban_ip_file else None
 
+    offsets = None
+    if args.offset_file:
+        offsets = {}
+        if os.path.exists(args.offset_file):
+            offsets = json.load(open(args.offset_file))
+
     battles = clean_battle_data(
-        log_files, args.exclude_model_names or [], ban_ip_list, args.sanitize_ip
+        log_files,
+        args.exclude_model_names or [],
+        ban_ip_list,
+        args.sanitize_ip,
+        offsets=offsets,
     )
-    last_updated_tstamp = battles[-1]["tstamp"]
-    cutoff_date = datetime.datetime.fromtimestamp(
-        last_updated_tstamp, tz=timezone("US/Pacific")
-    ).strftime("%Y%m%d")
-
-    if args.mode == "simple":
-        for x in battles:
-            for key in [
-                "conversation_a",
-                "conversation_b",
-                "question_id",
-            ]:
-                del x[key]
-        print("Samples:")
-        for i in range(4):
-            print(battles[i])
-        output = f"clean_battle_{cutoff_date}.json"
-    elif args.mode == "conv_release":
-        new_battles = []
-        for x in battles:
-            if not x["anony"]:
-                continue
-            for key in []:
-                del x[key]
-            new_battles.append(x)
-        battles = new_battles
-        output = f"clean_battle_conv_{cutoff_date}.json"
-
-    with open(output, "w", encoding="utf-8", errors="replace") as fout:
-        json.dump(battles, fout, indent=2, ensure_ascii=False)
-    print(f"Write cleaned data to {output}")
+
+    if args.battle_store:
+        from fastchat.serve.monitor.battle_store import write_battle_store
+
+        if len(battles) > 0:
+            write_battle_store(battles, args.battle_store, append=offsets is not None)
+        print(f"Write {len(battles)} cleaned battles to {args.battle_store}")
+        if offsets is not None:
+            tmp_filename = f"{args.offset_file}.{os.getpid()}.tmp"
+            with open(tmp_filename, "w") as fout:
+                json.dump(offsets, fout, indent=2)
+            os.replace(tmp_filename, args.offset_file)
+    else:
+        last_updated_tstamp = battles[-1]["tstamp"]
+        cutoff_date = datetime.datetime.fromtimestamp(
+            last_updated_tstamp, tz=timezone("US/Pacific")
+        ).strftime("%Y%m%d")
+
+        if args.mode == "simple":
+            for x in battles:
+                for key in [
+                    "conversation_a",
+                    "conversation_b",
+                    "question_id",
+                ]:
+                    del x[key]
+            print("Samples:")
+            for i in range(4):
+                print(battles[i])
+            output = f"clean_battle_{cutoff_date}.json"
+        elif args.mode == "conv_release":
+            new_battles = []
+            for x in battles:
+                if not x["anony"]:
+                    continue
+                for key in []:
+                    del x[key]
+                new_battles.append(x)
+            battles = new_battles
+            output = f"clean_battle_conv_{cutoff_date}.json"
+
+        with open(output, "w", encoding="utf-8", errors="replace") as fout:
+            json.dump(battles, fout, indent=2, ensure_ascii=False)
+        print(f"Write cleaned data to {output}")
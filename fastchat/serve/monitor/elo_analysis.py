@@ -1,9 +1,11 @@
 import argparse
 import ast
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import datetime
 import json
 import math
+import os
 import pickle
 from pytz import timezone
 from functools import partial
@@ -21,8 +23,9 @@ from fastchat.serve.monitor.clean_battle_data import clean_battle_data
 pd.options.display.float_format = "{:.2f}".format
 
 
-def compute_elo(battles, K=4, SCALE=400, BASE=10, INIT_RATING=1000):
-    rating = defaultdict(lambda: INIT_RATING)
+def compute_elo(battles, K=4, SCALE=400, BASE=10, INIT_RATING=1000, rating=None):
+    """Online Elo. Continue from the ratings `rating` if given."""
+    rating = defaultdict(lambda: INIT_RATING, rating or {})
 
     for rd, model_a, model_b, winner in battles[
         ["model_a", "model_b", "winner"]
@@ -54,69 +57,182 @@ def get_bootstrap_result(battles, func_compute_elo, num_round=1000):
     return df[df.median().sort_values(ascending=False).index]
 
 
+def get_battle_counts(battles):
+    """Aggregate battles into the counts of their (model_a, model_b, winner) cells.
+
+    Returns the sorted model names, the model_a and model_b indices and the
+    outcome (0: model_a wins, 1: model_b wins, 2: tie) of every cell, and the
+    number of battles in each cell. Battles that are already aggregated have
+    a "count" column.
+    """
+    outcome = battles["winner"].map(
+        {"model_a": 0, "model_b": 1, "tie": 2, "tie (bothbad)": 2}
+    )
+    battles = battles[outcome.notna()]
+    outcome = outcome[outcome.notna()].astype(np.int64)
+    model_a = pd.Categorical(battles["model_a"])
+    model_b = pd.Categorical(battles["model_b"])
+    models = model_a.categories.union(model_b.categories)
+    a = pd.Categorical(battles["model_a"], categories=models).codes.astype(np.int64)
+    b = pd.Categorical(battles["model_b"], categories=models).codes.astype(np.int64)
+
+    num_models = len(models)
+    cell_ids, inverse = np.unique(
+        (a * num_models + b) * 3 + outcome.to_numpy(), return_inverse=True
+    )
+    weights = battles["count"].to_numpy() if "count" in battles else None
+    counts = np.bincount(inverse, weights=weights).astype(np.int64)
+    cells = (cell_ids // 3 // num_models, cell_ids // 3 % num_models, cell_ids % 3)
+    return models, cells, counts
+
+
+def get_win_matrix(cells, counts, num_models):
+    """The [..., num_models, num_models] weights of row beating column in the
+    Bradley-Terry fit, for counts of shape [..., num_cells].
+
+    A win counts twice and a tie once for each side, like in the pivot tables
+    of the logistic regression this replaces.
+    """
+    a, b, outcome = cells
+    counts = np.asarray(counts, dtype=np.float64)
+    # Every cell adds its weighted count at one or two (winner, loser) entries.
+    is_tie = outcome == 2
+    winner = np.concatenate([np.where(outcome == 1, b, a), b[is_tie]])
+    loser = np.concatenate([np.where(outcome == 1, a, b), a[is_tie]])
+    cell_index = np.concatenate([np.arange(len(a)), np.nonzero(is_tie)[0]])
+    weight = np.where(outcome[cell_index] == 2, 1.0, 2.0)
+
+    win_matrix = np.zeros(counts.shape[:-1] + (num_models * num_models,))
+    np.add.at(
+        win_matrix,
+        (..., winner * num_models + loser),
+        counts[..., cell_index] * weight,
+    )
+    return win_matrix.reshape(counts.shape[:-1] + (num_models, num_models))
+
+
+def fit_bt(win_matrix, BASE=10, init_beta=None, max_iter=100, tol=1e-6, max_step=1.0):
+    """Fit Bradley-Terry strengths by maximum likelihood with Newton's method.
+
+    `win_matrix` holds [..., M, M] weights of row beating column, so a batch
+    of bootstrap replicates is fitted at once. Returns the [..., M] strengths
+    in log-BASE units, centered like an unpenalized logistic regression
+    started from zero. Steps are clipped to `max_step`, so strengths that
+    diverge (a model that never loses) stay finite like with lbfgs.
+    `init_beta` warm-starts the iteration, e.g. from the previous ratings.
+    """
+    win_matrix = np.asarray(win_matrix, dtype=np.float64)
+    num_models = win_matrix.shape[-1]
+    num_games = win_matrix + np.swapaxes(win_matrix, -1, -2)
+    c = math.log(BASE)
+    # The constant matrix removes the shift invariance of the strengths, and
+    # the tiny ridge keeps models without games in a replicate at zero.
+    regularizer = np.full((num_models, num_models), 1 / num_models)
+    regularizer += np.eye(num_models) * 1e-9 * (1 + num_games.max())
+
+    beta = np.zeros(win_matrix.shape[:-1])
+    if init_beta is not None:
+        # Newton steps keep the mean, which must be zero like without warm start.
+        beta += init_beta - np.mean(init_beta, axis=-1, keepdims=True)
+    for _ in range(max_iter):
+        prob = 1 / (1 + np.exp(-c * (beta[..., :, None] - beta[..., None, :])))
+        grad = c * (win_matrix - num_games * prob).sum(axis=-1)
+        curvature = c * c * num_games * prob * (1 - prob)
+        neg_hessian = -curvature
+        diagonal = np.einsum("...ii->...i", neg_hessian)
+        diagonal += curvature.sum(axis=-1)
+        delta = np.linalg.solve(neg_hessian + regularizer, grad[..., None])[..., 0]
+        size = np.abs(delta).max(axis=-1, keepdims=True)
+        beta += delta * np.minimum(1, max_step / np.maximum(size, 1e-300))
+        if size.max() < tol:
+            break
+    return beta
+
+
+def bt_to_elo(beta, models, SCALE=400, INIT_RATING=1000):
+    elo_scores = SCALE * beta + INIT_RATING
+    if "mixtral-8x7b-instruct-v0.1" in models:
+        anchor = elo_scores[..., models.get_loc("mixtral-8x7b-instruct-v0.1")]
+        # Replicates without the anchor model are not shifted.
+        elo_scores += np.nan_to_num(1114 - anchor[..., None])
+    return elo_scores
+
+
+def elo_to_bt(rating, models, SCALE=400, INIT_RATING=1000):
+    """The strengths of `models` for warm-starting `fit_bt` from Elo ratings."""
+    if rating is None:
+        return None
+    beta = (pd.Series(rating).reindex(models) - INIT_RATING) / SCALE
+    # New models start at the mean.
+    return beta.fillna(beta.mean() if beta.notna().any() else 0).to_numpy()
+
+
 def compute_elo_mle_with_tie(
-    df, SCALE=400, BASE=10, INIT_RATING=1000, sample_weight=None
+    df, SCALE=400, BASE=10, INIT_RATING=1000, sample_weight=None, init_rating=None
 ):
-    from sklearn.linear_model import LogisticRegression
-
-    ptbl_a_win = pd.pivot_table(
-        df[df["winner"] == "model_a"],
-        index="model_a",
-        columns="model_b",
-        aggfunc="size",
-        fill_value=0,
-    )
-    ptbl_tie = pd.pivot_table(
-        df[df["winner"].isin(["tie", "tie (bothbad)"])],
-        index="model_a",
-        columns="model_b",
-        aggfunc="size",
-        fill_value=0,
-    )
-    ptbl_tie = ptbl_tie + ptbl_tie.T
-    ptbl_b_win = pd.pivot_table(
-        df[df["winner"] == "model_b"],
-        index="model_a",
-        columns="model_b",
-        aggfunc="size",
-        fill_value=0,
-    )
-    ptbl_win = ptbl_a_win * 2 + ptbl_b_win.T * 2 + ptbl_tie
-
-    models = pd.Series(np.arange(len(ptbl_win.index)), index=ptbl_win.index)
-
-    p = len(models)
-    X = np.zeros([p * (p - 1) * 2, p])
-    Y = np.zeros(p * (p - 1) * 2)
-
-    cur_row = 0
-    sample_weights = []
-    for m_a in ptbl_win.index:
-        for m_b in ptbl_win.columns:
-            if m_a == m_b:
-                continue
-            # if nan skip
-            if math.isnan(ptbl_win.loc[m_a, m_b]) or math.isnan(ptbl_win.loc[m_b, m_a]):
-                continue
-            X[cur_row, models[m_a]] = +math.log(BASE)
-            X[cur_row, models[m_b]] = -math.log(BASE)
-            Y[cur_row] = 1.0
-            sample_weights.append(ptbl_win.loc[m_a, m_b])
-
-            X[cur_row + 1, models[m_a]] = math.log(BASE)
-            X[cur_row + 1, models[m_b]] = -math.log(BASE)
-            Y[cur_row + 1] = 0.0
-            sample_weights.append(ptbl_win.loc[m_b, m_a])
-            cur_row += 2
-    X = X[:cur_row]
-    Y = Y[:cur_row]
-
-    lr = LogisticRegression(fit_intercept=False, penalty=None)
-    lr.fit(X, Y, sample_weight=sample_weights)
-    elo_scores = SCALE * lr.coef_[0] + INIT_RATING
-    if "mixtral-8x7b-instruct-v0.1" in models.index:
-        elo_scores += 1114 - elo_scores[models["mixtral-8x7b-instruct-v0.1"]]
-    return pd.Series(elo_scores, index=models.index).sort_values(ascending=False)
+    models, cells, counts = get_battle_counts(df)
+    win_matrix = get_win_matrix(cells, counts, len(models))
+    init_beta = elo_to_bt(init_rating, models, SCALE, INIT_RATING)
+    beta = fit_bt(win_matrix, BASE, init_beta=init_beta)
+    elo_scores = bt_to_elo(beta, models, SCALE, INIT_RATING)
+    return pd.Series(elo_scores, index=models).sort_values(ascending=False)
+
+
+def _bootstrap_bt_chunk(
+    seed, num_round, cells, counts, num_models, BASE, init_beta=None
+):
+    rng = np.random.default_rng(seed)
+    total = counts.sum()
+    boot_counts = rng.multinomial(total, counts / total, size=num_round)
+    win_matrix = get_win_matrix(cells, boot_counts, num_models)
+    beta = fit_bt(win_matrix, BASE, init_beta=init_beta)
+    # A model without games in a replicate is missing from it.
+    num_games = (win_matrix + np.swapaxes(win_matrix, -1, -2)).sum(axis=-1)
+    return np.where(num_games > 0, beta, np.nan)
+
+
+def get_bootstrap_result_bt(
+    battles,
+    num_round=1000,
+    num_cpu=None,
+    chunk_size=64,
+    SCALE=400,
+    BASE=10,
+    INIT_RATING=1000,
+    init_rating=None,
+):
+    """`get_bootstrap_result(battles, compute_elo_mle_with_tie, num_round)`
+    without resampling DataFrames.
+
+    The battles are aggregated once. Resampling them with replacement is
+    drawing multinomial counts of their cells, so each replicate is a
+    reweighting of the same cells. Chunks of replicates are fitted together
+    by `fit_bt`, in parallel processes.
+    """
+    models, cells, counts = get_battle_counts(battles)
+    num_cpu = num_cpu or os.cpu_count()
+    sizes = [min(chunk_size, num_round - i) for i in range(0, num_round, chunk_size)]
+    seeds = np.random.randint(0, 2**31 - 1, size=len(sizes))
+    func = partial(
+        _bootstrap_bt_chunk,
+        cells=cells,
+        counts=counts,
+        num_models=len(models),
+        BASE=BASE,
+        init_beta=elo_to_bt(init_rating, models, SCALE, INIT_RATING),
+    )
+    if num_cpu > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(min(num_cpu, len(sizes))) as executor:
+            betas = list(
+                tqdm(
+                    executor.map(func, seeds, sizes), total=len(sizes), desc="bootstrap"
+                )
+            )
+    else:
+        betas = [func(seed, size) for seed, size in zip(seeds, sizes)]
+    elo_scores = bt_to_elo(np.concatenate(betas), models, SCALE, INIT_RATING)
+    df = pd.DataFrame(elo_scores, columns=models)
+    return df[df.median().sort_values(ascending=False).index]
 
 
 def get_median_elo_from_bootstrap(bootstrap_df):
@@ -125,29 +241,44 @@ def get_median_elo_from_bootstrap(bootstrap_df):
     return median
 
 
+def pivot_battle_counts(battles):
+    """The number of battles of each (model_a, model_b) pair. Battles that are
+    already aggregated have a "count" column."""
+    if "count" in battles:
+        return pd.pivot_table(
+            battles,
+            index="model_a",
+            columns="model_b",
+            values="count",
+            aggfunc="sum",
+            fill_value=0,
+        )
+    return pd.pivot_table(
+        battles, index="model_a", columns="model_b", aggfunc="size", fill_value=0
+    )
+
+
+def count_battles_per_model(battles):
+    if "count" in battles:
+        counts = battles["count"]
+    else:
+        counts = pd.Series(1, index=battles.index)
+    return (
+        counts.groupby(battles["model_a"])
+        .sum()
+        .add(counts.groupby(battles["model_b"]).sum(), fill_value=0)
+    )
+
+
 def compute_pairwise_win_fraction(battles, model_order, limit_show_number=None):
     # Times each model wins as Model A
-    a_win_ptbl = pd.pivot_table(
-        battles[battles["winner"] == "model_a"],
-        index="model_a",
-        columns="model_b",
-        aggfunc="size",
-        fill_value=0,
-    )
+    a_win_ptbl = pivot_battle_counts(battles[battles["winner"] == "model_a"])
 
     # Table counting times each model wins as Model B
-    b_win_ptbl = pd.pivot_table(
-        battles[battles["winner"] == "model_b"],
-        index="model_a",
-        columns="model_b",
-        aggfunc="size",
-        fill_value=0,
-    )
+    b_win_ptbl = pivot_battle_counts(battles[battles["winner"] == "model_b"])
 
     # Table counting number of A-B pairs
-    num_battles_ptbl = pd.pivot_table(
-        battles, index="model_a", columns="model_b", aggfunc="size", fill_value=0
-    )
+    num_battles_ptbl = pivot_battle_counts(battles)
 
     # Computing the proportion of wins for each model as A and as B
     # against all other models
@@ -213,9 +344,7 @@ def visualize_pairwise_win_fraction(battles, model_order, scale=1):
 
 
 def visualize_battle_count(battles, model_order, scale=1):
-    ptbl = pd.pivot_table(
-        battles, index="model_a", columns="model_b", aggfunc="size", fill_value=0
-    )
+    ptbl = pivot_battle_counts(battles)
     battle_counts = ptbl + ptbl.T
     fig = px.imshow(
         battle_counts.loc[model_order, model_order],
@@ -303,28 +432,32 @@ def limit_user_votes(battles, daily_vote_per_user):
     return battles_new
 
 
-def get_model_pair_stats(battles):
-    battles["ordered_pair"] = battles.apply(
-        lambda x: tuple(sorted([x["model_a"], x["model_b"]])), axis=1
-    )
+def get_pair_votes(battles):
+    """The model pair of every battle, sorted by name, and the vote for the
+    first model of the pair: 1 for a win, 0.5 for a tie and 0 for a loss."""
+    model_a = battles["model_a"].astype(str).to_numpy(dtype=object)
+    model_b = battles["model_b"].astype(str).to_numpy(dtype=object)
+    winner = battles["winner"].astype(str).to_numpy(dtype=object)
+    swap = model_b < model_a
+    first = np.where(swap, model_b, model_a)
+    second = np.where(swap, model_a, model_b)
 
-    model_pair_stats = {}
+    first_wins = ((winner == "model_a") & (model_a == first)) | (
+        (winner == "model_b") & (model_b == first)
+    )
+    tie = (winner == "tie") | (winner == "tie (bothbad)")
+    vote = np.where(tie, 0.5, np.where(first_wins, 1.0, 0.0))
+    return first, second, vote
 
-    for index, row in battles.iterrows():
-        pair = row["ordered_pair"]
-        if pair not in model_pair_stats:
-            model_pair_stats[pair] = {"win": 0, "loss": 0, "tie": 0}
 
-        if row["winner"] in ["tie", "tie (bothbad)"]:
-            model_pair_stats[pair]["tie"] += 1
-        elif row["winner"] == "model_a" and row["model_a"] == min(pair):
-            model_pair_stats[pair]["win"] += 1
-        elif row["winner"] == "model_b" and row["model_b"] == min(pair):
-            model_pair_stats[pair]["win"] += 1
-        else:
-            model_pair_stats[pair]["loss"] += 1
+def get_model_pair_stats(battles):
+    first, second, vote = get_pair_votes(battles)
+    battles["ordered_pair"] = list(zip(first, second))
 
-    return model_pair_stats
+    counts = pd.crosstab([first, second], vote)
+    counts = counts.reindex(columns=[1.0, 0.0, 0.5], fill_value=0)
+    counts.columns = ["win", "loss", "tie"]
+    return counts.astype(int).to_dict("index")
 
 
 def outlier_detect(
@@ -336,60 +469,67 @@ def outlier_detect(
     c_param=0.5,
     user_list=None,
 ):
+    """Remove the users whose votes disagree with the other users.
+
+    The first `max_vote` votes of every user are tested sequentially: the
+    p-value of a vote is its rank among the wins and losses of the model pair,
+    and a user is removed once the product of 1 / (2 * p-value) over their
+    votes exceeds 1 / alpha. The test runs for all the users at once with
+    grouped cumulative sums of the logs.
+    """
     if user_list is None:
         # only check user who has >= 5 votes to save compute
         user_vote_cnt = battles["judge"].value_counts()
         user_list = user_vote_cnt[user_vote_cnt >= 5].index.tolist()
     print("#User to be checked: ", len(user_list))
 
+    df = battles[battles["judge"].isin(user_list)]
+    judge = df["judge"].astype(str).to_numpy(dtype=object)
+    vote_index = pd.Series(judge).groupby(judge).cumcount().to_numpy()
+    df, judge, vote_index = (
+        df[vote_index < max_vote],
+        judge[vote_index < max_vote],
+        vote_index[vote_index < max_vote],
+    )
+
+    # Look up the wins and losses of the pair of every vote
+    first, second, vote = get_pair_votes(df)
+    pairs = pd.MultiIndex.from_tuples(list(model_pair_stats.keys()))
+    pair_index = pairs.get_indexer(pd.MultiIndex.from_arrays([first, second]))
+    win = np.array([x["win"] for x in model_pair_stats.values()])[pair_index]
+    loss = np.array([x["loss"] for x in model_pair_stats.values()])[pair_index]
+
+    # The number of wins and losses (ratings 1 and 0) <= and >= the vote
+    if randomized:
+        # With tiny noise added to the ratings and the vote, the vote ranks
+        # uniformly among the ratings equal to it.
+        num_equal = np.where(vote == 1, win, np.where(vote == 0, loss, 0))
+        num_below = np.floor(np.random.uniform(size=len(vote)) * (num_equal + 1))
+        num_upper = np.where(vote == 1, loss + num_below, loss)
+        num_upper = np.where(vote == 0, num_below, num_upper)
+        num_lower = np.where(vote == 1, win - num_below, win)
+        num_lower = np.where(vote == 0, win + loss - num_below, num_lower)
+    else:
+        num_upper = np.where(vote == 1, win + loss, loss)
+        num_lower = np.where(vote == 0, win + loss, win)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_m = -np.log(
+            2 * np.stack([num_upper, num_lower], axis=1) / (win + loss)[:, None]
+        )
+    # A pair without wins or losses makes the product NaN from that vote on
+    is_nan = pd.DataFrame(np.isnan(log_m).astype(int)).groupby(judge).cummax()
+    is_nan = is_nan.to_numpy() > 0
+    log_m = pd.DataFrame(np.nan_to_num(log_m, nan=0.0, posinf=np.inf))
+    log_m = log_m.groupby(judge).cumsum().to_numpy()
+    flag = ((log_m > np.log(1 / alpha)) & ~is_nan).any(axis=1)
+
+    num_votes = pd.Series(vote_index[flag] + 1).groupby(judge[flag]).min()
     bad_user_list = []
     for user in user_list:
-        flag = False
-        p_upper = []
-        p_lower = []
-        df_2 = battles[battles["judge"] == user]
-        for row in df_2.iterrows():
-            if len(p_upper) >= max_vote:
-                break
-
-            model_pair = tuple(sorted([row[1]["model_a"], row[1]["model_b"]]))
-
-            if row[1]["winner"] in ["tie", "tie (bothbad)"]:
-                vote = 0.5
-            elif row[1]["winner"] == "model_a" and row[1]["model_a"] == model_pair[0]:
-                vote = 1
-            elif row[1]["winner"] == "model_b" and row[1]["model_b"] == model_pair[0]:
-                vote = 1
-            else:
-                vote = 0
-
-            stats = model_pair_stats[model_pair]
-            # count all votes
-            # ratings = np.array(
-            #     [1] * stats["win"] + [0.5] * stats["tie"] + [0] * stats["loss"]
-            # )
-
-            # only count win and loss
-            ratings = np.array([1] * stats["win"] + [0] * stats["loss"])
-            if randomized:
-                noise = np.random.uniform(-1e-5, 1e-5, len(ratings))
-                ratings += noise
-                vote += np.random.uniform(-1e-5, 1e-5)
-
-            p_upper += [(ratings <= vote).mean()]
-            p_lower += [(ratings >= vote).mean()]
-
-            M_upper = np.prod(1 / (2 * np.array(p_upper)))
-            M_lower = np.prod(1 / (2 * np.array(p_lower)))
-
-            # M_upper = np.prod((1 - c_param) / (c_param * np.array(p_upper) ** c_param))
-            # M_lower = np.prod((1 - c_param) / (c_param * np.array(p_lower) ** c_param))
-            if (M_upper > 1 / alpha) or (M_lower > 1 / alpha):
-                print(f"Identify bad user with {len(p_upper)} votes")
-                flag = True
-                break
-        if flag:
-            bad_user_list.append({"user_id": user, "votes": len(p_upper)})
+        if user in num_votes.index:
+            print(f"Identify bad user with {num_votes[user]} votes")
+            bad_user_list.append({"user_id": user, "votes": int(num_votes[user])})
     print("Bad user length: ", len(bad_user_list))
     print(bad_user_list)
 
@@ -401,29 +541,26 @@ def outlier_detect(
 
 def filter_long_conv(row):
     threshold = 768
-    for conversation_type in ["conversation_a", "conversation_b"]:
-        cur_conv = row[conversation_type]
-        num_tokens_all = sum([turn["num_tokens"] for turn in cur_conv])
+    for side in ["a", "b"]:
+        if f"num_tokens_{side}" in row:
+            # Precomputed by the battle store
+            num_tokens_all = row[f"num_tokens_{side}"]
+        else:
+            cur_conv = row[f"conversation_{side}"]
+            num_tokens_all = sum([turn["num_tokens"] for turn in cur_conv])
         if num_tokens_all >= threshold:
             return True
     return False
 
 
-def report_elo_analysis_results(
-    battles_json,
-    rating_system="bt",
-    num_bootstrap=100,
+def filter_battles(
+    battles,
     exclude_models=[],
     langs=[],
-    exclude_tie=False,
     exclude_unknown_lang=False,
-    daily_vote_per_user=None,
-    run_outlier_detect=False,
-    scale=1,
     filter_func=lambda x: True,
 ):
-    battles = pd.DataFrame(battles_json)
-
+    """Keep the anonymous battles of a category, sorted by time."""
     tqdm.pandas(desc=f"Processing using {filter_func.__name__}")
     filtered_indices = battles.progress_apply(filter_func, axis=1)
     battles = battles[filtered_indices]
@@ -445,6 +582,35 @@ def report_elo_analysis_results(
 
     # Only use anonymous votes
     battles = battles[battles["anony"]].reset_index(drop=True)
+
+    # Drop the filtered out models from the categories of a battle store
+    for column in ["model_a", "model_b"]:
+        if isinstance(battles[column].dtype, pd.CategoricalDtype):
+            battles[column] = battles[column].cat.remove_unused_categories()
+    return battles
+
+
+def report_elo_analysis_results(
+    battles_json,
+    rating_system="bt",
+    num_bootstrap=100,
+    exclude_models=[],
+    langs=[],
+    exclude_tie=False,
+    exclude_unknown_lang=False,
+    daily_vote_per_user=None,
+    run_outlier_detect=False,
+    scale=1,
+    filter_func=lambda x: True,
+    num_cpu=None,
+):
+    battles = filter_battles(
+        pd.DataFrame(battles_json),
+        exclude_models,
+        langs,
+        exclude_unknown_lang,
+        filter_func,
+    )
     battles_no_ties = battles[~battles["winner"].str.contains("tie")]
     if exclude_tie:
         battles = battles_no_ties
@@ -460,11 +626,38 @@ def report_elo_analysis_results(
     # Online update
     elo_rating_online = compute_elo(battles)
 
+    return summarize_elo_analysis_results(
+        battles,
+        battles_no_ties,
+        elo_rating_online,
+        rating_system=rating_system,
+        num_bootstrap=num_bootstrap,
+        scale=scale,
+        num_cpu=num_cpu,
+    )
+
+
+def summarize_elo_analysis_results(
+    battles,
+    battles_no_ties,
+    elo_rating_online,
+    rating_system="bt",
+    num_bootstrap=100,
+    scale=1,
+    num_cpu=None,
+    init_rating=None,
+    last_updated_tstamp=None,
+):
+    """Compute the final ratings, their bootstrap intervals and the plots of
+    the filtered battles."""
     if rating_system == "bt":
-        bootstrap_df = get_bootstrap_result(
-            battles, compute_elo_mle_with_tie, num_round=num_bootstrap
+        bootstrap_df = get_bootstrap_result_bt(
+            battles,
+            num_round=num_bootstrap,
+            num_cpu=num_cpu,
+            init_rating=init_rating,
         )
-        elo_rating_final = compute_elo_mle_with_tie(battles)
+        elo_rating_final = compute_elo_mle_with_tie(battles, init_rating=init_rating)
     elif rating_system == "elo":
         bootstrap_df = get_bootstrap_result(
             battles, compute_elo, num_round=num_bootstrap
@@ -494,9 +687,7 @@ def report_elo_analysis_results(
             "variance": bootstrap_df.var(),
             "rating_q975": bootstrap_df.quantile(0.975),
             "rating_q025": bootstrap_df.quantile(0.025),
-            "num_battles": battles["model_a"]
-            .value_counts()
-            .add(battles["model_b"].value_counts(), fill_value=0),
+            "num_battles": count_battles_per_model(battles),
             "final_ranking": pd.Series(ranking),
         }
     )
@@ -520,7 +711,8 @@ def report_elo_analysis_results(
         bootstrap_df, elo_rating_final, limit_show_number, scale=scale
     )
 
-    last_updated_tstamp = battles["tstamp"].max()
+    if last_updated_tstamp is None:
+        last_updated_tstamp = battles["tstamp"].max()
     last_updated_datetime = datetime.datetime.fromtimestamp(
         last_updated_tstamp, tz=timezone("US/Pacific")
     ).strftime("%Y-%m-%d %H:%M:%S %Z")
@@ -541,6 +733,138 @@ def report_elo_analysis_results(
     }
 
 
+# The battle columns used by the analysis
+ELO_COLUMNS = [
+    "model_a",
+    "model_b",
+    "winner",
+    "judge",
+    "anony",
+    "language",
+    "tstamp",
+    "num_tokens_a",
+    "num_tokens_b",
+]
+
+CATEGORY_FILTERS = {
+    "full": lambda x: True,
+    "long": filter_long_conv,
+    "chinese": lambda x: x["language"] == "Chinese",
+    "english": lambda x: x["language"] == "English",
+}
+
+
+class IncrementalEloAnalysis:
+    """Leaderboard results that are updated from the new battles only.
+
+    The filtered battles of each category are kept as counts per day and
+    (model_a, model_b, winner), which is all the Bradley-Terry fit and the
+    plots need. `update` ingests the battles newer than the last one seen,
+    and `report` warm-starts the fit from the previous ratings. Outlier
+    detection and daily vote limits need every vote, so they are not
+    supported.
+    """
+
+    keys = ["date", "model_a", "model_b", "winner"]
+
+    def __init__(
+        self,
+        categories=["full"],
+        exclude_models=[],
+        langs=[],
+        exclude_tie=False,
+        exclude_unknown_lang=False,
+    ):
+        self.categories = list(categories)
+        self.exclude_models = exclude_models
+        self.langs = langs
+        self.exclude_tie = exclude_tie
+        self.exclude_unknown_lang = exclude_unknown_lang
+
+        self.counts = {
+            cat: pd.DataFrame(columns=self.keys + ["count"]) for cat in categories
+        }
+        self.elo_rating_online = {cat: {} for cat in categories}
+        self.elo_rating_final = {cat: None for cat in categories}
+        self.last_tstamp = None
+
+    def update(self, battles_json):
+        """Ingest the battles newer than the last update. Returns their number."""
+        battles = pd.DataFrame(battles_json)
+        if self.last_tstamp is not None and len(battles) > 0:
+            battles = battles[battles["tstamp"] > self.last_tstamp]
+        if len(battles) == 0:
+            return 0
+
+        for cat in self.categories:
+            new_battles = filter_battles(
+                battles,
+                self.exclude_models,
+                self.langs,
+                self.exclude_unknown_lang,
+                CATEGORY_FILTERS[cat],
+            )
+            if self.exclude_tie:
+                new_battles = new_battles[~new_battles["winner"].str.contains("tie")]
+            self.elo_rating_online[cat] = compute_elo(
+                new_battles, rating=self.elo_rating_online[cat]
+            )
+
+            date = pd.to_datetime(new_battles["tstamp"], unit="s").dt.strftime(
+                "%Y-%m-%d"
+            )
+            new_counts = (
+                new_battles.assign(date=date)[self.keys]
+                .astype(str)
+                .groupby(self.keys)
+                .size()
+            )
+            counts = self.counts[cat].set_index(self.keys)["count"]
+            counts = counts.add(new_counts, fill_value=0).astype(np.int64)
+            self.counts[cat] = counts.rename("count").reset_index()
+
+        self.last_tstamp = battles["tstamp"].max()
+        return len(battles)
+
+    def report(
+        self, category="full", num_bootstrap=100, scale=1, num_cpu=None, start_date=None
+    ):
+        """The results of `report_elo_analysis_results` for the battles
+        ingested so far, or for those since `start_date` (YYYY-MM-DD)."""
+        counts = self.counts[category]
+        if start_date is not None:
+            counts = counts[counts["date"] >= start_date]
+        battles = counts.groupby(self.keys[1:], as_index=False)["count"].sum()
+        battles_no_ties = battles[~battles["winner"].str.contains("tie")]
+        print(f"Number of battles: {battles['count'].sum()}")
+
+        results = summarize_elo_analysis_results(
+            battles,
+            battles_no_ties,
+            dict(self.elo_rating_online[category]),
+            num_bootstrap=num_bootstrap,
+            scale=scale,
+            num_cpu=num_cpu,
+            init_rating=self.elo_rating_final[category],
+            last_updated_tstamp=self.last_tstamp,
+        )
+        self.elo_rating_final[category] = results["elo_rating_final"]
+        return results
+
+    def save(self, filename):
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, "wb") as fout:
+            pickle.dump(self.__dict__, fout)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        analysis = cls.__new__(cls)
+        with open(filename, "rb") as fin:
+            analysis.__dict__.update(pickle.load(fin))
+        return analysis
+
+
 def pretty_print_elo_rating(rating):
     model_order = list(rating.keys())
     model_order.sort(key=lambda k: -rating[k])
@@ -550,7 +874,11 @@ def pretty_print_elo_rating(rating):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--clean-battle-file", type=str)
+    parser.add_argument(
+        "--clean-battle-file",
+        type=str,
+        help="A JSON file of clean_battle_data.py or a battle store directory",
+    )
     parser.add_argument("--max-num-files", type=int)
     parser.add_argument("--num-bootstrap", type=int, default=100)
     parser.add_argument(
@@ -565,44 +893,98 @@ if __name__ == "__main__":
     parser.add_argument("--run-outlier-detect", action="store_true", default=False)
     parser.add_argument("--category", nargs="+", default=["full"])
     parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument(
+        "--num-cpu",
+        type=int,
+        default=None,
+        help="The number of processes for the bootstrap (default: all CPUs).",
+    )
+    parser.add_argument(
+        "--incremental-file",
+        type=str,
+        default=None,
+        help="Keep the aggregated battles in this file and only ingest the battles "
+        "newer than the last run. Only supports the bt rating system.",
+    )
     args = parser.parse_args()
 
     np.random.seed(42)
 
-    if args.clean_battle_file:
-        # Read data from a cleaned battle files
+    assert all(
+        [cat in CATEGORY_FILTERS for cat in args.category]
+    ), f"Invalid category: {args.category}"
+
+    analysis = None
+    if args.incremental_file:
+        if args.rating_system != "bt":
+            parser.error("--incremental-file only supports --rating-system bt")
+        if args.daily_vote_per_user is not None or args.run_outlier_detect:
+            parser.error(
+                "--incremental-file does not support --daily-vote-per-user and "
+                "--run-outlier-detect, which need every vote"
+            )
+        if os.path.exists(args.incremental_file):
+            analysis = IncrementalEloAnalysis.load(args.incremental_file)
+            assert set(args.category) <= set(
+                analysis.categories
+            ), f"{args.incremental_file} only has {analysis.categories}"
+        else:
+            analysis = IncrementalEloAnalysis(
+                args.category,
+                args.exclude_models,
+                args.langs,
+                args.exclude_tie,
+                args.exclude_unknown_lang,
+            )
+
+    if args.clean_battle_file and os.path.isdir(args.clean_battle_file):
+        # Read data from a battle store. Only read the columns and the battles
+        # that the analysis uses.
+        from fastchat.serve.monitor.battle_store import get_dates, load_battles
+
+        start_date = None
+        if analysis is not None and analysis.last_tstamp is not None:
+            start_date = get_dates([analysis.last_tstamp])[0]
+        battles = load_battles(
+            args.clean_battle_file,
+            ELO_COLUMNS,
+            start_date=start_date,
+            exclude_models=args.exclude_models,
+            anony_only=True,
+        )
+    elif args.clean_battle_file:
+        # Read data from a cleaned battle file
         battles = pd.read_json(args.clean_battle_file)
     else:
         # Read data from all log files
         log_files = get_log_files(args.max_num_files)
         battles = clean_battle_data(log_files)
 
-    filter_func_map = {
-        "full": lambda x: True,
-        "long": filter_long_conv,
-        "chinese": lambda x: x["language"] == "Chinese",
-        "english": lambda x: x["language"] == "English",
-    }
-    assert all(
-        [cat in filter_func_map for cat in args.category]
-    ), f"Invalid category: {args.category}"
-
     results = {}
-    for cat in args.category:
-        filter_func = filter_func_map[cat]
-        results[cat] = report_elo_analysis_results(
-            battles,
-            rating_system=args.rating_system,
-            num_bootstrap=args.num_bootstrap,
-            exclude_models=args.exclude_models,
-            langs=args.langs,
-            exclude_tie=args.exclude_tie,
-            exclude_unknown_lang=args.exclude_unknown_lang,
-            daily_vote_per_user=args.daily_vote_per_user,
-            run_outlier_detect=args.run_outlier_detect,
-            scale=args.scale,
-            filter_func=filter_func,
-        )
+    if analysis is not None:
+        print(f"Ingested {analysis.update(battles)} new battles")
+        for cat in args.category:
+            results[cat] = analysis.report(
+                cat, args.num_bootstrap, args.scale, args.num_cpu
+            )
+        analysis.save(args.incremental_file)
+    else:
+        for cat in args.category:
+            filter_func = CATEGORY_FILTERS[cat]
+            results[cat] = report_elo_analysis_results(
+                battles,
+                rating_system=args.rating_system,
+                num_bootstrap=args.num_bootstrap,
+                exclude_models=args.exclude_models,
+                langs=args.langs,
+                exclude_tie=args.exclude_tie,
+                exclude_unknown_lang=args.exclude_unknown_lang,
+                daily_vote_per_user=args.daily_vote_per_user,
+                run_outlier_detect=args.run_outlier_detect,
+                scale=args.scale,
+                filter_func=filter_func,
+                num_cpu=args.num_cpu,
+            )
 
     for cat in args.category:
         print(f"# Results for {cat} conversations")
@@ -21,7 +21,11 @@ import numpy as np
 from fastchat.constants import SURVEY_LINK
 from fastchat.serve.monitor.basic_stats import report_basic_stats, get_log_files
 from fastchat.serve.monitor.clean_battle_data import clean_battle_data
-from fastchat.serve.monitor.elo_analysis import report_elo_analysis_results
+from fastchat.serve.monitor.elo_analysis import (
+    ELO_COLUMNS,
+    IncrementalEloAnalysis,
+    report_elo_analysis_results,
+)
 from fastchat.utils import build_logger, get_window_url_params_js
 
 
@@ -31,6 +35,9 @@ notebook_url = (
 
 basic_component_values = [None] * 6
 leader_component_values = [None] * 5
+incremental_elo = None
+# The byte offsets of the log files read by the incremental leaderboard
+log_offsets = {}
 
 
 def make_default_md_1(mirror=False):
@@ -124,17 +131,53 @@ We prompt GPT-4-Turbo as judge to compare the models' responses against a baseli
 
 
 def update_elo_components(
-    max_num_files, elo_results_file, ban_ip_file, exclude_model_names
+    max_num_files,
+    elo_results_file,
+    ban_ip_file,
+    exclude_model_names,
+    incremental_elo_file=None,
+    battle_store=None,
 ):
+    global incremental_elo
     log_files = get_log_files(max_num_files)
 
     # Leaderboard
     if elo_results_file is None:  # Do live update
-        ban_ip_list = json.load(open(ban_ip_file)) if ban_ip_file else None
-        battles = clean_battle_data(
-            log_files, exclude_model_names, ban_ip_list=ban_ip_list
-        )
-        elo_results = report_elo_analysis_results(battles, scale=2)
+        if incremental_elo_file is not None and incremental_elo is None:
+            if os.path.exists(incremental_elo_file):
+                incremental_elo = IncrementalEloAnalysis.load(incremental_elo_file)
+            else:
+                incremental_elo = IncrementalEloAnalysis()
+
+        if battle_store is not None:
+            from fastchat.serve.monitor.battle_store import get_dates, load_battles
+
+            start_date = None
+            if incremental_elo is not None and incremental_elo.last_tstamp is not None:
+                start_date = get_dates([incremental_elo.last_tstamp])[0]
+            battles = load_battles(
+                battle_store,
+                ELO_COLUMNS,
+                start_date=start_date,
+                exclude_models=exclude_model_names,
+                anony_only=True,
+            )
+        else:
+            ban_ip_list = json.load(open(ban_ip_file)) if ban_ip_file else None
+            # The incremental leaderboard only needs the new log lines
+            battles = clean_battle_data(
+                log_files,
+                exclude_model_names,
+                ban_ip_list=ban_ip_list,
+                offsets=log_offsets if incremental_elo is not None else None,
+            )
+        if incremental_elo_file is None:
+            elo_results = report_elo_analysis_results(battles, scale=2)
+        else:
+            num_new_battles = incremental_elo.update(battles)
+            logger.info(f"Ingested {num_new_battles} new battles")
+            elo_results = incremental_elo.report(scale=2)
+            incremental_elo.save(incremental_elo_file)
 
         leader_component_values[0] = make_leaderboard_md_live(elo_results)
         leader_component_values[1] = elo_results["win_fraction_heatmap"]
@@ -167,12 +210,23 @@ def update_elo_components(
 
 
 def update_worker(
-    max_num_files, interval, elo_results_file, ban_ip_file, exclude_model_names
+    max_num_files,
+    interval,
+    elo_results_file,
+    ban_ip_file,
+    exclude_model_names,
+    incremental_elo_file=None,
+    battle_store=None,
 ):
     while True:
         tic = time.time()
         update_elo_components(
-            max_num_files, elo_results_file, ban_ip_file, exclude_model_names
+            max_num_files,
+            elo_results_file,
+            ban_ip_file,
+            exclude_model_names,
+            incremental_elo_file,
+            battle_store,
         )
         durtaion = time.time() - tic
         print(f"update duration: {durtaion:.2f} s")
@@ -999,6 +1053,18 @@ if __name__ == "__main__":
     parser.add_argument("--exclude-model-names", type=str, nargs="+")
     parser.add_argument("--password", type=str, default=None, nargs="+")
     parser.add_argument("--arena-hard-leaderboard", type=str)
+    parser.add_argument(
+        "--incremental-elo-file",
+        type=str,
+        help="Update the live leaderboard from the new battles only, keeping the "
+        "aggregated battles and ratings in this file between updates.",
+    )
+    parser.add_argument(
+        "--battle-store",
+        type=str,
+        help="Read the battles of the live leaderboard from this battle store "
+        "directory (written by clean_battle_data.py) instead of the logs.",
+    )
     args = parser.parse_args()
 
     logger = build_logger("monitor", "monitor.log")
@@ -1013,6 +1079,8 @@ if __name__ == "__main__":
                 args.elo_results_file,
                 args.ban_ip_file,
                 args.exclude_model_names,
+                args.incremental_elo_file,
+                args.battle_store,
             ),
         )
         update_thread.start()
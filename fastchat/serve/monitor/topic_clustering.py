@@ -6,6 +6,7 @@ python3 topic_clustering.py --in clean_conv_20230809_100k.json --english-only --
 """
 import argparse
 import json
+import os
 import pickle
 import string
 import time
@@ -34,7 +35,13 @@ def read_texts(input_file, min_length, max_length, english_only):
     visited = set()
     texts = []
 
-    lines = json.load(open(input_file, "r"))
+    if os.path.isdir(input_file):
+        # A battle store: only read the prompts
+        from fastchat.serve.monitor.battle_store import load_battles
+
+        lines = load_battles(input_file, ["conversation_a"]).to_dict("records")
+    else:
+        lines = json.load(open(input_file, "r"))
 
     for l in tqdm(lines):
         if "text" in l:
@@ -0,0 +1,312 @@
+"""
+Serve many LoRA adapters of one base model in the same batches.
+
+`LoRARegistry` replaces the targeted linear layers of the base model with
+`MultiLoRALinear` layers. Every such layer holds the A and B matrices of all
+the adapters loaded on the device in slot-indexed tensors padded to a maximum
+rank, with the LoRA scaling folded into B. Slot 0 stays zero and is used by
+rows that request the base model. A forward pass is given the slot of each
+row of the batch and gathers the per-row A/B matrices, so one batch can mix
+requests for different adapters.
+
+The number of slots follows from a memory budget. Adapters are registered by
+name and path, and loaded into a slot when a request needs them. When all the
+slots are taken, the least recently used adapter that no running request uses
+is evicted. Adapters can be registered and unregistered while serving.
+"""
+from collections import OrderedDict
+import contextlib
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "o_proj"]
+
+# A PEFT checkpoint key, e.g.
+# base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight
+LORA_KEY_PATTERN = re.compile(
+    r"^(?:base_model\.model\.)?(.+)\.lora_([AB])(?:\.[^.]+)?\.weight$"
+)
+
+
+class LoRASlotsFull(RuntimeError):
+    """All the slots are used by running requests."""
+
+
+class LoRABatchContext:
+    """The adapter slots of the rows of the batch being run, shared by all the
+    `MultiLoRALinear` layers of a model."""
+
+    def __init__(self):
+        self.slots: Optional[torch.Tensor] = None  # [batch_size]
+        # Set when all the rows use the same slot, which avoids the gather.
+        self.single_slot: Optional[int] = None
+
+
+class MultiLoRALinear(nn.Module):
+    """A linear layer plus a per-row LoRA delta selected by the batch context."""
+
+    def __init__(
+        self, base: nn.Linear, num_slots: int, max_rank: int, context: LoRABatchContext
+    ):
+        super().__init__()
+        self.base = base
+        self.context = context
+        kwargs = {"dtype": base.weight.dtype, "device": base.weight.device}
+        # Slot 0 is the zero adapter.
+        shape_a = (num_slots + 1, max_rank, base.in_features)
+        shape_b = (num_slots + 1, base.out_features, max_rank)
+        self.lora_a = torch.zeros(shape_a, **kwargs)
+        self.lora_b = torch.zeros(shape_b, **kwargs)
+
+    def set_slot(self, slot: int, a: Optional[torch.Tensor], b: Optional[torch.Tensor]):
+        self.lora_a[slot].zero_()
+        self.lora_b[slot].zero_()
+        if a is not None:
+            rank = a.shape[0]
+            self.lora_a[slot, :rank].copy_(a)
+            self.lora_b[slot, :, :rank].copy_(b)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.base(x)
+        context = self.context
+        if context.slots is None:
+            return out
+        if context.single_slot is not None:
+            slot = context.single_slot
+            delta = F.linear(F.linear(x, self.lora_a[slot]), self.lora_b[slot])
+            return out + delta
+        batch_size = context.slots.shape[0]
+        a = self.lora_a.index_select(0, context.slots)  # [batch, rank, in]
+        b = self.lora_b.index_select(0, context.slots)  # [batch, out, rank]
+        x = x.reshape(batch_size, -1, x.shape[-1])
+        delta = torch.bmm(torch.bmm(x, a.transpose(1, 2)), b.transpose(1, 2))
+        return out + delta.view(out.shape)
+
+
+def load_lora_weights(path: str, max_rank: int):
+    """Read a PEFT LoRA checkpoint.
+
+    Return {module name: (A [rank, in], B * scaling [out, rank])}.
+    """
+    with open(os.path.join(path, "adapter_config.json")) as f:
+        config = json.load(f)
+    if config.get("peft_type", "LORA") != "LORA":
+        raise ValueError(f"{path} is not a LoRA adapter: {config['peft_type']}")
+
+    filename = os.path.join(path, "adapter_model.safetensors")
+    if os.path.exists(filename):
+        from safetensors.torch import load_file
+
+        state_dict = load_file(filename)
+    else:
+        state_dict = torch.load(
+            os.path.join(path, "adapter_model.bin"),
+            map_location="cpu",
+            weights_only=True,
+        )
+
+    weights = {}
+    for key, tensor in state_dict.items():
+        m = LORA_KEY_PATTERN.match(key)
+        if m:
+            weights.setdefault(m.group(1), {})[m.group(2)] = tensor
+
+    ret = {}
+    for name, ab in weights.items():
+        a, b = ab["A"], ab["B"]
+        rank = a.shape[0]
+        if rank > max_rank:
+            raise ValueError(
+                f"The rank {rank} of {path} is larger than --lora-max-rank {max_rank}"
+            )
+        alpha = config.get("lora_alpha", rank)
+        if config.get("use_rslora", False):
+            scaling = alpha / rank**0.5
+        else:
+            scaling = alpha / rank
+        ret[name] = (a, b * scaling)
+    return ret
+
+
+def get_lora_target_modules(paths: Sequence[str]) -> List[str]:
+    """The union of the target modules of several adapters."""
+    target_modules = set()
+    for path in paths:
+        with open(os.path.join(path, "adapter_config.json")) as f:
+            config = json.load(f)
+        modules = config.get("target_modules") or []
+        if isinstance(modules, str):
+            modules = [modules]
+        target_modules.update(modules)
+    return sorted(target_modules) or list(DEFAULT_TARGET_MODULES)
+
+
+class LoRARegistry:
+    """The LoRA adapters served on top of one base model."""
+
+    def __init__(
+        self,
+        model: nn.Module,
+        target_modules: Sequence[str],
+        max_rank: int,
+        memory_budget: int,
+    ):
+        """
+        The linear layers of `model` whose name ends with one of
+        `target_modules` are replaced. `memory_budget` is the number of bytes
+        of device memory for the adapter slots.
+        """
+        self.max_rank = max_rank
+        self.context = LoRABatchContext()
+        self.lock = threading.Lock()
+
+        targets = {
+            name: module
+            for name, module in model.named_modules()
+            if isinstance(module, nn.Linear) and name.split(".")[-1] in target_modules
+        }
+        if not targets:
+            raise ValueError(f"The model has no linear layers named {target_modules}")
+        bytes_per_slot = sum(
+            (x.in_features + x.out_features) * max_rank * x.weight.element_size()
+            for x in targets.values()
+        )
+        self.num_slots = max(memory_budget // bytes_per_slot, 1)
+        self.memory_bytes = self.num_slots * bytes_per_slot
+
+        self.layers: Dict[str, MultiLoRALinear] = {}
+        for name, base in targets.items():
+            layer = MultiLoRALinear(base, self.num_slots, max_rank, self.context)
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, layer)
+            self.layers[name] = layer
+
+        self.adapters: Dict[str, str] = {}  # name -> path
+        self.slots = OrderedDict()  # name -> slot, least recently used first
+        self.ref_counts: Dict[str, int] = {}
+        self.free_slots = list(range(self.num_slots, 0, -1))
+        self.num_loads = 0
+
+    def register(self, name: str, path: str):
+        with self.lock:
+            if name in self.ref_counts:
+                raise ValueError(f"The LoRA adapter {name} is used by running requests")
+            if name in self.slots:
+                # Reload the new weights on the next use.
+                self._free(name)
+            self.adapters[name] = path
+
+    def unregister(self, name: str):
+        """Unregister an adapter. Its slot is freed once no request uses it."""
+        with self.lock:
+            self.adapters.pop(name, None)
+            if name in self.slots and self.ref_counts.get(name, 0) == 0:
+                self._free(name)
+
+    def has(self, name: Optional[str]) -> bool:
+        return name in self.adapters
+
+    def acquire(self, name: Optional[str]) -> int:
+        """Return the slot of an adapter, loading it if needed. Slot 0 is the
+        base model, for a name that is not an adapter."""
+        if name is None or name not in self.adapters:
+            return 0
+        with self.lock:
+            if name not in self.slots:
+                if not self.free_slots:
+                    self._evict()
+                slot = self.free_slots.pop()
+                try:
+                    self._load(self.adapters[name], slot)
+                except OSError as e:
+                    self.free_slots.append(slot)
+                    raise ValueError(f"Cannot load the LoRA adapter {name}: {e}")
+                except Exception:
+                    self.free_slots.append(slot)
+                    raise
+                self.slots[name] = slot
+                self.num_loads += 1
+            self.slots.move_to_end(name)
+            self.ref_counts[name] = self.ref_counts.get(name, 0) + 1
+            return self.slots[name]
+
+    def release(self, name: Optional[str]):
+        with self.lock:
+            if name not in self.ref_counts:
+                return
+            self.ref_counts[name] -= 1
+            if self.ref_counts[name] == 0:
+                del self.ref_counts[name]
+                if name not in self.adapters and name in self.slots:
+                    self._free(name)
+
+    def _free(self, name: str):
+        self.free_slots.append(self.slots.pop(name))
+
+    def _evict(self):
+        for name in self.slots:
+            if name not in self.ref_counts:
+                self._free(name)
+                return
+        raise LoRASlotsFull(
+            f"All the {self.num_slots} LoRA slots are used by running requests"
+        )
+
+    @torch.inference_mode()
+    def _load(self, path: str, slot: int):
+        weights = load_lora_weights(path, self.max_rank)
+        unknown = set(weights) - set(self.layers)
+        if unknown:
+            raise ValueError(
+                f"{path} targets modules that are not served with LoRA, such as "
+                f"{sorted(unknown)[0]}. Please set --lora-target-modules."
+            )
+        for name, layer in self.layers.items():
+            a, b = weights.get(name, (None, None))
+            layer.set_slot(slot, a, b)
+
+    @contextlib.contextmanager
+    def activate(self, slots: List[int]):
+        """Run the batch in this context with the given slot for each row."""
+        context = self.context
+        if any(slots):
+            if all(slot == slots[0] for slot in slots):
+                context.single_slot = slots[0]
+            device = next(iter(self.layers.values())).lora_a.device
+            context.slots = torch.as_tensor(slots, device=device)
+        try:
+            yield
+        finally:
+            context.slots = context.single_slot = None
+
+    def wrap_stream(self, output_stream, name: Optional[str]):
+        """Run every step of a one-request generator with the adapter `name`."""
+        slot = self.acquire(name)
+        try:
+            while True:
+                with self.activate([slot]):
+                    try:
+                        output = next(output_stream)
+                    except StopIteration:
+                        return
+                yield output
+        finally:
+            output_stream.close()
+            self.release(name)
+
+    def get_status(self):
+        with self.lock:
+            return {
+                "adapters": sorted(self.adapters),
+                "loaded": list(self.slots),
+                "num_slots": self.num_slots,
+                "num_loads": self.num_loads,
+                "memory_bytes": self.memory_bytes,
+            }
@@ -10,6 +10,10 @@ thus reports the combined queue lengths for health checks.
 
 We recommend using this with multiple Peft models (with `peft` in the name)
 where all Peft models are trained on the exact same base model.
+
+Alternatively, `--lora-adapters` serves LoRA adapters on top of one copy of
+their base model. With `--continuous-batching`, requests for different adapters
+run in the same batches instead of taking turns, see `fastchat.serve.multi_lora`.
 """
 import argparse
 import asyncio
@@ -56,6 +60,11 @@ from fastchat.model.model_codet5p import generate_stream_codet5p
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
+from fastchat.serve.base_model_worker import (
+    create_embedding_response,
+    generate_in_executor,
+    generate_stream_in_executor,
+)
 from fastchat.serve.inference import generate_stream
 from fastchat.serve.model_worker import ModelWorker, worker_id, logger
 from fastchat.utils import build_logger, pretty_print_semaphore, get_context_length
@@ -99,7 +108,7 @@ async def api_generate_stream(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
-    generator = worker.generate_stream_gate(params)
+    generator = generate_stream_in_executor(worker, params)
     background_tasks = create_background_tasks()
     return StreamingResponse(generator, background=background_tasks)
 
@@ -109,8 +118,10 @@ async def api_generate(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
-    output = worker.generate_gate(params)
-    release_worker_semaphore()
+    try:
+        output = await generate_in_executor(worker, params)
+    finally:
+        release_worker_semaphore()
     return JSONResponse(output)
 
 
@@ -119,13 +130,19 @@ async def api_get_embeddings(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
     worker = worker_map[params["model"]]
-    embedding = worker.get_embeddings(params)
+    embedding = await worker.embedding_batcher.submit(params)
     background_tasks = create_background_tasks()
-    return JSONResponse(content=embedding, background=background_tasks)
+    response = create_embedding_response(params, embedding)
+    response.background = background_tasks
+    return response
 
 
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
+    return get_status()
+
+
+def get_status():
     return {
         "model_names": [m for w in workers for m in w.model_names],
         "speed": 1,
@@ -133,11 +150,71 @@ async def api_get_status(request: Request):
     }
 
 
+def register_workers(controller_address: str, no_register: bool):
+    url = controller_address + "/register_worker"
+    data = {
+        "worker_name": workers[0].worker_addr,
+        "check_heart_beat": not no_register,
+        "worker_status": get_status(),
+    }
+    r = requests.post(url, json=data)
+    assert r.status_code == 200
+
+
+@app.post("/worker_load_lora")
+async def api_load_lora(request: Request):
+    """Register a LoRA adapter of the base model `model` under `lora_name`.
+
+    It is loaded on the device by its first request.
+    """
+    params = await request.json()
+    worker = worker_map.get(params["model"])
+    if worker is None or worker.lora_registry is None:
+        return JSONResponse(
+            {"error": f"{params['model']} does not serve LoRA adapters"},
+            status_code=400,
+        )
+    name = params["lora_name"]
+    if name in worker_map and worker_map[name] is not worker:
+        return JSONResponse(
+            {"error": f"{name} is served by another model"}, status_code=400
+        )
+    try:
+        worker.lora_registry.register(name, params["lora_path"])
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    if name not in worker.model_names:
+        worker.model_names = worker.model_names + [name]
+    worker_map[name] = worker
+    if not args.no_register:
+        await asyncio.to_thread(
+            register_workers, args.controller_address, args.no_register
+        )
+    return worker.lora_registry.get_status()
+
+
+@app.post("/worker_unload_lora")
+async def api_unload_lora(request: Request):
+    params = await request.json()
+    name = params["lora_name"]
+    worker = worker_map.get(name)
+    if worker is None or not (worker.lora_registry and worker.lora_registry.has(name)):
+        return JSONResponse({"error": f"{name} is not a LoRA adapter"}, status_code=400)
+    worker.lora_registry.unregister(name)
+    worker.model_names = [m for m in worker.model_names if m != name]
+    del worker_map[name]
+    if not args.no_register:
+        await asyncio.to_thread(
+            register_workers, args.controller_address, args.no_register
+        )
+    return worker.lora_registry.get_status()
+
+
 @app.post("/count_token")
 async def api_count_token(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
-    return worker.count_token(params)
+    return await worker.executor.run_cpu(worker.count_token, params)
 
 
 @app.post("/worker_get_conv_template")
@@ -154,6 +231,13 @@ async def api_model_details(request: Request):
     return {"context_length": worker.context_len}
 
 
+@app.post("/worker_get_model_info")
+async def api_get_model_info(request: Request):
+    params = await request.json()
+    worker = worker_map[params["model"]]
+    return await worker.executor.run_cpu(worker.get_model_info, params)
+
+
 def create_multi_model_worker():
     # Note: Ensure we resolve arg conflicts.  We let `add_model_args` add MOST
     # of the model args but we'll override one to have an append action that
@@ -187,6 +271,41 @@ def create_multi_model_worker():
         action="append",
         help="Conversation prompt template. Values must be aligned with `--model-path` values. If only one value is provided, it will be repeated for all models.",
     )
+    parser.add_argument(
+        "--lora-adapters",
+        type=lambda s: None if s == "none" else [x for x in s.split(",") if x],
+        action="append",
+        help="LoRA adapters served in the same batches as their base model, as comma separated name=path pairs. Values must be aligned with `--model-path` values. Use '' to serve only adapters loaded later with /worker_load_lora, and 'none' to serve a model without adapters. Use with --continuous-batching to batch requests for different adapters together.",
+    )
+    parser.add_argument(
+        "--lora-target-modules",
+        type=lambda s: s.split(","),
+        default=None,
+        help="Comma separated names of the linear layers that LoRA adapters may target. Defaults to the targets of the adapters given at startup.",
+    )
+    parser.add_argument(
+        "--lora-max-rank",
+        type=int,
+        default=64,
+        help="The maximum rank of the LoRA adapters.",
+    )
+    parser.add_argument(
+        "--lora-memory-gb",
+        type=float,
+        default=1.0,
+        help="The device memory for the LoRA adapters of each base model. Least recently used adapters are evicted when it is full.",
+    )
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Merge concurrent requests into one batched forward pass per decoding step.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=16,
+        help="Used for continuous batching. The maximum number of requests decoded together.",
+    )
     parser.add_argument("--limit-worker-concurrency", type=int, default=5)
     parser.add_argument("--stream-interval", type=int, default=2)
     parser.add_argument("--no-register", action="store_true")
@@ -240,10 +359,23 @@ def create_multi_model_worker():
     elif len(args.conv_template) == 1:  # Repeat the same template
         args.conv_template = args.conv_template * len(args.model_path)
 
+    if args.lora_adapters is None:
+        args.lora_adapters = [None] * len(args.model_path)
+    else:
+        assert len(args.lora_adapters) == len(args.model_path), (
+            f"Got {len(args.lora_adapters)} --lora-adapters values for "
+            f"{len(args.model_path)} --model-path values. Pass one value per model, "
+            "'' for adapters loaded later with /worker_load_lora only and 'none' "
+            "for a model without adapters."
+        )
+        args.lora_adapters = [
+            None if adapters is None else dict(x.split("=", 1) for x in adapters)
+            for adapters in args.lora_adapters
+        ]
+
     # Launch all workers
-    workers = []
-    for conv_template, model_path, model_names in zip(
-        args.conv_template, args.model_path, args.model_names
+    for conv_template, model_path, model_names, lora_adapters in zip(
+        args.conv_template, args.model_path, args.model_names, args.lora_adapters
     ):
         w = ModelWorker(
             args.controller_address,
@@ -263,24 +395,21 @@ def create_multi_model_worker():
             xft_config=xft_config,
             stream_interval=args.stream_interval,
             conv_template=conv_template,
+            mmap_weights=args.mmap_weights,
+            weight_store_dir=args.weight_store_dir,
+            lora_adapters=lora_adapters,
+            lora_target_modules=args.lora_target_modules,
+            lora_max_rank=args.lora_max_rank,
+            lora_memory_gb=args.lora_memory_gb,
+            continuous_batching=args.continuous_batching,
+            max_batch_size=args.max_batch_size,
         )
         workers.append(w)
-        for model_name in model_names:
+        for model_name in w.model_names:
             worker_map[model_name] = w
 
     # Register all models
-    url = args.controller_address + "/register_worker"
-    data = {
-        "worker_name": workers[0].worker_addr,
-        "check_heart_beat": not args.no_register,
-        "worker_status": {
-            "model_names": [m for w in workers for m in w.model_names],
-            "speed": 1,
-            "queue_length": sum([w.get_queue_length() for w in workers]),
-        },
-    }
-    r = requests.post(url, json=data)
-    assert r.status_code == 200
+    register_workers(args.controller_address, args.no_register)
 
     return args, workers
 
@@ -9,19 +9,22 @@ python3 -m fastchat.serve.openai_api_server
 """
 import asyncio
 import argparse
+import base64
+import collections
+import dataclasses
 import json
 import os
+import time
 from typing import Generator, Optional, Union, Dict, List, Any
 
 import aiohttp
 import fastapi
-from fastapi import Depends, HTTPException
+from fastapi import BackgroundTasks, Depends, HTTPException
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
-import httpx
-
+import numpy as np
 from pydantic_settings import BaseSettings
 import shortuuid
 import tiktoken
@@ -33,6 +36,8 @@ from fastchat.constants import (
     ErrorCode,
 )
 from fastchat.conversation import Conversation, SeparatorStyle
+from fastchat.serve.dispatch import DispatchMethod, dispatch_worker
+from fastchat.serve.embedding_cache import EmbeddingCache
 from fastchat.protocol.openai_api_protocol import (
     ChatCompletionRequest,
     ChatCompletionResponse,
@@ -61,29 +66,48 @@ from fastchat.protocol.api_protocol import (
     APITokenCheckResponse,
     APITokenCheckResponseItem,
 )
-from fastchat.utils import build_logger
+from fastchat.utils import StreamDeltaDecoder, build_logger, decode_embedding_buffer
 
 logger = build_logger("openai_api_server", "openai_api_server.log")
 
-conv_template_map = {}
+# (worker_addr, model_name) -> {"context_length": ..., "conv": ...}
+model_info_map = {}
+# Workers without the /worker_get_model_info endpoint
+legacy_workers = set()
 
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
+stream_timeout = aiohttp.ClientTimeout(
+    total=None, sock_connect=WORKER_API_TIMEOUT, sock_read=WORKER_API_TIMEOUT
+)
+session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Get the HTTP session shared by all requests.
+
+    Its connection pool keeps the connections to the controller and each worker
+    alive, so requests do not pay for a new TCP handshake every time.
+    """
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=60)
+        session = aiohttp.ClientSession(timeout=fetch_timeout, connector=connector)
+    return session
 
 
 async def fetch_remote(url, pload=None, name=None):
-    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
-        async with session.post(url, json=pload) as response:
-            chunks = []
-            if response.status != 200:
-                ret = {
-                    "text": f"{response.reason}",
-                    "error_code": ErrorCode.INTERNAL_ERROR,
-                }
-                return json.dumps(ret)
-
-            async for chunk, _ in response.content.iter_chunks():
-                chunks.append(chunk)
-        output = b"".join(chunks)
+    async with get_session().post(url, json=pload) as response:
+        chunks = []
+        if response.status != 200:
+            ret = {
+                "text": f"{response.reason}",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+            return json.dumps(ret)
+
+        async for chunk, _ in response.content.iter_chunks():
+            chunks.append(chunk)
+    output = b"".join(chunks)
 
     if name is not None:
         res = json.loads(output)
@@ -98,6 +122,13 @@ class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # Refresh the local routing table in the background after this many seconds.
+    # Set to 0 to ask the controller for a worker on every request instead.
+    routing_refresh_interval: float = 5.0
+    # Refresh the routing table before dispatching if it is older than this.
+    routing_max_staleness: float = 60.0
+    # Do not dispatch to a worker for this many seconds after a request to it failed.
+    routing_error_backoff: float = 30.0
 
 
 app_settings = AppSettings()
@@ -106,6 +137,132 @@ headers = {"User-Agent": "FastChat API Server"}
 get_bearer_token = HTTPBearer(auto_error=False)
 
 
+@dataclasses.dataclass
+class WorkerRoute:
+    model_names: List[str]
+    speed: int
+    queue_length: int
+    in_flight: int = 0
+    tokens_per_second: float = 0.0
+    kv_cache_occupancy: float = 0.0
+
+
+class WorkerRoutingTable:
+    """
+    A local copy of the worker table of the controller.
+
+    Requests are dispatched locally with the dispatch method of the controller,
+    so the controller is not in the path of every request. The table is pulled
+    in the background every `routing_refresh_interval` seconds and before
+    dispatching if it is older than `routing_max_staleness` seconds. Workers that
+    fail a request are skipped for `routing_error_backoff` seconds.
+
+    For dispatch methods that track requests in flight, the requests this server
+    dispatched and has not released yet are added to the counts of the controller.
+    """
+
+    def __init__(self):
+        self.workers: Dict[str, WorkerRoute] = {}
+        self.dispatch_method = None
+        self.last_refresh = -float("inf")
+        self.refresh_task = None
+        self.lock = asyncio.Lock()
+        self.failed_workers = {}  # worker name -> time of the last error
+        self.local_in_flight = collections.Counter()
+        self.supported = True  # Whether the controller has /list_workers
+
+    async def refresh(self):
+        async with self.lock:
+            age = time.monotonic() - self.last_refresh
+            if age < app_settings.routing_refresh_interval:
+                return  # Refreshed by another request
+
+            controller_address = app_settings.controller_address
+            async with get_session().post(
+                controller_address + "/list_workers"
+            ) as response:
+                if response.status == 404:
+                    logger.info("The controller does not support /list_workers")
+                    self.supported = False
+                    return
+                response.raise_for_status()
+                ret = await response.json()
+
+            self.dispatch_method = DispatchMethod.from_str(ret["dispatch_method"])
+            self.workers = {
+                w_name: WorkerRoute(
+                    w_info["model_names"],
+                    w_info["speed"],
+                    w_info["queue_length"],
+                    w_info.get("in_flight", 0) + self.local_in_flight[w_name],
+                    w_info.get("tokens_per_second", 0.0),
+                    w_info.get("kv_cache_occupancy", 0.0),
+                )
+                for w_name, w_info in ret["workers"].items()
+            }
+            self.last_refresh = time.monotonic()
+
+    async def background_refresh(self):
+        try:
+            await self.refresh()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Refresh routing table fails: {e}")
+
+    async def get_worker_address(self, model_name: str) -> str:
+        """Dispatch locally. Return "" if the controller has to be asked instead."""
+        age = time.monotonic() - self.last_refresh
+        if age > app_settings.routing_max_staleness:
+            await self.background_refresh()
+        elif age > app_settings.routing_refresh_interval and (
+            self.refresh_task is None or self.refresh_task.done()
+        ):
+            self.refresh_task = asyncio.create_task(self.background_refresh())
+
+        if (
+            not self.supported
+            or time.monotonic() - self.last_refresh > app_settings.routing_max_staleness
+        ):
+            return ""
+
+        expire = time.monotonic() - app_settings.routing_error_backoff
+        workers = {
+            w_name: w_info
+            for w_name, w_info in self.workers.items()
+            if self.failed_workers.get(w_name, expire) <= expire
+        }
+        w_name = dispatch_worker(workers, model_name, self.dispatch_method)
+        if w_name and self.dispatch_method.tracks_in_flight:
+            self.local_in_flight[w_name] += 1
+        return w_name
+
+    def release_worker(self, worker_addr: str):
+        if self.local_in_flight[worker_addr] > 0:
+            self.local_in_flight[worker_addr] -= 1
+            if worker_addr in self.workers:
+                w_info = self.workers[worker_addr]
+                w_info.in_flight = max(w_info.in_flight - 1, 0)
+
+    def invalidate_worker(self, worker_addr: str):
+        logger.info(f"Skip worker after an error: {worker_addr}")
+        self.failed_workers[worker_addr] = time.monotonic()
+
+
+worker_routing_table = WorkerRoutingTable()
+# Requests dispatched by the controller that it needs to be notified of on completion
+controller_in_flight = collections.Counter()
+background_tasks = set()
+
+embedding_cache: Optional[EmbeddingCache] = None
+# model name -> whether its workers truncate the embedding inputs, as last reported
+embedding_truncation = {}
+
+
+@app.on_event("shutdown")
+async def close_session():
+    if session is not None:
+        await session.close()
+
+
 async def check_api_key(
     auth: Optional[HTTPAuthorizationCredentials] = Depends(get_bearer_token),
 ) -> str:
@@ -158,14 +315,9 @@ async def check_length(request, prompt, max_tokens, worker_addr):
     ):  # model worker not support max_tokens=None
         max_tokens = 1024 * 1024
 
-    context_len = await fetch_remote(
-        worker_addr + "/model_details", {"model": request.model}, "context_length"
-    )
-    token_num = await fetch_remote(
-        worker_addr + "/count_token",
-        {"model": request.model, "prompt": prompt},
-        "count",
-    )
+    model_info = await get_model_info(request.model, worker_addr, prompt)
+    context_len = model_info["context_length"]
+    token_num = model_info["count"]
     length = min(max_tokens, context_len - token_num)
 
     if length <= 0:
@@ -372,10 +524,18 @@ async def get_worker_address(model_name: str) -> str:
     :return: Worker address from the controller
     :raises: :class:`ValueError`: No available worker for requested model
     """
-    controller_address = app_settings.controller_address
-    worker_addr = await fetch_remote(
-        controller_address + "/get_worker_address", {"model": model_name}, "address"
-    )
+    worker_addr = ""
+    if app_settings.routing_refresh_interval > 0:
+        worker_addr = await worker_routing_table.get_worker_address(model_name)
+
+    if worker_addr == "":
+        controller_address = app_settings.controller_address
+        ret = await fetch_remote(
+            controller_address + "/get_worker_address", {"model": model_name}, ""
+        )
+        worker_addr = ret["address"]
+        if worker_addr and ret.get("track_in_flight", False):
+            controller_in_flight[worker_addr] += 1
 
     # No available worker
     if worker_addr == "":
@@ -384,14 +544,75 @@ async def get_worker_address(model_name: str) -> str:
     return worker_addr
 
 
-async def get_conv(model_name: str, worker_addr: str):
-    conv_template = conv_template_map.get((worker_addr, model_name))
-    if conv_template is None:
-        conv_template = await fetch_remote(
-            worker_addr + "/worker_get_conv_template", {"model": model_name}, "conv"
+async def release_worker_address(worker_addr: str):
+    """Notify that a request dispatched by `get_worker_address` completed."""
+    if controller_in_flight[worker_addr] > 0:
+        controller_in_flight[worker_addr] -= 1
+        controller_address = app_settings.controller_address
+        # Do not make the client wait for the notification.
+        task = asyncio.create_task(
+            fetch_remote(
+                controller_address + "/release_worker_address",
+                {"address": worker_addr},
+            )
         )
-        conv_template_map[(worker_addr, model_name)] = conv_template
-    return conv_template
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    else:
+        worker_routing_table.release_worker(worker_addr)
+
+
+async def get_model_info(
+    model_name: str, worker_addr: str, prompt: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Get the context length and conv template of a model, and the token count of
+    `prompt` if given, from a worker in one call.
+    """
+    pload = {"model": model_name}
+    if prompt is not None:
+        pload["prompt"] = prompt
+
+    model_info = None
+    if worker_addr not in legacy_workers:
+        try:
+            async with get_session().post(
+                worker_addr + "/worker_get_model_info", json=pload
+            ) as response:
+                if response.status == 404:
+                    legacy_workers.add(worker_addr)
+                else:
+                    response.raise_for_status()
+                    model_info = await response.json()
+        except aiohttp.ClientConnectionError:
+            worker_routing_table.invalidate_worker(worker_addr)
+            raise
+
+    if model_info is None:
+        # Fall back to one call per item for workers without the endpoint.
+        tasks = [
+            fetch_remote(worker_addr + "/model_details", pload, "context_length"),
+            fetch_remote(worker_addr + "/worker_get_conv_template", pload, "conv"),
+        ]
+        if prompt is not None:
+            tasks.append(fetch_remote(worker_addr + "/count_token", pload, "count"))
+        results = await asyncio.gather(*tasks)
+        model_info = {"context_length": results[0], "conv": results[1]}
+        if prompt is not None:
+            model_info["count"] = results[2]
+
+    model_info_map[(worker_addr, model_name)] = {
+        "context_length": model_info["context_length"],
+        "conv": model_info["conv"],
+    }
+    return model_info
+
+
+async def get_conv(model_name: str, worker_addr: str):
+    model_info = model_info_map.get((worker_addr, model_name))
+    if model_info is None:
+        model_info = await get_model_info(model_name, worker_addr)
+    return model_info["conv"]
 
 
 @app.get("/v1/models", dependencies=[Depends(check_api_key)])
@@ -409,7 +630,9 @@ async def show_available_models():
 
 
 @app.post("/v1/chat/completions", dependencies=[Depends(check_api_key)])
-async def create_chat_completion(request: ChatCompletionRequest):
+async def create_chat_completion(
+    request: ChatCompletionRequest, tasks: BackgroundTasks
+):
     """Creates a completion for the chat message"""
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
@@ -419,6 +642,8 @@ async def create_chat_completion(request: ChatCompletionRequest):
         return error_check_ret
 
     worker_addr = await get_worker_address(request.model)
+    # Runs after the response (or the whole stream) is sent
+    tasks.add_task(release_worker_address, worker_addr)
 
     gen_params = await get_gen_params(
         request.model,
@@ -504,19 +729,12 @@ async def chat_completion_stream_generator(
         )
         yield f"data: {chunk.model_dump_json(exclude_unset=True)}\n\n"
 
-        previous_text = ""
         async for content in generate_completion_stream(gen_params, worker_addr):
             if content["error_code"] != 0:
                 yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
                 yield "data: [DONE]\n\n"
                 return
-            decoded_unicode = content["text"].replace("\ufffd", "")
-            delta_text = decoded_unicode[len(previous_text) :]
-            previous_text = (
-                decoded_unicode
-                if len(decoded_unicode) > len(previous_text)
-                else previous_text
-            )
+            delta_text = content["text"].replace("\ufffd", "")
 
             if len(delta_text) == 0:
                 delta_text = None
@@ -540,7 +758,7 @@ async def chat_completion_stream_generator(
 
 
 @app.post("/v1/completions", dependencies=[Depends(check_api_key)])
-async def create_completion(request: CompletionRequest):
+async def create_completion(request: CompletionRequest, tasks: BackgroundTasks):
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
         return error_check_ret
@@ -551,6 +769,7 @@ async def create_completion(request: CompletionRequest):
     request.prompt = process_input(request.model, request.prompt)
 
     worker_addr = await get_worker_address(request.model)
+    tasks.add_task(release_worker_address, worker_addr)
     for text in request.prompt:
         max_tokens, error_check_ret = await check_length(
             request, text, request.max_tokens, worker_addr
@@ -626,7 +845,6 @@ async def generate_completion_stream_generator(
     finish_stream_events = []
     for text in request.prompt:
         for i in range(n):
-            previous_text = ""
             gen_params = await get_gen_params(
                 request.model,
                 worker_addr,
@@ -646,13 +864,7 @@ async def generate_completion_stream_generator(
                     yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
                     yield "data: [DONE]\n\n"
                     return
-                decoded_unicode = content["text"].replace("\ufffd", "")
-                delta_text = decoded_unicode[len(previous_text) :]
-                previous_text = (
-                    decoded_unicode
-                    if len(decoded_unicode) > len(previous_text)
-                    else previous_text
-                )
+                delta_text = content["text"].replace("\ufffd", "")
                 # todo: index is not apparent
                 choice_data = CompletionResponseStreamChoice(
                     index=i,
@@ -678,29 +890,40 @@ async def generate_completion_stream_generator(
 
 
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
+    """Stream the new text (and logprobs) of each chunk generated by a worker.
+
+    Workers that support it only send the new text of each chunk ("stream_delta").
+    Other workers send the full text, which is turned into deltas here.
+    """
+    payload = dict(payload, stream_delta=True)
+    delta_decoder = StreamDeltaDecoder()
+    delimiter = b"\0"
+    try:
+        async with get_session().post(
             worker_addr + "/worker_generate_stream",
             headers=headers,
             json=payload,
-            timeout=WORKER_API_TIMEOUT,
+            timeout=stream_timeout,
         ) as response:
-            # content = await response.aread()
             buffer = b""
-            async for raw_chunk in response.aiter_raw():
+            async for raw_chunk in response.content.iter_any():
                 buffer += raw_chunk
                 while (chunk_end := buffer.find(delimiter)) >= 0:
                     chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
                     if not chunk:
                         continue
-                    yield json.loads(chunk.decode())
+                    yield delta_decoder.decode(json.loads(chunk.decode()))
+    except aiohttp.ClientConnectionError:
+        worker_routing_table.invalidate_worker(worker_addr)
+        raise
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
-    return await fetch_remote(worker_addr + "/worker_generate", payload, "")
+    try:
+        return await fetch_remote(worker_addr + "/worker_generate", payload, "")
+    except aiohttp.ClientConnectionError:
+        worker_routing_table.invalidate_worker(worker_addr)
+        raise
 
 
 @app.post("/v1/embeddings", dependencies=[Depends(check_api_key)])
@@ -714,6 +937,8 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
         return error_check_ret
 
     request.input = process_input(request.model, request.input)
+    if embedding_cache is not None:
+        return await create_embeddings_with_cache(request)
 
     data = []
     token_num = 0
@@ -723,18 +948,14 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
         for i in range(0, len(request.input), batch_size)
     ]
     for num_batch, batch in enumerate(batches):
-        payload = {
-            "model": request.model,
-            "input": batch,
-            "encoding_format": request.encoding_format,
-        }
+        payload = {"model": request.model, "input": batch}
         embedding = await get_embedding(payload)
         if "error_code" in embedding and embedding["error_code"] != 0:
             return create_error_response(embedding["error_code"], embedding["text"])
         data += [
             {
                 "object": "embedding",
-                "embedding": emb,
+                "embedding": encode_embedding(emb, request.encoding_format),
                 "index": num_batch * batch_size + i,
             }
             for i, emb in enumerate(embedding["embedding"])
@@ -751,13 +972,80 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
     ).model_dump(exclude_none=True)
 
 
+def encode_embedding(vector: np.ndarray, encoding_format: Optional[str]):
+    if encoding_format == "base64":
+        return base64.b64encode(vector.astype("<f4").tobytes()).decode("utf-8")
+    return vector.tolist()
+
+
+async def create_embeddings_with_cache(request: EmbeddingsRequest):
+    """Creates embeddings for the text, sending only the cache misses to workers"""
+    truncation = embedding_truncation.get(request.model)
+    cached = embedding_cache.get(request.model, truncation, request.input)
+    vectors = [result[0] if result is not None else None for result in cached]
+    token_num = sum(result[1] for result in cached if result is not None)
+
+    # Embed each distinct missing text once.
+    misses = collections.defaultdict(list)  # text -> indices in the input
+    for i, result in enumerate(cached):
+        if result is None:
+            misses[request.input[i]].append(i)
+    missed_texts = list(misses)
+    batch_size = WORKER_API_EMBEDDING_BATCH_SIZE
+    for start in range(0, len(missed_texts), batch_size):
+        texts = missed_texts[start : start + batch_size]
+        embedding = await get_embedding({"model": request.model, "input": texts})
+        if "error_code" in embedding and embedding["error_code"] != 0:
+            return create_error_response(embedding["error_code"], embedding["text"])
+        batch_vectors = embedding["embedding"].astype(np.float32)
+        for text, vector in zip(texts, batch_vectors):
+            for i in misses[text]:
+                vectors[i] = vector
+
+        # The usage of a cache hit needs the token count of each input.
+        token_nums = embedding.get("token_nums")
+        if token_nums is None and len(texts) == 1:
+            token_nums = [embedding["token_num"]]
+        if token_nums is None:
+            token_num += embedding["token_num"]
+        else:
+            token_num += sum(n * len(misses[t]) for t, n in zip(texts, token_nums))
+            truncation = embedding.get("embed_in_truncate", False)
+            embedding_truncation[request.model] = truncation
+            embedding_cache.put(
+                request.model, truncation, texts, batch_vectors, token_nums
+            )
+
+    return EmbeddingsResponse(
+        data=[
+            {
+                "object": "embedding",
+                "embedding": encode_embedding(vector, request.encoding_format),
+                "index": i,
+            }
+            for i, vector in enumerate(vectors)
+        ],
+        model=request.model,
+        usage=UsageInfo(
+            prompt_tokens=token_num,
+            total_tokens=token_num,
+            completion_tokens=None,
+        ),
+    ).model_dump(exclude_none=True)
+
+
 async def get_embedding(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
+    """Get the embeddings from a worker as a NumPy array in "embedding"."""
     model_name = payload["model"]
     worker_addr = await get_worker_address(model_name)
 
-    embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
-    return json.loads(embedding)
+    # Ask for one binary buffer instead of JSON lists of floats.
+    payload = dict(payload, encoding_format="binary")
+    try:
+        embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
+    finally:
+        await release_worker_address(worker_addr)
+    return decode_embedding_buffer(embedding)
 
 
 ### GENERAL API - NOT OPENAI COMPATIBLE ###
@@ -772,18 +1060,12 @@ async def count_tokens(request: APITokenCheckRequest):
     checkedList = []
     for item in request.prompts:
         worker_addr = await get_worker_address(item.model)
-
-        context_len = await fetch_remote(
-            worker_addr + "/model_details",
-            {"prompt": item.prompt, "model": item.model},
-            "context_length",
-        )
-
-        token_num = await fetch_remote(
-            worker_addr + "/count_token",
-            {"prompt": item.prompt, "model": item.model},
-            "count",
-        )
+        try:
+            model_info = await get_model_info(item.model, worker_addr, item.prompt)
+        finally:
+            await release_worker_address(worker_addr)
+        context_len = model_info["context_length"]
+        token_num = model_info["count"]
 
         can_fit = True
         if token_num + item.max_tokens > context_len:
@@ -798,8 +1080,21 @@ async def count_tokens(request: APITokenCheckRequest):
     return APITokenCheckResponse(prompts=checkedList)
 
 
+@app.get("/api/v1/embedding_cache", dependencies=[Depends(check_api_key)])
+async def get_embedding_cache_status():
+    """
+    Reports the hit rate and the bytes saved by the embedding cache.
+    This is not part of the OpenAI API spec.
+    """
+    if embedding_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **embedding_cache.get_status()}
+
+
 @app.post("/api/v1/chat/completions")
-async def create_chat_completion(request: APIChatCompletionRequest):
+async def create_chat_completion(
+    request: APIChatCompletionRequest, tasks: BackgroundTasks
+):
     """Creates a completion for the chat message"""
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
@@ -809,6 +1104,7 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         return error_check_ret
 
     worker_addr = await get_worker_address(request.model)
+    tasks.add_task(release_worker_address, worker_addr)
 
     gen_params = await get_gen_params(
         request.model,
@@ -908,6 +1204,47 @@ def create_openai_api_server():
         default=False,
         help="Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.",
     )
+    parser.add_argument(
+        "--routing-refresh-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between pulls of the worker table from the controller, "
+        "which is used to dispatch requests locally. "
+        "Set to 0 to ask the controller on every request.",
+    )
+    parser.add_argument(
+        "--routing-max-staleness",
+        type=float,
+        default=60.0,
+        help="Pull the worker table before dispatching if it is older than this.",
+    )
+    parser.add_argument(
+        "--embedding-cache-memory-mb",
+        type=float,
+        default=0,
+        help="Cache embeddings by (model, truncation mode, text hash) in an "
+        "in-memory LRU of this size, so only cache misses reach the workers.",
+    )
+    parser.add_argument(
+        "--embedding-cache-dir",
+        type=str,
+        default=None,
+        help="Also cache embeddings in memory-mapped files in this directory, "
+        "which persist across restarts.",
+    )
+    parser.add_argument(
+        "--embedding-cache-dtype",
+        type=str,
+        default="float32",
+        choices=["float32", "float16"],
+        help="The dtype of the cached embeddings. float16 halves the cache size.",
+    )
+    parser.add_argument(
+        "--embedding-cache-max-disk-gb",
+        type=float,
+        default=None,
+        help="Stop adding embeddings to a cache file larger than this.",
+    )
     args = parser.parse_args()
 
     app.add_middleware(
@@ -919,6 +1256,20 @@ def create_openai_api_server():
     )
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
+    app_settings.routing_refresh_interval = args.routing_refresh_interval
+    app_settings.routing_max_staleness = args.routing_max_staleness
+
+    if args.embedding_cache_memory_mb > 0 or args.embedding_cache_dir is not None:
+        global embedding_cache
+        embedding_cache = EmbeddingCache(
+            int(args.embedding_cache_memory_mb * 2**20),
+            args.embedding_cache_dir,
+            args.embedding_cache_dtype,
+            int(args.embedding_cache_max_disk_gb * 2**30)
+            if args.embedding_cache_max_disk_gb is not None
+            else None,
+        )
+        logger.info(f"Embedding cache: {embedding_cache.get_status()}")
 
     logger.info(f"args: {args}")
     return args
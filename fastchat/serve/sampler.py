@@ -0,0 +1,233 @@
+"""
+Batched sampling for the huggingface/transformers model workers.
+
+`BatchSampler` applies temperature, repetition penalty, top-p and top-k to the
+logits of a whole batch with per-row parameters and samples the next token of
+every row in a few tensor ops, instead of one `LogitsProcessorList` call per
+request. The processing order and semantics follow the transformers processors
+(temperature, repetition penalty, top-p, top-k) that `generate_stream` used.
+The tokens each row has seen are kept on the device as a boolean mask, so the
+repetition penalty does not copy the whole output to the device at every step.
+Logprobs of the sampled tokens and the top-N alternatives come from a single
+log-softmax of the raw logits.
+"""
+import dataclasses
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+
+@dataclasses.dataclass
+class SamplerOutput:
+    # The sampled token ids of each row. The first one is the next token, the
+    # others are fallbacks drawn without replacement.
+    tokens: List[List[int]]
+    # The logprob of the next token of each row, None if the row has no logprobs.
+    token_logprobs: List[Optional[float]]
+    # The top-N {token id: logprob} of each row, None if the row has no logprobs.
+    top_logprobs: List[Optional[Dict[int, float]]]
+
+
+class BatchSampler:
+    """Sample the next tokens of a batch of requests with per-row parameters.
+
+    Rows are added and removed together with the rows of the batch they sample
+    for, see `select` and `concat`.
+    """
+
+    def __init__(
+        self,
+        temperature: Sequence[float],
+        repetition_penalty: Sequence[float],
+        top_p: Sequence[float],
+        top_k: Sequence[int],
+        logprobs: Sequence[Optional[int]],
+        token_ids: Sequence[Sequence[int]],
+        vocab_size: int,
+        device,
+    ):
+        """
+        `logprobs` is the number of top alternatives to return for each row, or
+        None for rows that do not need logprobs. `token_ids` holds the tokens
+        each row has already seen, used by the repetition penalty.
+        """
+        kwargs = {"dtype": torch.float32, "device": device}
+        self.temperature = torch.tensor(temperature, **kwargs)
+        self.repetition_penalty = torch.tensor(repetition_penalty, **kwargs)
+        self.top_p = torch.tensor(top_p, **kwargs)
+        self.top_k = torch.tensor(top_k, dtype=torch.long, device=device)
+        self.logprobs = list(logprobs)
+        self.vocab_size = vocab_size
+        self.device = device
+
+        self.seen = torch.zeros(
+            (len(token_ids), vocab_size), dtype=torch.bool, device=device
+        )
+        for i, ids in enumerate(token_ids):
+            self.reset_history(i, ids)
+        self._update_flags()
+
+    def _update_flags(self):
+        # Rows are greedy like in `generate_stream`. A parameter outside of these
+        # ranges is a no-op, like in the transformers processors.
+        self.greedy = (self.temperature < 1e-5) | (self.top_p < 1e-8)
+        self.temperature_mask = (self.temperature >= 1e-5) & (self.temperature != 1.0)
+        self.penalty_mask = self.repetition_penalty > 1.0
+        self.top_p_mask = (self.top_p >= 1e-8) & (self.top_p < 1.0)
+        self.top_k_mask = self.top_k > 0
+
+        # Skip the ops that no row needs with a single device sync.
+        flags = torch.stack(
+            [
+                self.greedy.all(),
+                self.temperature_mask.any(),
+                self.penalty_mask.any(),
+                self.top_p_mask.any(),
+                self.top_k_mask.any(),
+            ]
+        ).tolist()
+        (
+            self.all_greedy,
+            self.use_temperature,
+            self.use_penalty,
+            self.use_top_p,
+            self.use_top_k,
+        ) = flags
+
+    def __len__(self):
+        return len(self.logprobs)
+
+    def reset_history(self, row: int, token_ids: Sequence[int]):
+        """Replace the tokens seen by a row."""
+        self.seen[row] = False
+        if len(token_ids) > 0:
+            index = torch.as_tensor(token_ids, dtype=torch.long, device=self.device)
+            self.seen[row, index] = True
+
+    def append(self, tokens: torch.Tensor):
+        """Mark the next token of each row ([batch_size] tensor) as seen."""
+        self.seen.scatter_(1, tokens.view(-1, 1).to(self.device), True)
+
+    def select(self, index: List[int]) -> "BatchSampler":
+        """Keep only the rows in `index`, in that order."""
+        index_tensor = torch.as_tensor(index, dtype=torch.long, device=self.device)
+        for name in ("temperature", "repetition_penalty", "top_p", "top_k", "seen"):
+            setattr(self, name, getattr(self, name).index_select(0, index_tensor))
+        self.logprobs = [self.logprobs[i] for i in index]
+        self._update_flags()
+        return self
+
+    @classmethod
+    def concat(cls, samplers: List["BatchSampler"]) -> "BatchSampler":
+        """Stack the rows of several samplers into one."""
+        new = cls.__new__(cls)
+        for name in ("temperature", "repetition_penalty", "top_p", "top_k", "seen"):
+            setattr(new, name, torch.cat([getattr(s, name) for s in samplers]))
+        new.logprobs = [x for s in samplers for x in s.logprobs]
+        new.vocab_size = samplers[0].vocab_size
+        new.device = samplers[0].device
+        new._update_flags()
+        return new
+
+    def process_logits(self, logits: torch.Tensor) -> torch.Tensor:
+        """Apply the processors of every row to [batch_size, vocab_size] logits."""
+        logits = logits.float()
+        if self.use_temperature:
+            temperature = torch.where(self.temperature_mask, self.temperature, 1.0)
+            logits = logits / temperature.unsqueeze(-1)
+        if self.use_penalty:
+            penalty = torch.where(self.penalty_mask, self.repetition_penalty, 1.0)
+            penalty = penalty.unsqueeze(-1)
+            penalized = torch.where(logits < 0, logits * penalty, logits / penalty)
+            logits = torch.where(self.seen, penalized, logits)
+        if self.use_top_p or self.use_top_k:
+            sorted_logits, sorted_index = torch.sort(logits, dim=-1, descending=True)
+            remove = torch.zeros_like(sorted_logits, dtype=torch.bool)
+            if self.use_top_p:
+                probs = torch.softmax(sorted_logits, dim=-1)
+                # Keep the smallest set of tokens whose cumulative probability
+                # reaches top_p, and at least the most likely one.
+                cum_probs_before = torch.cumsum(probs, dim=-1) - probs
+                remove |= (cum_probs_before >= self.top_p.unsqueeze(-1)) & (
+                    self.top_p_mask.unsqueeze(-1)
+                )
+                remove[:, 0] = False
+            if self.use_top_k:
+                ranks = torch.arange(logits.shape[-1], device=logits.device)
+                top_k = torch.where(self.top_k_mask, self.top_k, logits.shape[-1])
+                remove |= ranks.unsqueeze(0) >= top_k.unsqueeze(-1)
+            sorted_logits = sorted_logits.masked_fill(remove, -float("inf"))
+            logits = torch.empty_like(logits).scatter_(-1, sorted_index, sorted_logits)
+        return logits
+
+    @torch.inference_mode()
+    def __call__(
+        self, logits: torch.Tensor, num_samples: int = 1, update_history: bool = True
+    ) -> SamplerOutput:
+        """Sample `num_samples` distinct tokens for each row of the last-step logits.
+
+        If `update_history` is true, the first sampled token of each row is
+        marked as seen for the repetition penalty of the next steps.
+        """
+        if logits.device != torch.device(self.device):
+            logits = logits.to(self.device)
+        processed = self.process_logits(logits)
+
+        # The ranking of greedy rows is not changed by the warpers, which only
+        # scale the logits or mask the tail.
+        greedy_tokens = torch.topk(processed, num_samples, dim=-1).indices
+        if self.all_greedy:
+            tokens = greedy_tokens
+        else:
+            # Sample without replacement with the exponential race, which draws
+            # the whole batch at once: argmax(p / q) with q ~ Exp(1).
+            probs = torch.softmax(processed, dim=-1)
+            q = torch.empty_like(probs).exponential_(1)
+            q.clamp_(min=torch.finfo(q.dtype).tiny)
+            sampled_tokens = torch.topk(probs / q, num_samples, dim=-1).indices
+            tokens = torch.where(
+                self.greedy.unsqueeze(-1), greedy_tokens, sampled_tokens
+            )
+        if update_history:
+            self.append(tokens[:, 0])
+
+        # Logprobs are based on the raw logits.
+        token_logprobs = [None] * len(self)
+        top_logprobs = [None] * len(self)
+        num_top = [n for n in self.logprobs if n is not None]
+        if num_top:
+            logprobs = torch.log_softmax(logits.float(), dim=-1)
+            chosen = logprobs.gather(-1, tokens[:, :1]).squeeze(-1)
+            max_top = min(max(num_top), logprobs.shape[-1])
+            top_values, top_index = torch.topk(logprobs, max_top, dim=-1)
+            chosen, top_values, top_index = (
+                chosen.tolist(),
+                top_values.tolist(),
+                top_index.tolist(),
+            )
+            for i, n in enumerate(self.logprobs):
+                if n is not None:
+                    token_logprobs[i] = chosen[i]
+                    top_logprobs[i] = dict(zip(top_index[i][:n], top_values[i][:n]))
+
+        return SamplerOutput(tokens.tolist(), token_logprobs, top_logprobs)
+
+
+def get_prompt_logprobs(
+    logits: torch.Tensor, token_ids: torch.Tensor, num_top: int
+) -> Tuple[List[float], List[Dict[int, float]]]:
+    """Logprobs of the prompt tokens and their top-N alternatives.
+
+    `logits` are the [seq_len, vocab_size] logits of one prompt and `token_ids`
+    its [seq_len] token ids. The first token has no logprobs and is skipped.
+    """
+    logprobs = torch.log_softmax(logits[:-1].float(), dim=-1)
+    token_logprobs = logprobs.gather(-1, token_ids[1:].unsqueeze(-1)).squeeze(-1)
+    top_logprobs = [{} for _ in range(logprobs.shape[0])]
+    if num_top > 0:
+        top_values, top_index = torch.topk(logprobs, num_top, dim=-1)
+        top_logprobs = [
+            dict(zip(index, values))
+            for index, values in zip(top_index.tolist(), top_values.tolist())
+        ]
+    return token_logprobs.tolist(), top_logprobs
@@ -0,0 +1,360 @@
+"""
+Speculative decoding with a draft model for the huggingface/transformers workers.
+
+Each step, a small draft model proposes `k` tokens one by one, and the target
+model scores all of them in a single forward pass. The proposals are accepted
+with the standard rejection rule: token d drawn from the draft distribution q
+is kept with probability min(1, p(d) / q(d)), where p is the target
+distribution, and the first rejected token is replaced by a sample of the
+normalized max(0, p - q). When all the proposals are accepted, one more token
+is sampled from the target. Both distributions are processed by the same
+temperature, repetition penalty, top-p and top-k as `generate_stream`, so the
+output follows the same distribution as without a draft model, while one target
+forward can produce up to `k + 1` tokens. Greedy requests keep a proposal if it
+is the argmax of the target.
+
+The draft model must share the tokenizer of the target model. Other proposers,
+such as the n-gram lookahead in `lookahead_decoding.py`, plug into the same
+verification loop, see `generate_stream_with_proposer`.
+"""
+import dataclasses
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from fastchat.serve.inference import BatchedRequest, decode_top_logprobs
+from fastchat.serve.sampler import BatchSampler, get_prompt_logprobs
+
+
+@dataclasses.dataclass
+class SpeculativeDecodingMetrics:
+    num_steps: int = 0  # Target forwards after the prefill
+    num_proposed: int = 0
+    num_accepted: int = 0
+    num_generated: int = 0
+
+    def __post_init__(self):
+        self.lock = threading.Lock()
+
+    def update(self, num_proposed: int, num_accepted: int, num_generated: int):
+        with self.lock:
+            self.num_steps += 1
+            self.num_proposed += num_proposed
+            self.num_accepted += num_accepted
+            self.num_generated += num_generated
+
+    def get_status(self) -> Dict:
+        with self.lock:
+            return {
+                "num_steps": self.num_steps,
+                "num_proposed": self.num_proposed,
+                "num_accepted": self.num_accepted,
+                "acceptance_rate": self.num_accepted / max(self.num_proposed, 1),
+                "tokens_per_step": self.num_generated / max(self.num_steps, 1),
+            }
+
+
+def crop_past_key_values(past_key_values, length: int):
+    """Drop the cached tokens after the first `length` ones."""
+    if hasattr(past_key_values, "crop"):
+        # A negative value removes that many tokens in every transformers version.
+        num_removed = past_key_values.get_seq_length() - length
+        if num_removed > 0:
+            past_key_values.crop(-num_removed)
+        return past_key_values
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+
+
+def match_vocab_size(logits: torch.Tensor, vocab_size: int) -> torch.Tensor:
+    """Trim or pad the logits of the draft model to the vocabulary of the target."""
+    if logits.shape[-1] > vocab_size:
+        return logits[..., :vocab_size]
+    if logits.shape[-1] < vocab_size:
+        pad = logits.new_full(
+            (*logits.shape[:-1], vocab_size - logits.shape[-1]), -float("inf")
+        )
+        return torch.cat([logits, pad], dim=-1)
+    return logits
+
+
+class DraftModelProposer:
+    """Propose tokens by sampling a draft model, with its own KV cache."""
+
+    def __init__(self, draft_model):
+        self.draft_model = draft_model
+        self.past_key_values = None
+        self.cache_len = 0  # The number of output tokens in the KV cache
+
+    def propose(
+        self, sampler: BatchSampler, output_ids: List[int], num_tokens: int
+    ) -> Tuple[List[int], Optional[torch.Tensor]]:
+        """Return the proposals and their [num_tokens, vocab_size] draft
+        distributions. Greedy requests get no distributions."""
+        draft_sampler = BatchSampler.concat([sampler])
+        drafts = []
+        draft_probs = []
+        input_ids = output_ids[self.cache_len :]
+        for _ in range(num_tokens):
+            out = self.draft_model(
+                input_ids=torch.as_tensor([input_ids], device=self.draft_model.device),
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+            self.past_key_values = out.past_key_values
+            logits = out.logits[:, -1, :].to(sampler.device)
+            processed = draft_sampler.process_logits(
+                match_vocab_size(logits, sampler.vocab_size)
+            )
+            if sampler.all_greedy:
+                token = processed.argmax(dim=-1)
+            else:
+                probs = torch.softmax(processed, dim=-1)
+                token = torch.multinomial(probs, 1).squeeze(-1)
+                draft_probs.append(probs[0])
+            draft_sampler.append(token)
+            drafts.append(int(token))
+            input_ids = drafts[-1:]
+        # The last proposal was never fed to the draft model.
+        self.cache_len = len(output_ids) + num_tokens - 1
+        return drafts, torch.stack(draft_probs) if draft_probs else None
+
+    def update(
+        self,
+        output_ids: List[int],
+        drafts: List[int],
+        num_accepted: int,
+        processed_logits: torch.Tensor,
+    ):
+        self.cache_len = min(self.cache_len, len(output_ids) + num_accepted)
+        self.past_key_values = crop_past_key_values(
+            self.past_key_values, self.cache_len
+        )
+
+
+def verify(
+    model,
+    sampler: BatchSampler,
+    output_ids: List[int],
+    past_key_values,
+    cache_len: int,
+    drafts: List[int],
+    draft_probs: Optional[torch.Tensor],
+):
+    """Score the proposals `drafts` in one forward of the target model.
+
+    The KV cache covers the first `cache_len` tokens of `output_ids`.
+    `draft_probs` are the [num_drafts, vocab_size] distributions the proposals
+    were sampled from, or None for deterministic proposals, which are accepted
+    with the target probability of the token. Return the accepted proposals
+    followed by the token sampled from the target, the raw and processed target
+    logits of all the proposals plus one, the KV cache cropped to the accepted
+    proposals, and the sampler updated with the new tokens.
+    """
+    device = sampler.device
+    num_drafts = len(drafts)
+    out = model(
+        input_ids=torch.as_tensor(
+            [output_ids[cache_len:] + drafts], device=model.device
+        ),
+        past_key_values=past_key_values,
+        use_cache=True,
+    )
+    target_logits = out.logits[0, -(num_drafts + 1) :].float().to(device)
+    # Row j is the target distribution after the first j proposals, with the
+    # proposals in the history of the repetition penalty.
+    rows = BatchSampler.concat([sampler] * (num_drafts + 1))
+    for j in range(num_drafts):
+        rows.seen[j + 1 :, drafts[j]] = True
+    processed = rows.process_logits(target_logits)
+    draft_ids = torch.as_tensor(drafts, dtype=torch.long, device=device)
+
+    if sampler.all_greedy:
+        target_tokens = processed.argmax(dim=-1)
+        accepted = (target_tokens[:num_drafts] == draft_ids).tolist()
+    else:
+        probs = torch.softmax(processed, dim=-1)
+        if draft_probs is None:
+            draft_probs = torch.zeros_like(probs[:num_drafts])
+            draft_probs.scatter_(-1, draft_ids.unsqueeze(-1), 1.0)
+        index = draft_ids.unsqueeze(-1)
+        p = probs[:num_drafts].gather(-1, index).squeeze(-1)
+        q = draft_probs.gather(-1, index).squeeze(-1)
+        u = torch.rand(num_drafts, device=device)
+        accepted = (u * q <= p).tolist()
+    num_accepted = accepted.index(False) if False in accepted else num_drafts
+
+    if sampler.all_greedy:
+        token = int(target_tokens[num_accepted])
+    else:
+        dist = probs[num_accepted]
+        if num_accepted < num_drafts:
+            residual = (dist - draft_probs[num_accepted]).clamp(min=0)
+            if residual.sum() > 0:
+                dist = residual
+        token = int(torch.multinomial(dist / dist.sum(), 1))
+
+    rows.select([num_accepted])
+    rows.append(torch.as_tensor([token], device=device))
+    past_key_values = crop_past_key_values(
+        out.past_key_values, len(output_ids) + num_accepted
+    )
+    return (
+        drafts[:num_accepted] + [token],
+        target_logits,
+        processed,
+        past_key_values,
+        rows,
+    )
+
+
+@torch.inference_mode()
+def generate_stream_with_proposer(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int,
+    proposer,
+    num_speculative_tokens: int,
+    metrics: Optional[SpeculativeDecodingMetrics] = None,
+):
+    """`generate_stream` for decoder-only models, verifying the tokens that
+    `proposer` guesses at every step.
+
+    A proposer has `propose(sampler, output_ids, num_tokens)`, which returns up
+    to `num_tokens` proposals and their draft distributions (see `verify`), and
+    `update(output_ids, drafts, num_accepted, processed_logits)`, which is
+    called after each verification with the output before the new tokens.
+    """
+    if hasattr(model, "device"):
+        device = model.device
+    req = BatchedRequest(params, tokenizer, context_len)
+
+    # Prefill
+    input_ids = torch.as_tensor([req.input_ids], device=device)
+    out = model(input_ids=input_ids, use_cache=True)
+    logits = out.logits
+    if req.logprobs is not None:
+        prompt_logprobs, prompt_top_logprobs = get_prompt_logprobs(
+            logits[0], input_ids[0], req.logprobs
+        )
+        req.token_logprobs.extend(prompt_logprobs)
+        req.top_logprobs.extend(
+            decode_top_logprobs(tokenizer, x) for x in prompt_top_logprobs
+        )
+    sampler = BatchSampler(
+        [req.temperature],
+        [req.repetition_penalty],
+        [req.top_p],
+        [req.top_k],
+        [req.logprobs],
+        [req.input_ids],
+        logits.shape[-1],
+        # Switch to CPU by avoiding some bugs in mps backend.
+        "cpu" if device == "mps" else logits.device,
+    )
+    sampled = sampler(logits[:, -1, :])
+    new_tokens = [sampled.tokens[0][0]]
+    token_logprobs = sampled.token_logprobs
+    top_logprobs = sampled.top_logprobs
+    past_key_values = out.past_key_values
+    cache_len = len(req.input_ids)
+
+    while True:
+        stream = False
+        stopped = False
+        for j, token in enumerate(new_tokens):
+            req.output_ids.append(token)
+            if req.logprobs is not None:
+                req.token_logprobs.append(token_logprobs[j])
+                req.top_logprobs.append(decode_top_logprobs(tokenizer, top_logprobs[j]))
+            stopped = token in req.stop_token_ids
+            if (req.num_generated - 1) % stream_interval == 0:
+                stream = True
+            if stopped or req.num_generated >= req.max_new_tokens:
+                stream = True
+                break
+        if stream:
+            output = req.make_output(tokenizer, stopped)
+            if output is not None:
+                yield output
+        if req.finished:
+            break
+
+        # The target samples one more token after the proposals.
+        remaining = req.max_new_tokens - req.num_generated
+        num_tokens = min(num_speculative_tokens, remaining - 1)
+        drafts, draft_probs = [], None
+        if num_tokens > 0:
+            drafts, draft_probs = proposer.propose(sampler, req.output_ids, num_tokens)
+        if not drafts:
+            out = model(
+                input_ids=torch.as_tensor([req.output_ids[cache_len:]], device=device),
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+            past_key_values = out.past_key_values
+            cache_len = len(req.output_ids)
+            sampled = sampler(out.logits[:, -1, :])
+            new_tokens = [sampled.tokens[0][0]]
+            token_logprobs = sampled.token_logprobs
+            top_logprobs = sampled.top_logprobs
+            if metrics is not None:
+                metrics.update(0, 0, 1)
+            continue
+
+        new_tokens, target_logits, processed, past_key_values, sampler = verify(
+            model,
+            sampler,
+            req.output_ids,
+            past_key_values,
+            cache_len,
+            drafts,
+            draft_probs,
+        )
+        num_accepted = len(new_tokens) - 1
+        proposer.update(req.output_ids, drafts, num_accepted, processed)
+        cache_len = len(req.output_ids) + num_accepted
+        if metrics is not None:
+            metrics.update(len(drafts), num_accepted, len(new_tokens))
+        if req.logprobs is not None:
+            # Logprobs are based on the raw logits, like in `BatchSampler`.
+            logprobs = torch.log_softmax(target_logits[: len(new_tokens)], dim=-1)
+            chosen = torch.as_tensor(new_tokens, device=logprobs.device)
+            token_logprobs = logprobs.gather(-1, chosen.unsqueeze(-1)).squeeze(-1)
+            token_logprobs = token_logprobs.tolist()
+            top_logprobs = [{}] * len(new_tokens)
+            if req.logprobs > 0:
+                top_values, top_index = torch.topk(logprobs, req.logprobs, dim=-1)
+                top_logprobs = [
+                    dict(zip(index, values))
+                    for index, values in zip(top_index.tolist(), top_values.tolist())
+                ]
+
+
+def generate_stream_speculative(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int = 2,
+    judge_sent_end: bool = False,
+    draft_model=None,
+    num_speculative_tokens: int = 4,
+    metrics: Optional[SpeculativeDecodingMetrics] = None,
+):
+    """`generate_stream` for decoder-only models, with speculative decoding."""
+    yield from generate_stream_with_proposer(
+        model,
+        tokenizer,
+        params,
+        device,
+        context_len,
+        stream_interval,
+        DraftModelProposer(draft_model),
+        num_speculative_tokens,
+        metrics,
+    )
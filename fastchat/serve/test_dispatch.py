@@ -0,0 +1,144 @@
+"""
+Benchmarking script to compare the dispatch methods of the controller.
+
+It simulates a cluster of workers with different decoding speeds that receive
+Poisson arrivals, and reports the request latency under each dispatch method.
+Workers report their status with heart beats as real workers do, and in-flight
+tracking methods are notified when a request completes.
+
+Usage:
+python3 -m fastchat.serve.test_dispatch --worker-speeds 20,20,40,80 --load 0.8
+"""
+import argparse
+import collections
+import heapq
+
+import numpy as np
+
+from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.serve.controller import WorkerInfo
+from fastchat.serve.dispatch import DispatchMethod, dispatch_worker
+
+
+class SimulatedWorker:
+    def __init__(self, tokens_per_second: float, max_batch_size: int):
+        self.tokens_per_second = tokens_per_second
+        self.max_batch_size = max_batch_size
+        self.num_running = 0
+        self.waiting = collections.deque()
+
+    def get_status(self):
+        return {
+            "model_names": ["model"],
+            "speed": 1,
+            "queue_length": self.num_running + len(self.waiting),
+            "tokens_per_second": self.tokens_per_second,
+            "kv_cache": {"occupancy": self.num_running / self.max_batch_size},
+        }
+
+
+def simulate(dispatch_method: DispatchMethod, args, seed: int):
+    rng = np.random.default_rng(seed)
+    np.random.seed(seed)
+    speeds = [float(x) for x in args.worker_speeds.split(",")]
+    workers = [SimulatedWorker(s, args.max_batch_size) for s in speeds]
+
+    names = [f"worker-{i}" for i in range(len(workers))]
+    worker_info = {}
+    for name, worker in zip(names, workers):
+        status = worker.get_status()
+        worker_info[name] = WorkerInfo(
+            status["model_names"], status["speed"], 0, True, 0.0, False
+        )
+        worker_info[name].update_load(status)
+
+    capacity = sum(speeds) * args.max_batch_size / args.mean_output_len
+    arrival_rate = args.load * capacity
+
+    events = []  # (time, order, kind, payload)
+    order = 0
+
+    def push(t, kind, payload=None):
+        nonlocal order
+        heapq.heappush(events, (t, order, kind, payload))
+        order += 1
+
+    def start(i, arrival_time, num_tokens, now):
+        workers[i].num_running += 1
+        finish_time = now + num_tokens / workers[i].tokens_per_second
+        push(finish_time, "finish", (i, arrival_time))
+
+    t = 0.0
+    for _ in range(args.num_requests):
+        t += rng.exponential(1 / arrival_rate)
+        push(t, "arrival", max(int(rng.exponential(args.mean_output_len)), 1))
+    for i in range(len(workers)):
+        # Heart beats of different workers are not aligned.
+        push(rng.uniform(0, WORKER_HEART_BEAT_INTERVAL), "heart_beat", i)
+
+    latencies = []
+    while len(latencies) < args.num_requests:
+        now, _, kind, payload = heapq.heappop(events)
+        if kind == "arrival":
+            i = names.index(dispatch_worker(worker_info, "model", dispatch_method))
+            if workers[i].num_running < workers[i].max_batch_size:
+                start(i, now, payload, now)
+            else:
+                workers[i].waiting.append((now, payload))
+        elif kind == "finish":
+            i, arrival_time = payload
+            latencies.append(now - arrival_time)
+            workers[i].num_running -= 1
+            if workers[i].waiting:
+                start(i, *workers[i].waiting.popleft(), now)
+            if dispatch_method.tracks_in_flight:
+                w_info = worker_info[names[i]]
+                w_info.in_flight = max(w_info.in_flight - 1, 0)
+        elif kind == "heart_beat":
+            worker_info[names[payload]].update_load(workers[payload].get_status())
+            push(now + WORKER_HEART_BEAT_INTERVAL, "heart_beat", payload)
+
+    return np.array(latencies)
+
+
+def main():
+    print(
+        f"{'method':<16}{'mean (s)':>10}{'p50 (s)':>10}{'p90 (s)':>10}{'p99 (s)':>10}"
+    )
+    for name in args.dispatch_methods.split(","):
+        dispatch_method = DispatchMethod.from_str(name)
+        latencies = np.concatenate(
+            [simulate(dispatch_method, args, seed) for seed in range(args.num_trials)]
+        )
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(
+            f"{name:<16}{latencies.mean():>10.2f}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dispatch-methods",
+        type=str,
+        default="lottery,shortest_queue,least_loaded,power_of_two",
+    )
+    parser.add_argument(
+        "--worker-speeds",
+        type=str,
+        default="20,20,40,80",
+        help="Comma separated decoding speeds (tokens/s) of the workers",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument(
+        "--load",
+        type=float,
+        default=0.8,
+        help="Arrival rate as a fraction of the total capacity of the workers",
+    )
+    parser.add_argument("--mean-output-len", type=float, default=256)
+    parser.add_argument("--num-requests", type=int, default=5000)
+    parser.add_argument("--num-trials", type=int, default=3)
+    args = parser.parse_args()
+
+    main()
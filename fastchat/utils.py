@@ -11,9 +11,10 @@ import os
 import platform
 import sys
 import time
-from typing import AsyncGenerator, Generator
+from typing import AsyncGenerator, Generator, Iterable, List, Optional, Tuple
 import warnings
 
+import numpy as np
 import requests
 
 from fastchat.constants import LOGDIR
@@ -335,6 +336,233 @@ def is_partial_stop(output: str, stop_str: str):
     return False
 
 
+class StopStringMatcher:
+    """
+    Find stop strings in a growing output by only scanning its new tail.
+
+    Text before `start` (e.g., the echoed prompt) is never matched.
+    """
+
+    def __init__(self, stop_str, start: int = 0):
+        if not stop_str:
+            self.stop_strs = []
+        elif isinstance(stop_str, str):
+            self.stop_strs = [stop_str]
+        elif isinstance(stop_str, Iterable):
+            self.stop_strs = [s for s in stop_str if s]
+        else:
+            raise ValueError("Invalid stop field type.")
+        self.max_len = max((len(s) for s in self.stop_strs), default=0)
+        self.start = start
+        self.scanned = start
+
+    def find(self, output: str) -> Tuple[int, bool]:
+        """
+        Return the position of the earliest stop string in `output` (or -1) and
+        whether `output` ends with a prefix of a stop string.
+        """
+        if not self.stop_strs:
+            return -1, False
+
+        # A stop string may straddle the boundary of the previous scan.
+        search_start = max(self.scanned - self.max_len + 1, self.start)
+        self.scanned = len(output)
+        positions = [output.find(s, search_start) for s in self.stop_strs]
+        positions = [pos for pos in positions if pos != -1]
+        if positions:
+            return min(positions), False
+
+        tail = output[max(search_start, len(output) - self.max_len) :]
+        partially_stopped = any(is_partial_stop(tail, s) for s in self.stop_strs)
+        return -1, partially_stopped
+
+
+class IncrementalDetokenizer:
+    """
+    Decode a growing list of token ids by only decoding a small window around the new tokens.
+
+    Pieces that end with an incomplete UTF-8 character (decoded as "\ufffd") are
+    held back until the following tokens complete them.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        token_ids: Optional[List[int]] = None,
+        skip_special_tokens: bool = True,
+        spaces_between_special_tokens: bool = False,
+        clean_up_tokenization_spaces: bool = True,
+    ):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = dict(
+            skip_special_tokens=skip_special_tokens,
+            spaces_between_special_tokens=spaces_between_special_tokens,
+            clean_up_tokenization_spaces=clean_up_tokenization_spaces,
+        )
+        self.reset(token_ids or [])
+
+    def reset(self, token_ids: List[int]):
+        """Restart from `token_ids`, e.g., after rewriting an already decoded token."""
+        self.token_ids = list(token_ids)
+        self.text = self.decode(self.token_ids)
+        self.read_offset = len(self.token_ids)
+        # Keep a few tokens of left context so that the leading spaces of the
+        # new tokens are decoded the same way as in the full sequence.
+        self.prefix_offset = max(self.read_offset - 6, 0)
+
+    def decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, **self.decode_kwargs)
+
+    def add_tokens(self, token_ids: List[int], flush: bool = False) -> str:
+        """Append token ids and return the newly decoded text.
+
+        Set `flush` on the last call to also emit an incomplete trailing character.
+        """
+        self.token_ids.extend(token_ids)
+        prefix_text = self.decode(self.token_ids[self.prefix_offset : self.read_offset])
+        new_text = self.decode(self.token_ids[self.prefix_offset :])
+        if len(new_text) <= len(prefix_text) or (
+            new_text.endswith("\ufffd") and not flush
+        ):
+            return ""
+
+        delta = new_text[len(prefix_text) :]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        self.text += delta
+        return delta
+
+
+class StreamDeltaEncoder:
+    """
+    Encode the chunks of `/worker_generate_stream` for the "stream_delta" protocol.
+
+    Instead of the full text generated so far, each chunk carries only the new
+    text in "text" and the length of the text it continues in "text_offset".
+    A chunk may rewrite the end of the previous text, in which case "text_offset"
+    is less than the length of the previous text. Likewise, "logprobs" only holds
+    the new tokens, starting at token index "token_offset".
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.num_tokens = 0
+
+    def encode(self, ret: dict) -> dict:
+        text = ret["text"]
+        if text.startswith(self.text):
+            text_offset = len(self.text)
+        else:
+            text_offset = len(os.path.commonprefix([self.text, text]))
+        self.text = text
+        ret = dict(ret, text=text[text_offset:], text_offset=text_offset)
+
+        logprobs = ret.get("logprobs")
+        if logprobs is not None:
+            num_tokens = len(logprobs["tokens"])
+            token_offset = self.num_tokens if num_tokens >= self.num_tokens else 0
+            ret["logprobs"] = {
+                k: v[token_offset:] if isinstance(v, list) else v
+                for k, v in logprobs.items()
+            }
+            ret["token_offset"] = token_offset
+            self.num_tokens = num_tokens
+        return ret
+
+
+class StreamDeltaDecoder:
+    """
+    Turn the chunks of `/worker_generate_stream` into chunks that only carry the
+    text and logprobs not returned before.
+
+    Both "stream_delta" chunks and the full-text chunks of workers that do not
+    support the protocol are accepted. Rewrites of already returned text are
+    dropped, since they cannot be streamed to the client. A trailing "\ufffd"
+    may be the start of an incomplete character, so it is held back until the
+    character is complete or the last chunk.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.text_len = 0
+        self.num_tokens = 0
+
+    def decode(self, content: dict) -> dict:
+        self.text = self.text[: content.get("text_offset", 0)] + content["text"]
+        text = self.text
+        if content.get("finish_reason") is None:
+            text = text.rstrip("\ufffd")
+        token_offset = content.get("token_offset", 0)
+
+        content = dict(content, text=text[self.text_len :])
+        self.text_len = max(self.text_len, len(text))
+
+        logprobs = content.get("logprobs")
+        if logprobs is not None:
+            skip = max(self.num_tokens - token_offset, 0)
+            self.num_tokens = max(
+                self.num_tokens, token_offset + len(logprobs["tokens"])
+            )
+            content["logprobs"] = {
+                k: v[skip:] if isinstance(v, list) else v for k, v in logprobs.items()
+            }
+        return content
+
+
+EMBEDDING_BUFFER_MAGIC = b"FCEB"
+
+
+def encode_embedding_buffer(ret: dict) -> bytes:
+    """
+    Pack the result of `get_embeddings` into one binary buffer.
+
+    The layout is the magic bytes, the little-endian uint32 length of a JSON
+    header, the header and the embeddings as one contiguous little-endian
+    float16/float32 array, aligned to 8 bytes. The header holds the dtype and
+    shape of the array and the other fields of `ret`.
+    """
+    embedding = ret.get("embedding")
+    header = {k: v for k, v in ret.items() if k != "embedding"}
+    data = b""
+    if embedding is not None:
+        embedding = np.asarray(embedding)
+        if embedding.dtype != np.float16:
+            embedding = embedding.astype(np.float32)
+        embedding = embedding.astype(embedding.dtype.newbyteorder("<"), copy=False)
+        header["dtype"] = embedding.dtype.str
+        header["shape"] = list(embedding.shape)
+        data = np.ascontiguousarray(embedding).tobytes()
+    header = json.dumps(header).encode()
+    header += b" " * (-(len(EMBEDDING_BUFFER_MAGIC) + 4 + len(header)) % 8)
+    return b"".join(
+        [EMBEDDING_BUFFER_MAGIC, len(header).to_bytes(4, "little"), header, data]
+    )
+
+
+def decode_embedding_buffer(buffer: bytes) -> dict:
+    """
+    Unpack a buffer of `encode_embedding_buffer` without copying the embeddings.
+
+    A JSON response of a worker that does not support the binary format is
+    accepted as well. In both cases "embedding" is returned as a NumPy array.
+    """
+    if not (isinstance(buffer, bytes) and buffer.startswith(EMBEDDING_BUFFER_MAGIC)):
+        ret = json.loads(buffer)
+        if "embedding" in ret:
+            ret["embedding"] = np.asarray(ret["embedding"], dtype=np.float32)
+        return ret
+    start = len(EMBEDDING_BUFFER_MAGIC) + 4
+    header_len = int.from_bytes(buffer[len(EMBEDDING_BUFFER_MAGIC) : start], "little")
+    ret = json.loads(buffer[start : start + header_len])
+    if "shape" in ret:
+        dtype = np.dtype(ret.pop("dtype"))
+        shape = ret.pop("shape")
+        ret["embedding"] = np.frombuffer(
+            buffer, dtype=dtype, count=int(np.prod(shape)), offset=start + header_len
+        ).reshape(shape)
+    return ret
+
+
 def run_cmd(cmd: str):
     """Run a bash command."""
     print(cmd)